@@ -1,7 +1,8 @@
 import tensorflow as tf
 from select_knn_op import SelectKnn
 from accknn_op import AccumulateKnn
-from local_cluster_op import LocalCluster
+from select_knn_accumulate_op import SelectKnnAccumulate
+from local_cluster_op import LocalCluster, LocalClusterHierarchy
 
 from local_distance_op import LocalDistance
 from lossLayers import LLLocalClusterCoordinates
@@ -92,9 +93,8 @@ class LocalClustering(tf.keras.layers.Layer):
         This layer does *not* introduce any new gradients on anything (e.g. the hierarchy score),
         so that needs to be done by hand. (e.g. using LLLocalClusterCoordinates).
         
-        Since this layers functionality is inherently sequential, it will run on CPU. Right now, 
-        the implementation (local_cluster_xx) can still be optimised for using multiple CPU cores.
-        A simple way of (mild) parallelising would be given by the row splits.
+        Since this layers functionality is inherently sequential, it will run on CPU.
+        The row splits are processed in parallel.
         
         """
         if 'dynamic' in kwargs:
@@ -125,20 +125,11 @@ class LocalClustering(tf.keras.layers.Layer):
         
     @staticmethod
     def raw_call(neighs, hier, row_splits,print_reduction,name):
-        if row_splits.shape[0] is None:
-            return tf.zeros_like(hier, dtype='int32'), row_splits, tf.zeros_like(hier, dtype='int32')
-        
         if hier.shape[1] > 1:
             raise ValueError(name+' received wrong hierarchy shape')
-        
-        hierarchy_idxs=[]
-        for i in range(row_splits.shape[0] - 1):
-            a = tf.argsort(hier[row_splits[i]:row_splits[i+1]],axis=0, direction='DESCENDING')
-            hierarchy_idxs.append(a+row_splits[i])
-        hierarchy_idxs = tf.concat(hierarchy_idxs,axis=0)
-        
-        
-        rs,sel,ggather = LocalCluster(neighs, hierarchy_idxs, row_splits)
+
+        #sorted by decreasing hierarchy within each row split in the op
+        rs,sel,ggather = LocalClusterHierarchy(neighs, hier, row_splits)
         
         #keras does not like gather_nd outputs
         sel = tf.reshape(sel, [-1,1])
@@ -146,7 +137,7 @@ class LocalClustering(tf.keras.layers.Layer):
         rs = tf.cast(rs, tf.int32) #just so keras knows
         ggather = tf.reshape(ggather, [-1,1])
         if print_reduction:
-            tf.print(name,'reduction',round(float(sel.shape[0])/float(ggather.shape[0]),2),'to',sel.shape[0])
+            tf.print(name,'reduction',tf.shape(sel)[0]/tf.shape(ggather)[0],'to',tf.shape(sel)[0])
         return sel, rs, ggather
         
     def call(self, inputs):
@@ -746,6 +737,9 @@ class RaggedGravNet(tf.keras.layers.Layer):
                  n_dimensions: int,
                  n_filters : int,
                  n_propagate : int,
+                 fused_knn : bool = False,
+                 return_neighbours : bool = True,
+                 knn_max_shells : int = -1,
                  **kwargs):
         """
         Call will return output features, coordinates, neighbor indices and squared distances from neighbors
@@ -756,6 +750,12 @@ class RaggedGravNet(tf.keras.layers.Layer):
         features transformations (minimum 1)
 
         :param n_propagate: how much to propagate in feature tranformation, could be a list in case of multiple
+        :param fused_knn: (CPU only) select the neighbours and accumulate their features in one op
+        (SelectKnnAccumulate), same results
+        :param return_neighbours: only with fused_knn. If False, the neighbour indices and distances
+        are not kept and returned with shape V x 0, which saves the V x K matrices
+        :param knn_max_shells: approximate neighbour search for inference, see SelectKnn max_shells
+        (uses the binned search). -1: exact
         :param kwargs:
         """
         super(RaggedGravNet, self).__init__(**kwargs)
@@ -766,6 +766,9 @@ class RaggedGravNet(tf.keras.layers.Layer):
         self.n_neighbours = n_neighbours
         self.n_dimensions = n_dimensions
         self.n_filters = n_filters
+        self.fused_knn = fused_knn
+        self.return_neighbours = return_neighbours or not fused_knn
+        self.knn_max_shells = knn_max_shells
 
         self.n_propagate = n_propagate
         self.n_prop_total = 2 * self.n_propagate
@@ -813,20 +816,40 @@ class RaggedGravNet(tf.keras.layers.Layer):
         
         coordinates = self.input_spatial_transform(x)
 
+        if self.fused_knn:
+            return self.priv_call_fused(x, coordinates, row_splits)
+
         neighbour_indices, distancesq = self.compute_neighbours_and_distancesq(coordinates, row_splits)
         neighbour_indices = tf.reshape(neighbour_indices, [-1, self.n_neighbours-1]) #for proper output shape for keras
         distancesq = tf.reshape(distancesq, [-1, self.n_neighbours-1])
 
         return self.create_output_features(x, neighbour_indices, distancesq), coordinates, neighbour_indices, distancesq
 
+    def priv_call_fused(self, x, coordinates, row_splits):
+        features = self.input_feature_transform(x)
+        prev_feat = features
+        features, _, neighbour_indices, distancesq = SelectKnnAccumulate(self.n_neighbours, coordinates, features,
+                                                                         row_splits, distance_scale=10.,
+                                                                         return_neighbours=self.return_neighbours,
+                                                                         max_shells=self.knn_max_shells)
+        features = tf.reshape(features, [-1, prev_feat.shape[1] * 2])
+        features -= tf.tile(prev_feat, [1, 2])
+        features = self.output_feature_transform(tf.concat([features, x], axis=-1))
+
+        n_kept = self.n_neighbours-1 if self.return_neighbours else 0
+        neighbour_indices = tf.reshape(neighbour_indices, [-1, n_kept])
+        distancesq = tf.reshape(distancesq, [-1, n_kept])
+        return features, coordinates, neighbour_indices, distancesq
+
     def call(self, inputs):
         return self.priv_call(inputs)
 
     def compute_output_shape(self, input_shapes):
+        n_kept = self.n_neighbours-1 if self.return_neighbours else 0
         return (input_shapes[0][0], 2*self.n_filters),\
                (input_shapes[0][0], self.n_dimensions),\
-               (input_shapes[0][0], self.n_neighbours-1),\
-               (input_shapes[0][0], self.n_neighbours-1)
+               (input_shapes[0][0], n_kept),\
+               (input_shapes[0][0], n_kept)
               
     
 
@@ -843,7 +866,8 @@ class RaggedGravNet(tf.keras.layers.Layer):
         #     (coordinates[:, tf.newaxis, :] - tf.gather_nd(coordinates, ragged_split_added_indices)) ** 2,
         #     axis=-1)  # [SV, N]
         idx,dist = SelectKnn(self.n_neighbours, coordinates,  row_splits,
-                             max_radius= -1.0, tf_compatible=False)
+                             max_radius= -1.0, tf_compatible=False, binned=self.knn_max_shells >= 0,
+                             max_shells=self.knn_max_shells)
 
         idx = idx[:, 1:]
         dist = dist[:, 1:]
@@ -860,7 +884,10 @@ class RaggedGravNet(tf.keras.layers.Layer):
         config = {'n_neighbours': self.n_neighbours,
                   'n_dimensions': self.n_dimensions,
                   'n_filters': self.n_filters,
-                  'n_propagate': self.n_propagate}
+                  'n_propagate': self.n_propagate,
+                  'fused_knn': self.fused_knn,
+                  'return_neighbours': self.return_neighbours,
+                  'knn_max_shells': self.knn_max_shells}
         base_config = super(RaggedGravNet, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
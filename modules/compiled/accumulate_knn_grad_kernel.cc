@@ -1,3 +1,4 @@
+#define EIGEN_USE_THREADS
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
@@ -8,6 +9,7 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -21,19 +23,45 @@ inline static float distanceWeight(const float& distsq){
     return exp(-1.*ACCUMULATE_KNN_EXPONENT* distsq);
 }
 
-static void set_feature_grad_zero(
-        float * d_out_grad_features,
-        size_t n_vert,
-        size_t n_feat
+/*
+ * Inverse neighbour list (CSR transpose of the neighbour indices):
+ * for each vertex m, all flat entries i_v*n_neigh+i_n with index m,
+ * in increasing order of the entries
+ */
+static void build_inverse_neighbours(
+        const int * d_neigh_indices,
+        const int n_vert,
+        const int n_neigh,
+        std::vector<int>& offsets,
+        std::vector<int>& entries
 ){
-
-    for (size_t i_v = 0; i_v < n_vert; i_v++){
-        for (size_t i_f = 0; i_f < n_feat; i_f++)
-            d_out_grad_features[I2D(i_v, i_f, n_feat)] = 0;
+    offsets.assign(n_vert+1, 0);
+    const size_t n_entries = (size_t)n_vert * n_neigh;
+    for (size_t e = 0; e < n_entries; e++){
+        int m_v = d_neigh_indices[e];
+        if(m_v<0) continue;
+        offsets[m_v+1]++;
+    }
+    for (int m = 0; m < n_vert; m++)
+        offsets[m+1] += offsets[m];
+
+    entries.resize(offsets[n_vert]);
+    std::vector<int> filled(offsets.begin(), offsets.end()-1);
+    for (size_t e = 0; e < n_entries; e++){
+        int m_v = d_neigh_indices[e];
+        if(m_v<0) continue;
+        entries[filled[m_v]++] = e;
     }
 }
 
+/*
+ * Gather-reduce over the inverse neighbour list: every vertex collects the
+ * contributions of all vertices that have it as neighbour, so each output row
+ * is written by exactly one thread. The contributions are added in the same
+ * order as in a loop over vertices and neighbours.
+ */
 static void calc_feature_gradients(
+        const CPUDevice &d,
         const float * d_grad_from_out_features,
         const int * d_max_feat_indices,
         const int * d_neigh_indices,
@@ -47,47 +75,41 @@ static void calc_feature_gradients(
 
         float * d_out_grad_features
 ){
-    for (size_t i_v = 0; i_v < n_vert; i_v++){
-        for(size_t nu_f=0;nu_f<n_feat;nu_f++){
-
-            const float ginu = d_grad_from_out_features[I2D(i_v, nu_f, n_grad_from_out_feat)];
-            const float ginu_max = d_grad_from_out_features[I2D(i_v, nu_f+n_feat, n_grad_from_out_feat)];
-            const int max_for_iv = d_max_feat_indices[I2D(i_v,nu_f,n_feat)];
+    std::vector<int> offsets, entries;
+    build_inverse_neighbours(d_neigh_indices, n_vert, n_neigh, offsets, entries);
 
-            bool firstself=true;
-            for(size_t i_i_n = 0; i_i_n < n_neigh; i_i_n++){
+    auto work = [&](Eigen::Index first, Eigen::Index last){
+        for (Eigen::Index m_v = first; m_v < last; m_v++){
 
-                int m_v = d_neigh_indices[I2D(i_v, i_i_n, n_neigh)];
-                if(m_v<0) continue;
+            float * grad = d_out_grad_features + I2D(m_v, 0, n_feat);
+            for(int nu_f=0;nu_f<n_feat;nu_f++)
+                grad[nu_f] = 0;
 
-                const float distsq_im = d_distances[I2D(i_v,i_i_n,n_neigh)];
+            for(int i_e = offsets[m_v]; i_e < offsets[m_v+1]; i_e++){
+                const int e = entries[i_e];
+                const int i_v = e / n_neigh;
 
-                const float weight_im = distanceWeight(distsq_im);
+                const float weight_im = distanceWeight(d_distances[e]);
 
-                //if weight_im > some number?
-                //     for (size_t nu_f = 0; nu_f < n_feat; nu_f++){
+                const float * ginu = d_grad_from_out_features + I2D(i_v, 0, n_grad_from_out_feat);
+                const float * ginu_max = ginu + n_feat;
+                const int * max_for_iv = d_max_feat_indices + I2D(i_v, 0, n_feat);
 
-                float mean_contrib = ginu  / (float)n_neigh  * weight_im;
-                float max_contrib = 0;
-                if(m_v ==  max_for_iv){
-                    if(m_v == i_v){
-                        if(firstself){//count self just once
-                            max_contrib = ginu_max * weight_im;
-                            //DEBUG firstself=false;
-                        }
-                    }
-                    else{
-                        max_contrib = ginu_max * weight_im;
-                    }
+                //self references are counted for every occurrence, as before
+                for(int nu_f=0;nu_f<n_feat;nu_f++){
+                    float mean_contrib = ginu[nu_f]  / (float)n_neigh  * weight_im;
+                    float max_contrib = max_for_iv[nu_f] == m_v ? ginu_max[nu_f] * weight_im : 0.f;
+                    grad[nu_f] += mean_contrib + max_contrib;
                 }
-
-                //ATOMIC because of m_v which can occur in different threads. this is slow.. but needs to be atomic at least here...
-                d_out_grad_features[I2D(m_v, nu_f, n_feat)] += mean_contrib + max_contrib;
-
-                //     }
             }
         }
-    }
+    };
+
+    const double avg_refs = n_vert > 0 ? (double)entries.size() / (double)n_vert : 0.;
+    d.parallelFor(n_vert,
+            Eigen::TensorOpCost(avg_refs * (2 * n_feat + 1) * sizeof(float) + avg_refs * n_feat * sizeof(int),
+                    n_feat * sizeof(float), avg_refs * 4. * n_feat),
+            work);
 }
 
 static void calc_distance_gradients(
@@ -175,10 +197,8 @@ struct AccumulateKnnGradOpFunctor<CPUDevice, dummy> {
 
         //CPU implementation
 
-        //set zero
-        set_feature_grad_zero(d_out_grad_features, n_vert, n_feat);
-
         calc_feature_gradients(
+                d,
                 d_grad_from_out_features,
                 d_max_feat_indices,
                 d_neigh_indices,
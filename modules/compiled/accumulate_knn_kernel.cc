@@ -1,4 +1,4 @@
-
+#define EIGEN_USE_THREADS
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
@@ -9,6 +9,8 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <algorithm>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -23,6 +25,9 @@ static inline float distanceWeight(const float& distsq){
     return exp(-1.*ACCUMULATE_KNN_EXPONENT* distsq);
 }
 
+// number of features processed together, the accumulators of one block stay in L1
+static const int feature_block_size = 64;
+
 // CPU specialization
 template<typename dummy>
 struct AccumulateKnnOpFunctor<CPUDevice, dummy> {
@@ -44,40 +49,74 @@ struct AccumulateKnnOpFunctor<CPUDevice, dummy> {
 
             int n_moments) {
 
+        auto work = [&](Eigen::Index first, Eigen::Index last){
 
-        for (size_t i_v = 0; i_v < n_vert; i_v++) {
+            std::vector<float> weights(n_neigh);
+            float t_mean[feature_block_size];
+            float t_max[feature_block_size];
+            int max_idx[feature_block_size];
 
-            for(size_t i_f=0;i_f<n_feat;i_f++){
-                float t_mean = 0;
-                float t_max = 0;
-                int max_i_n_gidx = 0;
+            for (Eigen::Index i_v = first; i_v < last; i_v++) {
 
-                for(size_t i_n=0;i_n<n_neigh;i_n++){
-                    int nidx = d_idxs[I2D(i_v,i_n,n_neigh)];
+                //the neighbour list ends at the first negative index
+                int n_valid=0;
+                for(;n_valid<n_neigh;n_valid++){
+                    if(d_idxs[I2D(i_v,n_valid,n_neigh)]<0) break;
+                    weights[n_valid] = distanceWeight(d_distances[I2D(i_v,n_valid,n_neigh)]);
+                }
 
-                    if(nidx<0) break;
+                for(int f_start=0;f_start<n_feat;f_start+=feature_block_size){
+                    const int n_f = std::min(feature_block_size, n_feat-f_start);
 
-                    float vnf = d_feat[I2D(nidx,i_f,n_feat)];
-                    float distsq = d_distances[I2D(i_v,i_n,n_neigh)];
-                    float wfeat = vnf * distanceWeight(distsq);
-                    //DEBUGCOUT(wfeat);
-                    t_mean += wfeat;
-                    if(wfeat >= t_max || !i_n){
-                        max_i_n_gidx = nidx;
-                        t_max = wfeat;
+                    if(n_valid<1){
+                        for(int i_f=0;i_f<n_f;i_f++){
+                            t_mean[i_f] = 0;
+                            t_max[i_f] = 0;
+                            max_idx[i_f] = 0;
+                        }
+                    }
+                    else{
+                        const int nidx = d_idxs[I2D(i_v,0,n_neigh)];
+                        const float w = weights[0];
+                        const float *vnf = d_feat + I2D(nidx,f_start,n_feat);
+                        for(int i_f=0;i_f<n_f;i_f++){
+                            float wfeat = vnf[i_f] * w;
+                            t_mean[i_f] = wfeat;
+                            t_max[i_f] = wfeat;
+                            max_idx[i_f] = nidx;
+                        }
                     }
-                }
-                t_mean /= (float)n_neigh;
 
-                d_out_maxidxs[I2D(i_v,i_f,n_feat)] = max_i_n_gidx; //just used for gradient
-                d_out_feat[I2D(i_v,i_f,n_out_feat)] = t_mean;
-                d_out_feat[I2D(i_v,i_f+n_feat,n_out_feat)] = t_max;
+                    for(int i_n=1;i_n<n_valid;i_n++){
+                        const int nidx = d_idxs[I2D(i_v,i_n,n_neigh)];
+                        const float w = weights[i_n];
+                        const float *vnf = d_feat + I2D(nidx,f_start,n_feat);
+                        //branch free, ties go to the later neighbour
+                        for(int i_f=0;i_f<n_f;i_f++){
+                            float wfeat = vnf[i_f] * w;
+                            t_mean[i_f] += wfeat;
+                            bool larger = wfeat >= t_max[i_f];
+                            t_max[i_f] = larger ? wfeat : t_max[i_f];
+                            max_idx[i_f] = larger ? nidx : max_idx[i_f];
+                        }
+                    }
 
-                //moments in n_coords x n_neigh loop here {}
+                    for(int i_f=0;i_f<n_f;i_f++){
+                        d_out_maxidxs[I2D(i_v,f_start+i_f,n_feat)] = max_idx[i_f]; //just used for gradient
+                        d_out_feat[I2D(i_v,f_start+i_f,n_out_feat)] = t_mean[i_f] / (float)n_neigh;
+                        d_out_feat[I2D(i_v,f_start+i_f+n_feat,n_out_feat)] = t_max[i_f];
+                    }
 
+                    //moments in n_coords x n_neigh loop here {}
+                }
             }
+        };
 
-        }
+        const double cost_per_vertex = 3. * n_neigh * n_feat;
+        d.parallelFor(n_vert,
+                Eigen::TensorOpCost(n_neigh * (n_feat + 2) * sizeof(float), n_out_feat * sizeof(float) + n_feat * sizeof(int),
+                        cost_per_vertex),
+                work);
     }
 };
 
@@ -0,0 +1,299 @@
+/*
+ * binning_helpers.h
+ *
+ * CPU-only helpers to put (a subset of) vertices into a uniform grid
+ * and to walk the grid in shells of increasing cell distance.
+ * The grid is built per row split, only the first (up to) 3
+ * coordinates are used for binning. Distances are always calculated
+ * in the full coordinate space, the binned coordinates only provide
+ * a lower bound for points in cells that have not been visited yet.
+ */
+
+#ifndef HGCALML_MODULES_COMPILED_BINNING_HELPERS_H_
+#define HGCALML_MODULES_COMPILED_BINNING_HELPERS_H_
+
+#include "helpers.h"
+#include <vector>
+#include <cmath>
+#include <limits>
+#include <algorithm>
+#include <utility>
+
+namespace binning {
+
+static const int max_bin_dims = 3;
+
+class vertex_grid {
+public:
+    vertex_grid():n_bin_dims_(0),n_bins_tot_(0){}
+
+    /*
+     * vertices: indices of the vertices to be binned, they are stored
+     * in this order within each bin.
+     * target_per_bin: average number of vertices per bin (e.g. K)
+     */
+    void build(const float *d_coord,
+            const int n_coords,
+            const std::vector<int>& vertices,
+            const int target_per_bin){
+
+        n_bin_dims_ = std::min(n_coords, max_bin_dims);
+        const int n_cand = vertices.size();
+
+        for(int d=0;d<n_bin_dims_;d++){
+            min_[d] = std::numeric_limits<float>::max();
+            max_[d] = std::numeric_limits<float>::lowest();
+        }
+        for(int i=0;i<n_cand;i++){
+            for(int d=0;d<n_bin_dims_;d++){
+                float x = d_coord[I2D(vertices[i],d,n_coords)];
+                if(x<min_[d]) min_[d]=x;
+                if(x>max_[d]) max_[d]=x;
+            }
+        }
+
+        int per_dim = 1;
+        if(n_bin_dims_ > 0 && target_per_bin > 0 && n_cand > target_per_bin){
+            per_dim = std::pow((float)n_cand / (float)target_per_bin, 1.f/(float)n_bin_dims_);
+            if(per_dim < 1)
+                per_dim = 1;
+            if(per_dim > 1024)
+                per_dim = 1024;
+        }
+
+        n_bins_tot_=1;
+        for(int d=0;d<n_bin_dims_;d++){
+            float range = max_[d]-min_[d];
+            if(n_cand < 1 || !(range > 0)){
+                n_bins_[d]=1;
+                width_[d]=1.;
+                if(n_cand < 1)
+                    min_[d]=0;
+            }
+            else{
+                n_bins_[d]=per_dim;
+                width_[d]=range/(float)per_dim;
+            }
+            n_bins_tot_ *= n_bins_[d];
+        }
+
+        //counting sort of the vertices into the bins, keeps the order within bins
+        std::vector<int> bin_of(n_cand);
+        bin_offsets_.assign(n_bins_tot_+1, 0);
+        for(int i=0;i<n_cand;i++){
+            int b[max_bin_dims];
+            bin_coords(d_coord + n_coords*vertices[i], b);
+            bin_of[i] = flat_bin(b);
+            bin_offsets_[bin_of[i]+1]++;
+        }
+        for(int ib=0;ib<n_bins_tot_;ib++)
+            bin_offsets_[ib+1] += bin_offsets_[ib];
+
+        bin_content_.resize(n_cand);
+        std::vector<int> filled(bin_offsets_.begin(), bin_offsets_.end()-1);
+        for(int i=0;i<n_cand;i++)
+            bin_content_[filled[bin_of[i]]++] = vertices[i];
+    }
+
+    int n_bin_dims()const{return n_bin_dims_;}
+    int n_bins(int d)const{return n_bins_[d];}
+
+    //x is a pointer to the coordinates of a single vertex
+    void bin_coords(const float * x, int * b)const{
+        for(int d=0;d<n_bin_dims_;d++){
+            int ib = (x[d]-min_[d])/width_[d];
+            if(ib<0) ib=0;
+            if(ib>=n_bins_[d]) ib=n_bins_[d]-1;
+            b[d]=ib;
+        }
+    }
+
+    int flat_bin(const int * b)const{
+        int idx=0;
+        for(int d=0;d<n_bin_dims_;d++)
+            idx = idx*n_bins_[d] + b[d];
+        return idx;
+    }
+
+    const int* bin_begin(int flatbin)const{return bin_content_.data() + bin_offsets_[flatbin];}
+    const int* bin_end(int flatbin)const{return bin_content_.data() + bin_offsets_[flatbin+1];}
+
+    /*
+     * Calls f(vertex_index) for all vertices in cells with a Chebyshev cell
+     * distance of exactly 'shell' to the cell 'center'.
+     * Returns false if the shell does not contain any cell within the grid.
+     */
+    template<class F>
+    bool visit_shell(const int * center, const int shell, F& f)const{
+        int lo[max_bin_dims], hi[max_bin_dims];
+        bool any=false;
+        for(int d=0;d<n_bin_dims_;d++){
+            lo[d] = std::max(0, center[d]-shell);
+            hi[d] = std::min(n_bins_[d]-1, center[d]+shell);
+            if(center[d]-shell >= 0 || center[d]+shell < n_bins_[d])
+                any=true;
+        }
+        if(n_bin_dims_ < 1){ //no binning at all, everything is in one cell
+            if(shell)
+                return false;
+            for(const int* v=bin_begin(0);v!=bin_end(0);++v)
+                f(*v);
+            return true;
+        }
+        if(!any)
+            return false;
+
+        int b[max_bin_dims];
+        for(int d=0;d<n_bin_dims_;d++)
+            b[d]=lo[d];
+        while(true){
+            bool on_shell = false;
+            for(int d=0;d<n_bin_dims_;d++){
+                if(std::abs(b[d]-center[d]) == shell){
+                    on_shell=true;
+                    break;
+                }
+            }
+            if(on_shell){
+                int fb = flat_bin(b);
+                for(const int* v=bin_begin(fb);v!=bin_end(fb);++v)
+                    f(*v);
+            }
+            //increment
+            int d=n_bin_dims_-1;
+            for(;d>=0;d--){
+                if(b[d]<hi[d]){
+                    b[d]++;
+                    break;
+                }
+                b[d]=lo[d];
+            }
+            if(d<0)
+                break;
+        }
+        return true;
+    }
+
+    /*
+     * Lower bound on the distance (not squared) of the point x to any vertex
+     * in a cell with Chebyshev distance larger than 'shell' to 'center'.
+     * Returns a negative value if there are no such cells.
+     * The bound is made slightly conservative (see tolerance) to be safe
+     * against rounding in the bin assignment.
+     */
+    float outside_shell_distance(const float * x, const int * center, const int shell)const{
+        float mindist = std::numeric_limits<float>::max();
+        bool found=false;
+        for(int d=0;d<n_bin_dims_;d++){
+            if(center[d]-shell > 0){
+                float edge = min_[d] + (float)(center[d]-shell)*width_[d];
+                float dist = x[d]-edge - tolerance(x[d],edge,d);
+                if(dist<mindist) mindist=dist;
+                found=true;
+            }
+            if(center[d]+shell+1 < n_bins_[d]){
+                float edge = min_[d] + (float)(center[d]+shell+1)*width_[d];
+                float dist = edge-x[d] - tolerance(x[d],edge,d);
+                if(dist<mindist) mindist=dist;
+                found=true;
+            }
+        }
+        if(!found)
+            return -1;
+        if(mindist<0)
+            mindist=0;
+        return mindist;
+    }
+
+private:
+    float tolerance(float x, float edge, int d)const{
+        return 1e-5f * (std::abs(x) + std::abs(edge) + width_[d]);
+    }
+
+    int n_bin_dims_;
+    int n_bins_tot_;
+    int n_bins_[max_bin_dims];
+    float min_[max_bin_dims];
+    float max_[max_bin_dims];
+    float width_[max_bin_dims];
+    std::vector<int> bin_offsets_;
+    std::vector<int> bin_content_;
+};
+
+typedef std::pair<float,int> dist_idx;
+
+static inline float squared_distance(const float * d_coord, const int n_coords, const int i_v, const int j_v){
+    float distsq=0;
+    for(int i=0;i<n_coords;i++){
+        float dist = d_coord[I2D(i_v,i,n_coords)] - d_coord[I2D(j_v,i,n_coords)];
+        distsq += dist*dist;
+    }
+    return distsq;
+}
+
+/*
+ * Selects the (up to) n_select vertices in the grid that are closest to the
+ * vertex i_v, excluding i_v itself, by walking shells of cells around it until
+ * no unvisited cell can contain a closer vertex.
+ * max_radius is squared, no limit if <= 0.
+ * The selection is returned in 'selected', sorted by distance, ties are resolved
+ * towards lower indices.
+ * Approximate mode: if max_shells >= 0, the search stops after shell max_shells
+ * once n_select vertices were found, even if cells further out could contain
+ * closer vertices.
+ */
+static inline void knn_search(
+        const vertex_grid& grid,
+        const float * d_coord,
+        const int n_coords,
+        const int i_v,
+        const int n_select,
+        const float max_radius,
+        std::vector<dist_idx>& selected,
+        const int max_shells = -1){
+
+    selected.clear();
+    if(n_select < 1)
+        return;
+
+    int center[max_bin_dims];
+    const float * x = d_coord + (size_t)n_coords*i_v;
+    grid.bin_coords(x, center);
+
+    auto fill = [&](int j_v){
+        if(j_v == i_v)
+            return;
+        float distsq = squared_distance(d_coord, n_coords, i_v, j_v);
+        if(max_radius>0 && distsq > max_radius)
+            return;
+        dist_idx c(distsq, j_v);
+        if((int)selected.size() < n_select){
+            selected.push_back(c);
+            std::push_heap(selected.begin(), selected.end());
+        }
+        else if(c < selected.front()){
+            std::pop_heap(selected.begin(), selected.end());
+            selected.back() = c;
+            std::push_heap(selected.begin(), selected.end());
+        }
+    };
+
+    for(int shell=0; grid.visit_shell(center, shell, fill); shell++){
+        float bound = grid.outside_shell_distance(x, center, shell);
+        if(bound < 0)
+            break; //all cells visited
+        float boundsq = bound*bound;
+        if(max_radius>0 && boundsq > max_radius)
+            break;
+        if((int)selected.size() == n_select && selected.front().first < boundsq)
+            break;
+        if(max_shells >= 0 && shell >= max_shells && (int)selected.size() == n_select)
+            break;
+    }
+
+    std::sort_heap(selected.begin(), selected.end());
+}
+
+}//binning
+
+#endif /* HGCALML_MODULES_COMPILED_BINNING_HELPERS_H_ */
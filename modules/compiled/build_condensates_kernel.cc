@@ -9,6 +9,10 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <unordered_map>
+#include <algorithm>
+#include <utility>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -38,39 +42,6 @@ static void set_defaults(
     }
 }
 
-static void get_max_beta(
-        const float* temp_betas,
-        int *asso_idx,
-        int * is_cpoint,
-        int * maxidx,
-
-        const int n_vert,
-        const int start_vertex,
-        const int end_vertex,
-        const float min_beta){
-
-    //this needs to be some smart algo here
-    //it will be called N_condensate times at least
-    int ref=-1;
-    float max = min_beta;
-    for(int i_v=start_vertex;i_v<end_vertex;i_v++){
-        float biv = temp_betas[i_v];
-        if(biv > max && asso_idx[i_v] < 0){
-            max=biv;
-            ref=i_v;
-        }
-
-    }
-
-    //if none can be found set ref to -1
-    *maxidx = ref;
-    if(ref>=0){
-        is_cpoint[ref]=1;
-        asso_idx[ref]=ref;
-    }
-}
-
-
 static float distancesq(const int v_a,
         const int v_b,
         const float *d_ccoords,
@@ -84,52 +55,206 @@ static float distancesq(const int v_a,
     return distsq;
 }
 
+/*
+ * Spatial hash of the clustering coordinates with a cell size of the
+ * (not squared) radius. Only the first (up to) 3 coordinates are hashed,
+ * all vertices within the radius are in the same or a neighbouring cell.
+ * Assigned vertices are removed lazily while the cells are visited.
+ */
+class condensate_hash {
+public:
+    static const int max_dims = 3;
+
+    condensate_hash(const float *d_ccoords,
+            const int n_ccoords,
+            const int start_vertex,
+            const int end_vertex,
+            const float radius):n_ccoords_(n_ccoords){
+
+        n_dims_ = n_ccoords < max_dims ? n_ccoords : max_dims; //no std::min: would odr-use max_dims in C++11
+        cell_size_ = 1.;
+        if(radius > 0)
+            cell_size_ = std::sqrt(radius) * 1.001; //protect against rounding at the edges
+
+        for(int i_v=start_vertex;i_v<end_vertex;i_v++){
+            cell_key k = key(d_ccoords + (size_t)n_ccoords*i_v);
+            cells_[k].push_back(i_v);
+        }
+    }
+
+    /*
+     * calls f(i_v) for all unassigned vertices in the cell of ref_vertex
+     * and its neighbours
+     */
+    template<class F>
+    void visit_unassigned(const float *d_ccoords, const int ref_vertex, const int * asso_idx, F& f){
+        cell_key center = key(d_ccoords + (size_t)n_ccoords_*ref_vertex);
+        int offset[max_dims]={-1,-1,-1};
+        while(true){
+            cell_key k = center;
+            for(int d=0;d<n_dims_;d++)
+                k.c[d] += offset[d];
+
+            auto it = cells_.find(k);
+            if(it != cells_.end()){
+                std::vector<int>& content = it->second;
+                for(size_t i=0;i<content.size();){
+                    if(asso_idx[content[i]] >= 0){
+                        content[i] = content.back();
+                        content.pop_back();
+                        continue;
+                    }
+                    f(content[i]);
+                    i++;
+                }
+            }
+
+            int d=n_dims_-1;
+            for(;d>=0;d--){
+                if(offset[d]<1){
+                    offset[d]++;
+                    break;
+                }
+                offset[d]=-1;
+            }
+            if(d<0)
+                break;
+        }
+    }
+
+private:
+    struct cell_key{
+        long long c[max_dims];
+        bool operator==(const cell_key& rhs)const{
+            return c[0]==rhs.c[0] && c[1]==rhs.c[1] && c[2]==rhs.c[2];
+        }
+    };
+    struct cell_key_hash{
+        size_t operator()(const cell_key& k)const{
+            size_t h = std::hash<long long>()(k.c[0]);
+            h ^= std::hash<long long>()(k.c[1]) + 0x9e3779b9 + (h<<6) + (h>>2);
+            h ^= std::hash<long long>()(k.c[2]) + 0x9e3779b9 + (h<<6) + (h>>2);
+            return h;
+        }
+    };
+
+    cell_key key(const float * x)const{
+        cell_key k;
+        for(int d=0;d<max_dims;d++)
+            k.c[d]=0;
+        for(int d=0;d<n_dims_;d++)
+            k.c[d] = std::floor(x[d]/cell_size_);
+        return k;
+    }
+
+    int n_ccoords_;
+    int n_dims_;
+    float cell_size_;
+    std::unordered_map<cell_key, std::vector<int>, cell_key_hash> cells_;
+};
+
+/*
+ * Lazy max-priority queue of the (modified) betas.
+ * Betas only decrease, so stale entries are refreshed when they reach the top.
+ * Ties are resolved towards the lower vertex index.
+ */
+class beta_queue {
+public:
+    beta_queue(const float * temp_betas,
+            const int start_vertex,
+            const int end_vertex){
+        heap_.reserve(end_vertex-start_vertex);
+        for(int i_v=start_vertex;i_v<end_vertex;i_v++)
+            heap_.push_back(entry(temp_betas[i_v], i_v));
+        std::make_heap(heap_.begin(), heap_.end(), compare());
+    }
+
+    //returns -1 if no unassigned vertex above min_beta is left
+    int pop_max(const float * temp_betas, const int *asso_idx, const float min_beta){
+        while(heap_.size()){
+            entry top = heap_.front();
+            std::pop_heap(heap_.begin(), heap_.end(), compare());
+            heap_.pop_back();
+
+            if(asso_idx[top.second] >= 0)
+                continue;
+            if(top.first != temp_betas[top.second]){//stale
+                heap_.push_back(entry(temp_betas[top.second], top.second));
+                std::push_heap(heap_.begin(), heap_.end(), compare());
+                continue;
+            }
+            if(top.first > min_beta)
+                return top.second;
+            return -1;
+        }
+        return -1;
+    }
+
+private:
+    typedef std::pair<float,int> entry;
+    struct compare{
+        bool operator()(const entry& a, const entry& b)const{
+            if(a.first == b.first)
+                return a.second > b.second;
+            return a.first < b.first;
+        }
+    };
+    std::vector<entry> heap_;
+};
+
+static int get_max_beta(
+        beta_queue& queue,
+        const float* temp_betas,
+        int *asso_idx,
+        int * is_cpoint,
+        const float min_beta){
+
+    int ref = queue.pop_max(temp_betas, asso_idx, min_beta);
+    if(ref>=0){
+        is_cpoint[ref]=1;
+        asso_idx[ref]=ref;
+    }
+    return ref;
+}
+
 static void check_and_collect(
 
+        condensate_hash& hash,
         const int ref_vertex,
         const float ref_beta,
         const float *d_ccoords,
-        const float *d_betas,
 
         int *asso_idx,
         float * temp_betas,
 
-        const int n_vert,
         const int n_ccoords,
 
-        const int start_vertex,
-        const int end_vertex,
         const float radius,
         const float min_beta,
         const bool soft){
 
-    for(size_t i_v=start_vertex;i_v<end_vertex;i_v++){
-
-        if(asso_idx[i_v] < 0){
-            float distsq = distancesq(ref_vertex,i_v,d_ccoords,n_ccoords);
-
-            if(soft){
-                //should the reduction in beta be using the original betas or the modified ones...?
-                //go with original betas
-                float moddist = 1 - (distsq / radius );
-                if(moddist < 0)
-                    moddist = 0;
-                float subtract =  moddist * ref_beta;
-                temp_betas[i_v] -= subtract;
-                if(temp_betas[i_v] <= min_beta && moddist)
-                    asso_idx[i_v] = ref_vertex;
-            }
-            else{
-                if(distsq <= radius){ //sum features in parallel?
-                    asso_idx[i_v] = ref_vertex;
-                }
+    auto collect = [&](int i_v){
+        float distsq = distancesq(ref_vertex,i_v,d_ccoords,n_ccoords);
+
+        if(soft){
+            //should the reduction in beta be using the original betas or the modified ones...?
+            //go with original betas
+            float moddist = 1 - (distsq / radius );
+            if(moddist < 0)
+                moddist = 0;
+            float subtract =  moddist * ref_beta;
+            temp_betas[i_v] -= subtract;
+            if(temp_betas[i_v] <= min_beta && moddist)
+                asso_idx[i_v] = ref_vertex;
+        }
+        else{
+            if(distsq <= radius){
+                asso_idx[i_v] = ref_vertex;
             }
         }
-
-
-    }
-
-
+    };
+    //everything outside the neighbouring cells is outside the radius
+    hash.visit_unassigned(d_ccoords, ref_vertex, asso_idx, collect);
 }
 
 
@@ -168,38 +293,28 @@ struct BuildCondensatesOpFunctor<CPUDevice, dummy> {
 
             set_defaults(asso_idx,is_cpoint,d_betas,temp_betas,start_vertex,end_vertex,n_vert);
 
-            int ref;
-            get_max_beta(temp_betas,asso_idx,is_cpoint,&ref,n_vert,start_vertex,end_vertex,min_beta);
-            //copy ref back
-            float ref_beta = d_betas[ref];
+            condensate_hash hash(d_ccoords, n_ccoords, start_vertex, end_vertex, radius);
+            beta_queue queue(temp_betas, start_vertex, end_vertex);
+
             int ncond=0;
-            //copy ref and refBeta from GPU to CPU
+            int ref = get_max_beta(queue,temp_betas,asso_idx,is_cpoint,min_beta);
 
             while(ref>=0){
-
-               // if(asso_idx[ref] >=0) continue; //
-               // if(temp_betas[ref] < min_beta)continue;
-                 //probably better to copy here instead of accessing n_vert times in GPU mem
                 ncond++;
 
                 check_and_collect(
+                        hash,
                         ref,
-                        ref_beta,
+                        d_betas[ref],
                         d_ccoords,
-                        d_betas,
                         asso_idx,
                         temp_betas,
-                        n_vert,
                         n_ccoords,
-                        start_vertex,
-                        end_vertex,
                         radius,
                         min_beta,
                         soft);
 
-                get_max_beta(temp_betas,asso_idx,is_cpoint,&ref,n_vert,start_vertex,end_vertex,min_beta);
-                //copy ref and refBeta from GPU to CPU
-                ref_beta = d_betas[ref];
+                ref = get_max_beta(queue,temp_betas,asso_idx,is_cpoint,min_beta);
             }
 
             n_condensates[j_rs] = ncond;
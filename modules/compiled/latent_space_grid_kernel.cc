@@ -1,4 +1,4 @@
-
+#define EIGEN_USE_THREADS
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
@@ -9,6 +9,8 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <algorithm>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -63,57 +65,33 @@ static void get_n_cells(
     n_cells_tot_per_rs[irs] = nthisrs;
 }
 
-static void assign_v_to_cells(
+static int cell_index(
         const float *d_coords,
-        const int *row_splits,
 
         const float *min_coords, //one per rs and dim
         const int * n_cells_per_rs_coord,
-        const int * n_cells_per_rs,
         const float * adj_cell_sizes,
 
-        int * asso_vert_to_global_cell, //1D C-format
-        int * n_vert_per_global_cell,
-
+        const int cellidx_offset,
         const int n_coords,
-        const int irs){ //1D C-format
-
-   // printf("assign_v_to_cells\n");
-
-    size_t startvert = row_splits[irs];
-    size_t endvert = row_splits[irs+1];
-
-    //potential opt FIXME
-    int cellidx_offset=0;
-    for(size_t i=0;i<irs;i++){
-        cellidx_offset +=  n_cells_per_rs[i];
-    }
-
-   // printf("offset %d\n",cellidx_offset);
-
-    for (int iv = startvert; iv < endvert; iv++) {
+        const int irs,
+        const int iv){
 
-        int cellidx = cellidx_offset;//make this a rs offset
-        int multiplier=1;
+    int cellidx = cellidx_offset;//make this a rs offset
+    int multiplier=1;
 
-        for (int ic = n_coords - 1; ic > -1; ic--){//reverse for indexing
+    for (int ic = n_coords - 1; ic > -1; ic--){//reverse for indexing
 
 
-            const float& csize = adj_cell_sizes[I2D(irs,ic,n_coords)];
-            float normcoord = d_coords[I2D(iv,ic,n_coords)] - min_coords[I2D(irs,ic,n_coords)];  //maybe add this offset in a different kernel TBI
-            int thisidx = normcoord / csize;
+        const float& csize = adj_cell_sizes[I2D(irs,ic,n_coords)];
+        float normcoord = d_coords[I2D(iv,ic,n_coords)] - min_coords[I2D(irs,ic,n_coords)];  //maybe add this offset in a different kernel TBI
+        int thisidx = normcoord / csize;
 
-            cellidx += multiplier*thisidx;
-            multiplier *= n_cells_per_rs_coord[I2D(irs,ic,n_coords)];
-
-        }
-        asso_vert_to_global_cell[iv] = cellidx;
-        //make atomic for parallel!
-        n_vert_per_global_cell[cellidx] += 1;
+        cellidx += multiplier*thisidx;
+        multiplier *= n_cells_per_rs_coord[I2D(irs,ic,n_coords)];
 
     }
-
-
+    return cellidx;
 }
 
 
@@ -136,36 +114,6 @@ static void make_pseudo_rs(
 }
 
 
-static void make_resort_idxs(
-        const int * pseudo_rs,
-        const int * asso_vert_to_global_cell,
-
-        int * n_vert_per_global_cell_filled,
-        int * resort_idxs,
-
-        const int n_cell,
-        const int n_vert
-        ){
-
-   // printf("make_resort_idxs\n");
-
-    for(size_t ice=0;ice<n_cell;ice++){//parallel over ice!
-
-        size_t offset = pseudo_rs[ice];
-
-
-        for(size_t iv=0;iv<n_vert;iv++){
-
-            if( asso_vert_to_global_cell[iv] == ice){ //parallel over ice avoids bad atomic here
-                size_t idx = n_vert_per_global_cell_filled[ice];
-                resort_idxs[offset + idx] = iv;
-                n_vert_per_global_cell_filled[ice] += 1;
-            }
-        }
-    }
-}
-
-
 template<typename dummy>
 struct LatentSpaceGetGridSizeOpFunctor<CPUDevice, dummy>  {
     void operator()(
@@ -245,33 +193,100 @@ struct LatentSpaceGridOpFunctor<CPUDevice, dummy> {
 
             const float size) {
 
-        for(size_t i=0;i<n_pseudo_rs-1;i++)
+        const int n_cells = n_pseudo_rs-1;
+        for(int i=0;i<n_cells;i++){
             n_vert_per_global_cell[i]=0;
+            n_vert_per_global_cell_filled[i]=0;
+        }
+        if(n_rs<2 || n_vert<1){
+            make_pseudo_rs(n_vert_per_global_cell, pseudo_rs, n_cells);
+            return;
+        }
 
-        for(size_t irs=0;irs<n_rs-1;irs++){
-
-            assign_v_to_cells(d_coords,row_splits,min_coords,n_cells_per_rs_coord,n_cells_tot_per_rs,
-                    adj_cell_sizes,
-                    asso_vert_to_global_cell,n_vert_per_global_cell,
-                    n_coords,irs);
-
-            /*
-             * int * asso_v_to_cell_idx, //1D C-format
-               int * n_vert_per_global_cell,
-             */
+        //first global cell index of each row split
+        std::vector<int> cellidx_offset(n_rs,0);
+        for(int irs=0;irs<n_rs-1;irs++)
+            cellidx_offset[irs+1] = cellidx_offset[irs] + n_cells_tot_per_rs[irs];
 
+        /*
+         * Counting sort in two passes over contiguous blocks of vertices.
+         * Each block assigns its vertices to cells and counts them in its own histogram
+         * (only over the range of cells it uses). The histograms are summed to get the
+         * pseudo row splits, and turned into the first output position of each block in
+         * each cell. The scatter then keeps the vertex order within each cell.
+         */
+        const int min_block_size = 1024;
+        int n_blocks = d.numThreads();
+        if(n_blocks > n_vert / min_block_size)
+            n_blocks = n_vert / min_block_size;
+        if(n_blocks < 1)
+            n_blocks = 1;
+
+        std::vector<int> block_min_cell(n_blocks);
+        std::vector<std::vector<int> > block_hist(n_blocks);
+
+        auto count = [&](Eigen::Index first, Eigen::Index last) {
+            for(Eigen::Index ib=first; ib<last; ib++){
+                const int vbegin = std::max(row_splits[0], (int)((long)n_vert * ib / n_blocks));
+                const int vend = std::min(row_splits[n_rs-1], (int)((long)n_vert * (ib+1) / n_blocks));
+                int irs = std::upper_bound(row_splits, row_splits + n_rs, vbegin) - row_splits - 1;
+                int cmin = n_cells, cmax = -1;
+                for(int iv=vbegin;iv<vend;iv++){
+                    while(iv >= row_splits[irs+1])
+                        irs++;
+                    int cellidx = cell_index(d_coords,min_coords,n_cells_per_rs_coord,adj_cell_sizes,
+                            cellidx_offset[irs],n_coords,irs,iv);
+                    asso_vert_to_global_cell[iv] = cellidx;
+                    cmin = std::min(cmin, cellidx);
+                    cmax = std::max(cmax, cellidx);
+                }
+                block_min_cell[ib] = cmin;
+                std::vector<int> & hist = block_hist[ib];
+                hist.assign(cmax >= cmin ? cmax - cmin + 1 : 0, 0);
+                for(int iv=vbegin;iv<vend;iv++)
+                    hist[asso_vert_to_global_cell[iv] - cmin] += 1;
+            }
+        };
+        d.parallelFor(n_blocks,
+                Eigen::TensorOpCost((double)n_vert / n_blocks * n_coords * sizeof(float),
+                        (double)n_vert / n_blocks * sizeof(int),
+                        (double)n_vert / n_blocks * n_coords * 10.),
+                count);
+
+        for(int ib=0;ib<n_blocks;ib++){
+            const std::vector<int> & hist = block_hist[ib];
+            for(size_t i=0;i<hist.size();i++)
+                n_vert_per_global_cell[block_min_cell[ib] + i] += hist[i];
         }
-        make_pseudo_rs(n_vert_per_global_cell, pseudo_rs,n_pseudo_rs-1);
-        //this can just run in some thread as long as pseudo_rs are not used
 
+        make_pseudo_rs(n_vert_per_global_cell, pseudo_rs, n_cells);
 
-        for(int i=0;i<n_pseudo_rs-1;i++)
-            n_vert_per_global_cell_filled[i]=0;
+        //first output position of each block in each cell, in block order
+        for(int ib=0;ib<n_blocks;ib++){
+            std::vector<int> & hist = block_hist[ib];
+            for(size_t i=0;i<hist.size();i++){
+                const int ice = block_min_cell[ib] + i;
+                const int n = hist[i];
+                hist[i] = pseudo_rs[ice] + n_vert_per_global_cell_filled[ice];
+                n_vert_per_global_cell_filled[ice] += n;
+            }
+        }
 
-        make_resort_idxs(pseudo_rs,asso_vert_to_global_cell,n_vert_per_global_cell_filled,resort_idxs,
-                n_pseudo_rs-1.,n_vert);
-      //  int * n_vert_per_global_cell_filled,
-      //  int * resort_idxs,
+        auto scatter = [&](Eigen::Index first, Eigen::Index last) {
+            for(Eigen::Index ib=first; ib<last; ib++){
+                const int vbegin = std::max(row_splits[0], (int)((long)n_vert * ib / n_blocks));
+                const int vend = std::min(row_splits[n_rs-1], (int)((long)n_vert * (ib+1) / n_blocks));
+                std::vector<int> & next = block_hist[ib];
+                const int cmin = block_min_cell[ib];
+                for(int iv=vbegin;iv<vend;iv++)
+                    resort_idxs[next[asso_vert_to_global_cell[iv] - cmin]++] = iv;
+            }
+        };
+        d.parallelFor(n_blocks,
+                Eigen::TensorOpCost((double)n_vert / n_blocks * sizeof(int),
+                        (double)n_vert / n_blocks * sizeof(int),
+                        (double)n_vert / n_blocks * 4.),
+                scatter);
 
         //now we have the minimal ingredients:
         // resort_idxs and pseudo_rs
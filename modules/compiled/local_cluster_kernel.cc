@@ -1,4 +1,4 @@
-
+#define EIGEN_USE_THREADS
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
@@ -9,6 +9,9 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <algorithm>
+#include <cstring>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -19,6 +22,49 @@ typedef Eigen::GpuDevice GPUDevice;
 namespace functor {
 
 
+// clusters the vertices of one row split, following the order given in d_hierarchy_idxs.
+// The selected vertex indices are written to d_sel, the associations in d_out_backgather
+// are relative to the first selected vertex of this row split.
+// Returns the number of selected vertices.
+static int local_cluster_row_split(
+        const int *d_neigh_idxs,
+        const int *d_hierarchy_idxs,
+        const int n_vert_rs,
+        const int * d_global_idxs,
+        int * mask,
+        int * d_sel,
+        int *d_out_backgather,
+        const int n_neigh){
+
+    int nsel=0;
+    for(int _i_v=0;_i_v<n_vert_rs; _i_v++){
+        int i_v = d_hierarchy_idxs[_i_v];
+        if(mask[i_v])
+            continue;
+
+        d_sel[nsel] = i_v;
+        int v_gl_idx = d_global_idxs[i_v];
+        d_out_backgather[v_gl_idx] = nsel; //global self-associate
+
+
+        for(int i_n=0;i_n<n_neigh;i_n++){
+
+            int nidx = d_neigh_idxs[I2D(i_v,i_n,n_neigh)];
+            if(nidx<0)//not a neighbour
+                continue;
+            if(mask[nidx])
+                continue;//already used
+
+            //mask
+            mask[nidx]=1;
+            int ngl_idx = d_global_idxs[nidx];
+            d_out_backgather[ngl_idx] = nsel; //global associate
+        }
+        nsel++;
+    }
+    return nsel;
+}
+
 // CPU specialization
 template<typename dummy>
 struct LocalClusterOpFunctor<CPUDevice, dummy> {
@@ -26,8 +72,7 @@ struct LocalClusterOpFunctor<CPUDevice, dummy> {
             const CPUDevice &d,
 
             const int *d_neigh_idxs,
-            const int *d_hierarchy_idxs, //maybe do this internally if op can be called by op
-            //the above will require an argsort on ragged (only with eager workaround so far)
+            const int *d_hierarchy_idxs, //sorted within each row split
 
             const int * d_global_idxs, //global index of each vertex: V x 1, not global dimension!
             const int * d_row_splits,  //keeps dimensions: N_rs x 1
@@ -47,51 +92,102 @@ struct LocalClusterOpFunctor<CPUDevice, dummy> {
     ){
 
         *n_sel_vtx=0;
-        int nseltotal=0;
         for(int i_v=0;i_v<n_in_vert; i_v++)
             mask[i_v]=0;
 
+        if(n_row_splits<2){
+            if(n_row_splits)
+                d_out_row_splits[0]=0;
+            return;
+        }
 
-        d_out_row_splits[0]=0;
-        for(int i_rs=0; i_rs<n_row_splits-1;i_rs++){
-            //row splits only relevant for parallelisation
-
-            for(int _i_v=d_row_splits[i_rs];_i_v<d_row_splits[i_rs+1]; _i_v++){
-                int i_v = d_hierarchy_idxs[_i_v];
-                if(mask[i_v])
-                    continue;
-
-                d_out_selection_idxs[nseltotal] = i_v;
-                int v_gl_idx = d_global_idxs[i_v];
-                d_out_backgather[v_gl_idx] = nseltotal; //global self-associate
-
+        //the row splits are independent (the neighbours are within the same row split).
+        //Each row split writes its selection to its own range of d_out_selection_idxs,
+        //the number of selected vertices goes to d_out_row_splits[i_rs+1]
+        auto cluster = [&](Eigen::Index first, Eigen::Index last) {
+            for(Eigen::Index i_rs=first; i_rs<last; i_rs++){
+                d_out_row_splits[i_rs+1] = local_cluster_row_split(
+                        d_neigh_idxs,
+                        d_hierarchy_idxs + d_row_splits[i_rs],
+                        d_row_splits[i_rs+1] - d_row_splits[i_rs],
+                        d_global_idxs,
+                        mask,
+                        d_out_selection_idxs + d_row_splits[i_rs],
+                        d_out_backgather,
+                        n_neigh);
+            }
+        };
 
-                for(int i_n=0;i_n<n_neigh;i_n++){
+        const int n_rs = n_row_splits-1;
+        const double vert_per_rs = (double)n_in_vert / (double)n_rs;
+        d.parallelFor(n_rs,
+                Eigen::TensorOpCost(vert_per_rs * (n_neigh + 2) * sizeof(int), vert_per_rs * 3 * sizeof(int),
+                        vert_per_rs * n_neigh * 2.),
+                cluster);
 
-                    int nidx = d_neigh_idxs[I2D(i_v,i_n,n_neigh)];
-                    if(nidx<0)//not a neighbour
-                        continue;
-                    if(mask[nidx])
-                        continue;//already used
+        d_out_row_splits[0]=0;
+        for(int i_rs=0; i_rs<n_rs;i_rs++)
+            d_out_row_splits[i_rs+1] += d_out_row_splits[i_rs];
+
+        //make the selection contiguous, only moves to lower indices
+        for(int i_rs=0; i_rs<n_rs;i_rs++){
+            int nsel = d_out_row_splits[i_rs+1] - d_out_row_splits[i_rs];
+            if(nsel>0 && d_out_row_splits[i_rs] != d_row_splits[i_rs])
+                std::memmove(d_out_selection_idxs + d_out_row_splits[i_rs],
+                        d_out_selection_idxs + d_row_splits[i_rs], nsel * sizeof(int));
+        }
 
-                    //mask
-                    mask[nidx]=1;
-                    int ngl_idx = d_global_idxs[nidx];
-                    d_out_backgather[ngl_idx] = nseltotal; //global associate
-                }
-                nseltotal++;
+        //shift the associations by the first selected vertex of each row split
+        auto shift = [&](Eigen::Index first, Eigen::Index last) {
+            for(Eigen::Index i_rs=first; i_rs<last; i_rs++){
+                const int offset = d_out_row_splits[i_rs];
+                if(!offset)
+                    continue;
+                for(int i_v=d_row_splits[i_rs];i_v<d_row_splits[i_rs+1]; i_v++)
+                    d_out_backgather[d_global_idxs[i_v]] += offset;
             }
+        };
+        d.parallelFor(n_rs,
+                Eigen::TensorOpCost(vert_per_rs * 2 * sizeof(int), vert_per_rs * sizeof(int), vert_per_rs),
+                shift);
 
-            d_out_row_splits[i_rs+1] = nseltotal;
-        }
-
-        *n_sel_vtx=nseltotal;
+        *n_sel_vtx=d_out_row_splits[n_rs];
 
     }
 
 
 };
 
+// sorts the vertices of each row split by decreasing hierarchy value,
+// ties keep the original order (as tf.argsort with direction='DESCENDING')
+static void sort_hierarchy(
+        const CPUDevice &d,
+        const float *d_hierarchy,
+        const int * d_row_splits,
+        int * d_hierarchy_idxs,
+        const int n_in_vert,
+        const int n_row_splits){
+
+    if(n_row_splits<2)
+        return;
+    auto sort = [&](Eigen::Index first, Eigen::Index last) {
+        for(Eigen::Index i_rs=first; i_rs<last; i_rs++){
+            int * begin = d_hierarchy_idxs + d_row_splits[i_rs];
+            int * end = d_hierarchy_idxs + d_row_splits[i_rs+1];
+            for(int i_v=d_row_splits[i_rs];i_v<d_row_splits[i_rs+1]; i_v++)
+                d_hierarchy_idxs[i_v] = i_v;
+            std::stable_sort(begin, end, [d_hierarchy](const int a, const int b){
+                return d_hierarchy[a] > d_hierarchy[b];
+            });
+        }
+    };
+    const double vert_per_rs = (double)n_in_vert / (double)(n_row_splits-1);
+    d.parallelFor(n_row_splits-1,
+            Eigen::TensorOpCost(vert_per_rs * sizeof(float), vert_per_rs * sizeof(int),
+                    vert_per_rs * (std::log2(vert_per_rs + 1.) + 1.) * 4.),
+            sort);
+}
+
 template<typename dummy>
 struct LocalClusterTruncateOpFunctor<CPUDevice,dummy> {
     void operator()(
@@ -108,7 +204,9 @@ struct LocalClusterTruncateOpFunctor<CPUDevice,dummy> {
 //needs a truncate functor, too? or do this with mallocs?
 };
 
-template<typename Device>
+//if sortHierarchy, the second input are the hierarchy values (V x 1, float)
+//that are sorted within each row split, otherwise the sorted indices
+template<typename Device, bool sortHierarchy>
 class LocalClusterOp : public OpKernel {
 public:
     explicit LocalClusterOp(OpKernelConstruction *context) : OpKernel(context) {
@@ -139,6 +237,22 @@ public:
         const int n_rs = t_row_splits.dim_size(0);
 
 
+        Tensor t_temp_hierarchy_idxs;
+        const int *d_hierarchy_idxs = t_hierarchy_idxs.flat<int>().data();
+        if(sortHierarchy){
+            OP_REQUIRES_OK(context, context->allocate_temp( DT_INT32 ,TensorShape({
+                n_vert_in
+            }),&t_temp_hierarchy_idxs));
+
+            sort_hierarchy(context->eigen_device<CPUDevice>(),
+                    t_hierarchy_idxs.flat<float>().data(),
+                    t_row_splits.flat<int>().data(),
+                    t_temp_hierarchy_idxs.flat<int>().data(),
+                    n_vert_in,
+                    n_rs);
+            d_hierarchy_idxs = t_temp_hierarchy_idxs.flat<int>().data();
+        }
+
         Tensor t_temp_out_sel_idxs;
         OP_REQUIRES_OK(context, context->allocate_temp( DT_INT32 ,TensorShape({
             n_vert_in
@@ -167,8 +281,7 @@ public:
                         context->eigen_device<Device>(),
 
                         t_neighbour_idxs.flat<int>().data(), // const int *d_neigh_idxs,
-                        t_hierarchy_idxs.flat<int>().data(), //const int *d_hierarchy_idxs, //maybe do this internally if op can be called by op
-                        //the above will require an argsort on ragged (only with eager workaround so far)
+                        d_hierarchy_idxs, //const int *d_hierarchy_idxs, sorted within each row split
 
                         t_global_idxs.flat<int>().data(), // const int * d_global_idxs, //global index of each vertex: V x 1, not global dimension!
                         t_row_splits.flat<int>().data(), //const int * d_row_splits,  //keeps dimensions: N_rs x 1
@@ -210,11 +323,12 @@ public:
 
 };
 
-REGISTER_KERNEL_BUILDER(Name("LocalCluster").Device(DEVICE_CPU), LocalClusterOp<CPUDevice>);
+REGISTER_KERNEL_BUILDER(Name("LocalCluster").Device(DEVICE_CPU), LocalClusterOp<CPUDevice, false>);
+REGISTER_KERNEL_BUILDER(Name("LocalClusterHierarchy").Device(DEVICE_CPU), LocalClusterOp<CPUDevice, true>);
 
 #ifdef NOOOOO_GOOGLE_CUDA
 extern template struct LocalClusterOpFunctor<GPUDevice, int>;
-REGISTER_KERNEL_BUILDER(Name("LocalCluster").Device(DEVICE_GPU), LocalClusterOp<GPUDevice>);
+REGISTER_KERNEL_BUILDER(Name("LocalCluster").Device(DEVICE_GPU), LocalClusterOp<GPUDevice, false>);
 #endif  // GOOGLE_CUDA
 
 }//functor
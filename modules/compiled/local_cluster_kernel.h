@@ -10,10 +10,8 @@ namespace functor {
  * the row splits are assumed to be accounted for in the input indices of the neighbours
  * (d_neigh_idxs)
  *
- * The performance can be increased by a small factor <10 if row splits
- * are used for parallelisation anyway, because we know vertices from differen row splits
- * don't talk to each other, we can parallelise along this dimension.
- * So far, this is not implemented, but foreseen in the interface
+ * Vertices from different row splits don't talk to each other,
+ * so the CPU implementation processes the row splits in parallel.
  *
  */
 template<typename Device, typename dummy>
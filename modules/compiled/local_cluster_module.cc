@@ -14,4 +14,13 @@ REGISTER_OP("LocalCluster")
     .Output("backscatter_idxs: int32");
 
 
+//same as LocalCluster, but the hierarchy values are sorted within each row split in the op
+REGISTER_OP("LocalClusterHierarchy")
+    .Input("neighbour_idxs: int32")
+    .Input("hierarchy: float")
+    .Input("global_idxs: int32")
+    .Input("row_splits: int32")
+    .Output("out_row_splits: int32")
+    .Output("selection_idxs: int32")
+    .Output("backscatter_idxs: int32");
 
@@ -0,0 +1,418 @@
+#define EIGEN_USE_THREADS
+#if GOOGLE_CUDA
+#define EIGEN_USE_GPU
+#endif  // GOOGLE_CUDA
+
+
+#include "tensorflow/core/framework/op_kernel.h"
+#include "select_knn_accumulate_grad_kernel.h"
+#include "helpers.h"
+#include "binning_helpers.h"
+#include <string> //size_t, just for helper function
+#include <cmath>
+#include <vector>
+#include <algorithm>
+#include <functional>
+
+namespace tensorflow {
+typedef Eigen::ThreadPoolDevice CPUDevice;
+typedef Eigen::GpuDevice GPUDevice;
+
+namespace functor {
+
+
+//same as in AccumulateKnn
+static inline float distanceWeight(const float& distsq){
+    return exp(-1.* distsq);
+}
+
+/*
+ * Weight and feature part of the gradient w.r.t. the squared distance of one
+ * neighbour entry, same expressions in both passes so that the results agree.
+ */
+static inline float feature_distance_gradient(
+        const float *g_mean,
+        const float *g_max,
+        const int *max_for_iv,
+        const float *flb,
+        const int l_g,
+        const int n_feat,
+        const int n_acc,
+        const float distance_scale,
+        const float w){
+
+    float mean_contrib=0;
+    float max_contrib=0;
+    for(int b_f=0;b_f<n_feat;b_f++){
+        mean_contrib += g_mean[b_f] * flb[b_f];
+        if(max_for_iv[b_f] == l_g)
+            max_contrib += g_max[b_f] * flb[b_f];
+    }
+    return -distance_scale * w * (mean_contrib / (float)n_acc + max_contrib);
+}
+
+/*
+ * Recomputes the neighbours of the vertices of one row split (same search as
+ * in the forward pass) and stores their indices. The part of the coordinate
+ * gradient that belongs to the vertex itself is written here.
+ */
+static void neighbour_distance_gradients(
+        const CPUDevice &d,
+
+        const float *d_grad_from_out_features,
+        const float *d_grad_from_distances,
+        const float *d_coord,
+        const float *d_feat,
+        const int *d_row_splits,
+        const int *d_max_feat_indices,
+
+        int *neigh_indices,
+        float *d_out_grad_coords,
+
+        const int n_vert,
+        const int n_neigh,
+        const int n_coords,
+        const int n_feat,
+
+        const int j_rs,
+        const float max_radius,
+        const float distance_scale,
+        const int max_shells,
+        const bool use_grad_distances){
+
+    const int start_vert = d_row_splits[j_rs];
+    int end_vert = d_row_splits[j_rs+1];
+    if(end_vert > n_vert)
+        end_vert = n_vert;
+    if(end_vert <= start_vert)
+        return;
+
+    const int nvert_in_row = end_vert - start_vert;
+    const int n_acc = n_neigh-1;
+
+    std::vector<int> candidates(nvert_in_row);
+    for(int j_v=start_vert;j_v<end_vert;j_v++)
+        candidates[j_v-start_vert] = j_v;
+
+    binning::vertex_grid grid;
+    grid.build(d_coord, n_coords, candidates, n_neigh);
+
+    auto work = [&](Eigen::Index first, Eigen::Index last){
+        std::vector<binning::dist_idx> selected;
+        selected.reserve(n_acc);
+
+        for(int i_v = start_vert+first; i_v < start_vert+last; i_v++){
+
+            binning::knn_search(grid, d_coord, n_coords, i_v, n_acc, max_radius, selected, max_shells);
+
+            const float * g_mean = d_grad_from_out_features + I2D(i_v, 0, 2*n_feat);
+            const float * g_max = g_mean + n_feat;
+            const int * max_for_iv = d_max_feat_indices + I2D(i_v, 0, n_feat);
+            float * grad_coord = d_out_grad_coords + I2D(i_v, 0, n_coords);
+
+            for(size_t i_n=0;i_n<selected.size();i_n++){
+                const int l_g = selected[i_n].second;
+                const float w = distanceWeight(distance_scale * selected[i_n].first);
+                float grad_dist = feature_distance_gradient(g_mean, g_max, max_for_iv,
+                        d_feat + I2D(l_g, 0, n_feat), l_g, n_feat, n_acc, distance_scale, w);
+                if(use_grad_distances)
+                    grad_dist += d_grad_from_distances[I2D(i_v,i_n,n_acc)];
+
+                neigh_indices[I2D(i_v,i_n,n_acc)] = l_g;
+
+                for(int nu_c=0;nu_c<n_coords;nu_c++)
+                    grad_coord[nu_c] += 2. * grad_dist *
+                        (d_coord[I2D(i_v,nu_c,n_coords)] - d_coord[I2D(l_g,nu_c,n_coords)]);
+            }
+        }
+    };
+
+    const double cost_per_vertex = 8. * n_neigh * n_coords + 3. * n_acc * n_feat;
+    d.parallelFor(nvert_in_row,
+            Eigen::TensorOpCost(cost_per_vertex * sizeof(float), n_acc * sizeof(int),
+                    cost_per_vertex),
+            work);
+}
+
+/*
+ * Groups the neighbour entries e = I2D(i_v,i_n,n_acc) by their neighbour index in place
+ * (counting sort following the permutation cycles, no second V x K-1 array).
+ * Afterwards, neigh[offsets[m_v]] to neigh[offsets[m_v+1]-1] hold -e-2 for all entries
+ * with neighbour m_v, in no particular order. Padded entries (-1) are moved behind offsets[n_vert].
+ */
+static void group_by_neighbour(
+        int *neigh,
+        std::vector<int>& offsets,
+        const size_t n_entries,
+        const int n_vert){
+
+    offsets.assign(n_vert+2, 0);
+    for (size_t e = 0; e < n_entries; e++){
+        int m_v = neigh[e];
+        offsets[(m_v<0 ? n_vert : m_v)+1]++;
+    }
+    for (int m = 0; m < n_vert+1; m++)
+        offsets[m+1] += offsets[m];
+
+    std::vector<int> filled(offsets.begin(), offsets.end()-1);
+    for (size_t start = 0; start < n_entries; start++){
+        if(neigh[start] < -1)
+            continue; //already placed
+        //entries that were not placed yet are still at their original position
+        int e = start;
+        int m_v = neigh[start];
+        while(true){
+            const int dest = filled[m_v<0 ? n_vert : m_v]++;
+            const int next_m_v = neigh[dest];
+            neigh[dest] = -e-2;
+            if(dest == (int)start)
+                break;
+            e = dest;
+            m_v = next_m_v;
+        }
+    }
+}
+
+/*
+ * Gather over the inverse neighbour list (as in AccumulateKnnGrad): every vertex
+ * collects the feature gradients and the neighbour part of the coordinate gradients
+ * from all vertices that have it as neighbour. The weights and distance gradients
+ * are recomputed instead of stored per entry.
+ */
+static void inverse_neighbour_gradients(
+        const CPUDevice &d,
+
+        const float *d_grad_from_out_features,
+        const float *d_grad_from_distances,
+        const float *d_coord,
+        const float *d_feat,
+        const int *d_max_feat_indices,
+
+        int *neigh_indices,
+
+        float *d_out_grad_coords,
+        float *d_out_grad_features,
+
+        const int n_vert,
+        const int n_neigh,
+        const int n_coords,
+        const int n_feat,
+
+        const float distance_scale,
+        const bool use_grad_distances){
+
+    const int n_acc = n_neigh-1;
+    const size_t n_entries = (size_t)n_vert * n_acc;
+
+    std::vector<int> offsets;
+    group_by_neighbour(neigh_indices, offsets, n_entries, n_vert);
+
+    auto work = [&](Eigen::Index first, Eigen::Index last){
+        for (Eigen::Index m_v = first; m_v < last; m_v++){
+
+            float * grad = d_out_grad_features + I2D(m_v, 0, n_feat);
+            for(int nu_f=0;nu_f<n_feat;nu_f++)
+                grad[nu_f] = 0;
+            float * grad_coord = d_out_grad_coords + I2D(m_v, 0, n_coords);
+            const float * flb = d_feat + I2D(m_v, 0, n_feat);
+
+            //ascending entry order (the grouping is not stable), same summation order as AccumulateKnnGrad
+            std::sort(neigh_indices + offsets[m_v], neigh_indices + offsets[m_v+1], std::greater<int>());
+
+            for(int i_e = offsets[m_v]; i_e < offsets[m_v+1]; i_e++){
+                const int e = -neigh_indices[i_e]-2;
+                const int i_v = e / n_acc;
+
+                const float * ginu = d_grad_from_out_features + I2D(i_v, 0, 2*n_feat);
+                const float * ginu_max = ginu + n_feat;
+                const int * max_for_iv = d_max_feat_indices + I2D(i_v, 0, n_feat);
+
+                const float weight_im = distanceWeight(distance_scale *
+                        binning::squared_distance(d_coord, n_coords, i_v, m_v));
+                float grad_dist = feature_distance_gradient(ginu, ginu_max, max_for_iv,
+                        flb, m_v, n_feat, n_acc, distance_scale, weight_im);
+                if(use_grad_distances)
+                    grad_dist += d_grad_from_distances[e];
+
+                for(int nu_f=0;nu_f<n_feat;nu_f++){
+                    float mean_contrib = ginu[nu_f]  / (float)n_acc  * weight_im;
+                    float max_contrib = max_for_iv[nu_f] == m_v ? ginu_max[nu_f] * weight_im : 0.f;
+                    grad[nu_f] += mean_contrib + max_contrib;
+                }
+                for(int nu_c=0;nu_c<n_coords;nu_c++)
+                    grad_coord[nu_c] += 2. * grad_dist *
+                        (d_coord[I2D(m_v,nu_c,n_coords)] - d_coord[I2D(i_v,nu_c,n_coords)]);
+            }
+        }
+    };
+
+    const double avg_refs = n_vert > 0 ? (double)offsets[n_vert] / (double)n_vert : 0.;
+    d.parallelFor(n_vert,
+            Eigen::TensorOpCost(avg_refs * (2 * n_feat + 1 + 2 * n_coords) * sizeof(float) + avg_refs * n_feat * sizeof(int),
+                    (n_feat + n_coords) * sizeof(float), avg_refs * 6. * (n_feat + n_coords)),
+            work);
+}
+
+// CPU specialization
+template<typename dummy>
+struct SelectKnnAccumulateGradOpFunctor<CPUDevice, dummy> {
+    void operator()(const CPUDevice &d,
+
+            const float *d_grad_from_out_features,
+            const float *d_grad_from_distances,
+            const float *d_coord,
+            const float *d_feat,
+            const int *d_row_splits,
+            const int *d_max_feat_indices,
+
+            float *d_out_grad_coords,
+            float *d_out_grad_features,
+
+            const int n_vert,
+            const int n_neigh,
+            const int n_coords,
+            const int n_feat,
+
+            const int n_rs,
+            const float max_radius,
+            const float distance_scale,
+            const int max_shells,
+            const bool use_grad_distances) {
+
+        //only the neighbour indices are kept for the duration of the gradient calculation
+        const size_t n_entries = (size_t)n_vert * (n_neigh-1);
+        std::vector<int> neigh_indices(n_entries, -1);
+
+        for(size_t i=0;i<(size_t)n_vert*n_coords;i++)
+            d_out_grad_coords[i]=0;
+
+        for(int j_rs=0;j_rs<n_rs-1;j_rs++){
+            neighbour_distance_gradients(d,
+                    d_grad_from_out_features,
+                    d_grad_from_distances,
+                    d_coord,
+                    d_feat,
+                    d_row_splits,
+                    d_max_feat_indices,
+
+                    neigh_indices.data(),
+                    d_out_grad_coords,
+
+                    n_vert,
+                    n_neigh,
+                    n_coords,
+                    n_feat,
+
+                    j_rs,
+                    max_radius,
+                    distance_scale,
+                    max_shells,
+                    use_grad_distances);
+        }
+
+        inverse_neighbour_gradients(d,
+                d_grad_from_out_features,
+                d_grad_from_distances,
+                d_coord,
+                d_feat,
+                d_max_feat_indices,
+
+                neigh_indices.data(),
+
+                d_out_grad_coords,
+                d_out_grad_features,
+
+                n_vert,
+                n_neigh,
+                n_coords,
+                n_feat,
+
+                distance_scale,
+                use_grad_distances);
+    }
+};
+
+template<typename Device>
+class SelectKnnAccumulateGradOp : public OpKernel {
+public:
+    explicit SelectKnnAccumulateGradOp(OpKernelConstruction *context) : OpKernel(context) {
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("n_neighbours", &K_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("max_radius", &max_radius_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("distance_scale", &distance_scale_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("max_shells", &max_shells_));
+
+        if(max_radius_>0)
+            max_radius_ *= max_radius_;//use squared
+    }
+
+    void Compute(OpKernelContext *context) override {
+
+        const Tensor &t_grad_from_out_features = context->input(0);
+        const Tensor &t_grad_from_distances = context->input(1);
+        const Tensor &t_coord = context->input(2);
+        const Tensor &t_feat = context->input(3);
+        const Tensor &t_rs = context->input(4);
+        const Tensor &t_max_feat_indices = context->input(5);
+
+        int n_vert = t_coord.dim_size(0);
+        int n_coords = t_coord.dim_size(1);
+        int n_feat = t_feat.dim_size(1);
+        int n_rs = t_rs.dim_size(0);
+
+        bool use_grad_distances = t_grad_from_distances.dim_size(1) == K_-1;
+
+        TensorShape outputShapeCoords;
+        outputShapeCoords.AddDim(n_vert);
+        outputShapeCoords.AddDim(n_coords);
+
+        TensorShape outputShapeFeat;
+        outputShapeFeat.AddDim(n_vert);
+        outputShapeFeat.AddDim(n_feat);
+
+        Tensor *t_out_grad_coords = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(0, outputShapeCoords, &t_out_grad_coords));
+
+        Tensor *t_out_grad_features = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(1, outputShapeFeat, &t_out_grad_features));
+
+        SelectKnnAccumulateGradOpFunctor<Device, int>()(
+                context->eigen_device<Device>(),
+
+                t_grad_from_out_features.flat<float>().data(),
+                t_grad_from_distances.flat<float>().data(),
+                t_coord.flat<float>().data(),
+                t_feat.flat<float>().data(),
+                t_rs.flat<int>().data(),
+                t_max_feat_indices.flat<int>().data(),
+
+                t_out_grad_coords->flat<float>().data(),
+                t_out_grad_features->flat<float>().data(),
+
+                n_vert,
+                K_,
+                n_coords,
+                n_feat,
+
+                n_rs,
+                max_radius_,
+                distance_scale_,
+                max_shells_,
+                use_grad_distances
+        );
+    }
+
+private:
+    int K_;
+    float max_radius_;
+    float distance_scale_;
+    int max_shells_;
+};
+
+REGISTER_KERNEL_BUILDER(Name("SelectKnnAccumulateGrad").Device(DEVICE_CPU), SelectKnnAccumulateGradOp<CPUDevice>);
+
+}//functor
+}//tensorflow
@@ -0,0 +1,38 @@
+// select_knn_accumulate_grad_kernel.h
+#ifndef SELECT_KNN_ACCUMULATE_GRAD_KERNEL_H
+#define SELECT_KNN_ACCUMULATE_GRAD_KERNEL_H
+
+namespace tensorflow {
+namespace functor {
+
+template<typename Device, typename dummy>
+struct SelectKnnAccumulateGradOpFunctor {
+    void operator()(
+            const Device &d,
+
+            const float *d_grad_from_out_features, // V x 2F
+            const float *d_grad_from_distances, // V x N-1, only used if use_grad_distances
+            const float *d_coord,
+            const float *d_feat,
+            const int *d_row_splits,
+            const int *d_max_feat_indices, // V x F
+
+            float *d_out_grad_coords,
+            float *d_out_grad_features,
+
+            const int n_vert,
+            const int n_neigh, //including self
+            const int n_coords,
+            const int n_feat,
+
+            const int n_rs,
+            const float max_radius,
+            const float distance_scale,
+            const int max_shells,
+            const bool use_grad_distances);
+};
+
+}  // namespace functor
+}  // namespace tensorflow
+
+#endif //SELECT_KNN_ACCUMULATE_GRAD_KERNEL_H
@@ -0,0 +1,22 @@
+
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/shape_inference.h"
+
+using namespace tensorflow;
+
+
+REGISTER_OP("SelectKnnAccumulateGrad")
+    .Attr("n_neighbours: int")
+    .Attr("max_radius: float")
+    .Attr("distance_scale: float = 1.0")
+    .Attr("max_shells: int = -1") //approximate search if >= 0, see SelectKnn
+    .Input("grad_from_out_features: float32")
+    .Input("grad_from_distances: float32") // V x 0 if there is none
+    .Input("coords: float32")
+    .Input("features: float32")
+    .Input("row_splits: int32")
+    .Input("max_feat_indices: int32")
+    .Output("out_grad_coords: float32")
+    .Output("out_grad_features: float32");
+
+
@@ -0,0 +1,307 @@
+#define EIGEN_USE_THREADS
+#if GOOGLE_CUDA
+#define EIGEN_USE_GPU
+#endif  // GOOGLE_CUDA
+
+
+#include "tensorflow/core/framework/op_kernel.h"
+#include "select_knn_accumulate_kernel.h"
+#include "helpers.h"
+#include "binning_helpers.h"
+#include <string> //size_t, just for helper function
+#include <cmath>
+#include <vector>
+#include <algorithm>
+
+namespace tensorflow {
+typedef Eigen::ThreadPoolDevice CPUDevice;
+typedef Eigen::GpuDevice GPUDevice;
+
+namespace functor {
+
+
+//same as in AccumulateKnn
+static inline float distanceWeight(const float& distsq){
+    return exp(-1.* distsq);
+}
+
+// number of features processed together, the accumulators of one block stay in L1
+static const int feature_block_size = 64;
+
+/*
+ * Selects the neighbours of each vertex with the binned search (see SelectKnn, binned=True)
+ * and accumulates the distance weighted mean and max of the features right away, the
+ * neighbours are only kept per vertex. The results are the same as those of SelectKnn
+ * (binned, tf_compatible=False), removing self, followed by
+ * AccumulateKnn(distance_scale * distances, features, indices).
+ */
+static void select_knn_accumulate_kernel(
+        const CPUDevice &d,
+
+        const float *d_coord,
+        const float *d_feat,
+        const int *d_row_splits,
+
+        float *d_out_feat,
+        int *d_out_maxidxs,
+        int *d_indices,
+        float *d_dist,
+
+        const int n_vert,
+        const int n_neigh,
+        const int n_coords,
+        const int n_feat,
+
+        const int j_rs,
+        const float max_radius,
+        const float distance_scale,
+        const int max_shells,
+        const bool keep_neighbours) {
+
+    const int start_vert = d_row_splits[j_rs];
+    int end_vert = d_row_splits[j_rs+1];
+    if(end_vert > n_vert)
+        end_vert = n_vert;//safety net as in SelectKnn
+    if(end_vert <= start_vert)
+        return;
+
+    const int nvert_in_row = end_vert - start_vert;
+    const int n_acc = n_neigh-1; //without self
+    const int n_out_feat = 2 * n_feat;
+
+    std::vector<int> candidates(nvert_in_row);
+    for(int j_v=start_vert;j_v<end_vert;j_v++)
+        candidates[j_v-start_vert] = j_v;
+
+    binning::vertex_grid grid;
+    grid.build(d_coord, n_coords, candidates, n_neigh);
+
+    auto work = [&](Eigen::Index first, Eigen::Index last){
+        std::vector<binning::dist_idx> selected;
+        selected.reserve(n_acc);
+        std::vector<float> weights(n_acc);
+        float t_mean[feature_block_size];
+        float t_max[feature_block_size];
+        int max_idx[feature_block_size];
+
+        for(int i_v = start_vert+first; i_v < start_vert+last; i_v++){
+
+            binning::knn_search(grid, d_coord, n_coords, i_v, n_acc, max_radius, selected, max_shells);
+            const int n_valid = selected.size();
+
+            for(int i_n=0;i_n<n_valid;i_n++)
+                weights[i_n] = distanceWeight(distance_scale * selected[i_n].first);
+
+            if(keep_neighbours){
+                for(int i_n=0;i_n<n_valid;i_n++){
+                    d_indices[I2D(i_v,i_n,n_acc)] = selected[i_n].second;
+                    d_dist[I2D(i_v,i_n,n_acc)] = selected[i_n].first;
+                }
+            }
+
+            for(int f_start=0;f_start<n_feat;f_start+=feature_block_size){
+                const int n_f = std::min(feature_block_size, n_feat-f_start);
+
+                if(n_valid<1){
+                    for(int i_f=0;i_f<n_f;i_f++){
+                        t_mean[i_f] = 0;
+                        t_max[i_f] = 0;
+                        max_idx[i_f] = 0;
+                    }
+                }
+                else{
+                    const int nidx = selected[0].second;
+                    const float w = weights[0];
+                    const float *vnf = d_feat + I2D(nidx,f_start,n_feat);
+                    for(int i_f=0;i_f<n_f;i_f++){
+                        float wfeat = vnf[i_f] * w;
+                        t_mean[i_f] = wfeat;
+                        t_max[i_f] = wfeat;
+                        max_idx[i_f] = nidx;
+                    }
+                }
+
+                for(int i_n=1;i_n<n_valid;i_n++){
+                    const int nidx = selected[i_n].second;
+                    const float w = weights[i_n];
+                    const float *vnf = d_feat + I2D(nidx,f_start,n_feat);
+                    //branch free, ties go to the later neighbour
+                    for(int i_f=0;i_f<n_f;i_f++){
+                        float wfeat = vnf[i_f] * w;
+                        t_mean[i_f] += wfeat;
+                        bool larger = wfeat >= t_max[i_f];
+                        t_max[i_f] = larger ? wfeat : t_max[i_f];
+                        max_idx[i_f] = larger ? nidx : max_idx[i_f];
+                    }
+                }
+
+                for(int i_f=0;i_f<n_f;i_f++){
+                    d_out_maxidxs[I2D(i_v,f_start+i_f,n_feat)] = max_idx[i_f]; //just used for gradient
+                    d_out_feat[I2D(i_v,f_start+i_f,n_out_feat)] = t_mean[i_f] / (float)n_acc;
+                    d_out_feat[I2D(i_v,f_start+i_f+n_feat,n_out_feat)] = t_max[i_f];
+                }
+            }
+        }
+    };
+
+    //rough estimate: a few cells worth of candidates per vertex, plus the accumulation
+    const double cost_per_vertex = 8. * n_neigh * n_coords + 3. * n_acc * n_feat;
+    d.parallelFor(nvert_in_row,
+            Eigen::TensorOpCost(cost_per_vertex * sizeof(float), n_out_feat * sizeof(float) + n_feat * sizeof(int),
+                    cost_per_vertex),
+            work);
+}
+
+// CPU specialization
+template<typename dummy>
+struct SelectKnnAccumulateOpFunctor<CPUDevice, dummy> {
+    void operator()(const CPUDevice &d,
+
+            const float *d_coord,
+            const float *d_feat,
+            const int *d_row_splits,
+
+            float *d_out_feat,
+            int *d_out_maxidxs,
+            int *d_indices,
+            float *d_dist,
+
+            const int n_vert,
+            const int n_neigh,
+            const int n_coords,
+            const int n_feat,
+
+            const int n_rs,
+            const float max_radius,
+            const float distance_scale,
+            const int max_shells,
+            const bool keep_neighbours) {
+
+        //vertices outside of the row splits
+        for(size_t i=0;i<(size_t)n_vert*2*n_feat;i++)
+            d_out_feat[i]=0;
+        for(size_t i=0;i<(size_t)n_vert*n_feat;i++)
+            d_out_maxidxs[i]=0;
+        if(keep_neighbours){
+            for(size_t i=0;i<(size_t)n_vert*(n_neigh-1);i++){
+                d_indices[i]=-1;
+                d_dist[i]=0;
+            }
+        }
+
+        for(int j_rs=0;j_rs<n_rs-1;j_rs++){
+            select_knn_accumulate_kernel(d,
+                    d_coord,
+                    d_feat,
+                    d_row_splits,
+
+                    d_out_feat,
+                    d_out_maxidxs,
+                    d_indices,
+                    d_dist,
+
+                    n_vert,
+                    n_neigh,
+                    n_coords,
+                    n_feat,
+
+                    j_rs,
+                    max_radius,
+                    distance_scale,
+                    max_shells,
+                    keep_neighbours);
+        }
+    }
+};
+
+template<typename Device>
+class SelectKnnAccumulateOp : public OpKernel {
+public:
+    explicit SelectKnnAccumulateOp(OpKernelConstruction *context) : OpKernel(context) {
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("n_neighbours", &K_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("max_radius", &max_radius_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("distance_scale", &distance_scale_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("max_shells", &max_shells_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("keep_neighbours", &keep_neighbours_));
+
+        if(max_radius_>0)
+            max_radius_ *= max_radius_;//use squared
+    }
+
+    void Compute(OpKernelContext *context) override {
+
+        const Tensor &t_coord = context->input(0);
+        const Tensor &t_feat = context->input(1);
+        const Tensor &t_rs = context->input(2);
+
+        int n_vert = t_coord.dim_size(0);
+        int n_coords = t_coord.dim_size(1);
+        int n_feat = t_feat.dim_size(1);
+        int n_rs = t_rs.dim_size(0);
+
+        TensorShape outputShape;
+        outputShape.AddDim(n_vert);
+        outputShape.AddDim(2 * n_feat); //mean and max
+
+        Tensor *output_tensor = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(0, outputShape, &output_tensor));
+
+        TensorShape outputShape_max_idxs;
+        outputShape_max_idxs.AddDim(n_vert);
+        outputShape_max_idxs.AddDim(n_feat);
+
+        Tensor *output_max_idxs_tensor = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(1, outputShape_max_idxs, &output_max_idxs_tensor));
+
+        TensorShape outputShape_neigh;
+        outputShape_neigh.AddDim(n_vert);
+        outputShape_neigh.AddDim(keep_neighbours_ ? K_-1 : 0);
+
+        Tensor *output_indices = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(2, outputShape_neigh, &output_indices));
+
+        Tensor *output_distances = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(3, outputShape_neigh, &output_distances));
+
+        SelectKnnAccumulateOpFunctor<Device, int>()(
+                context->eigen_device<Device>(),
+
+                t_coord.flat<float>().data(),
+                t_feat.flat<float>().data(),
+                t_rs.flat<int>().data(),
+
+                output_tensor->flat<float>().data(),
+                output_max_idxs_tensor->flat<int>().data(),
+                output_indices->flat<int>().data(),
+                output_distances->flat<float>().data(),
+
+                n_vert,
+                K_,
+                n_coords,
+                n_feat,
+
+                n_rs,
+                max_radius_,
+                distance_scale_,
+                max_shells_,
+                keep_neighbours_
+        );
+    }
+
+private:
+    int K_;
+    float max_radius_;
+    float distance_scale_;
+    int max_shells_;
+    bool keep_neighbours_;
+};
+
+REGISTER_KERNEL_BUILDER(Name("SelectKnnAccumulate").Device(DEVICE_CPU), SelectKnnAccumulateOp<CPUDevice>);
+
+}//functor
+}//tensorflow
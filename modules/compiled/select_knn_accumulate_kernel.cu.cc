@@ -0,0 +1,10 @@
+//#define GOOGLE_CUDA 1
+
+//no GPU implementation yet, the op is only registered for the CPU
+
+#if GOOGLE_CUDA
+#define EIGEN_USE_GPU
+
+#include "select_knn_accumulate_kernel.h"
+
+#endif  // GOOGLE_CUDA
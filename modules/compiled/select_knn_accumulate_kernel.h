@@ -0,0 +1,37 @@
+// select_knn_accumulate_kernel.h
+#ifndef SELECT_KNN_ACCUMULATE_KERNEL_H
+#define SELECT_KNN_ACCUMULATE_KERNEL_H
+
+namespace tensorflow {
+namespace functor {
+
+template<typename Device, typename dummy>
+struct SelectKnnAccumulateOpFunctor {
+    void operator()(
+            const Device &d,
+
+            const float *d_coord,
+            const float *d_feat,
+            const int *d_row_splits,
+
+            float *d_out_feat,
+            int *d_out_maxidxs,
+            int *d_indices, //only filled if keep_neighbours
+            float *d_dist,  //only filled if keep_neighbours
+
+            const int n_vert,
+            const int n_neigh, //including self
+            const int n_coords,
+            const int n_feat,
+
+            const int n_rs,
+            const float max_radius,
+            const float distance_scale,
+            const int max_shells,
+            const bool keep_neighbours);
+};
+
+}  // namespace functor
+}  // namespace tensorflow
+
+#endif //SELECT_KNN_ACCUMULATE_KERNEL_H
@@ -0,0 +1,26 @@
+
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/shape_inference.h"
+
+using namespace tensorflow;
+
+/*
+ * SelectKnn and AccumulateKnn in one op: the neighbours (n_neighbours including self,
+ * self is not accumulated) are only kept per vertex while accumulating,
+ * unless keep_neighbours is set. Otherwise indices and distances have shape V x 0.
+ */
+REGISTER_OP("SelectKnnAccumulate")
+    .Attr("n_neighbours: int")
+    .Attr("max_radius: float")
+    .Attr("distance_scale: float = 1.0")
+    .Attr("max_shells: int = -1") //approximate search if >= 0, see SelectKnn
+    .Attr("keep_neighbours: bool = false")
+    .Input("coords: float32")
+    .Input("features: float32")
+    .Input("row_splits: int32")
+    .Output("out_features: float32")
+    .Output("out_max_idxs: int32")
+    .Output("indices: int32")
+    .Output("distances: float32");
+
+
@@ -1,4 +1,5 @@
 
+#define EIGEN_USE_THREADS
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
@@ -7,8 +8,12 @@
 #include "tensorflow/core/framework/op_kernel.h"
 #include "select_knn_kernel.h"
 #include "helpers.h"
+#include "binning_helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <algorithm>
+#include <utility>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -177,6 +182,105 @@ void select_knn_kernel(
 
 }
 
+static bool is_accumulator(const int* d_mask, size_t i_v,
+        selknn::mask_mode_en mask_mode,
+        selknn::mask_logic_en mask_logic){
+    if(mask_mode == selknn::mm_none)
+        return true;
+    if(mask_logic == selknn::ml_and)
+        return d_mask[i_v];
+    if(mask_mode == selknn::mm_scat)
+        return !d_mask[i_v];
+    return d_mask[i_v];//mm_acc
+}
+
+static bool is_scatterer(const int* d_mask, size_t j_v,
+        selknn::mask_mode_en mask_mode,
+        selknn::mask_logic_en mask_logic){
+    if(mask_mode == selknn::mm_none)
+        return true;
+    if(mask_logic == selknn::ml_and)
+        return d_mask[j_v];
+    if(mask_mode == selknn::mm_scat)
+        return d_mask[j_v];
+    return !d_mask[j_v];//mm_acc
+}
+
+/*
+ * Same selection as select_knn_kernel, but the candidates are binned
+ * in a uniform grid and for each vertex only the cells that can still
+ * contain closer neighbours are visited. Vertices are processed in parallel.
+ * Selects neighbours with the same distances, sorted by distance. Ties at the
+ * largest selected distance are resolved towards lower indices, which is not
+ * necessarily what the brute-force replacement keeps, so the indices can differ.
+ * With max_shells >= 0, only the cells up to max_shells cells away are searched
+ * (unless fewer than K neighbours were found), which is faster but approximate.
+ */
+static void select_knn_binned_kernel(
+        const CPUDevice &d,
+        const float *d_coord,
+        const int* d_row_splits,
+        const int* d_mask,
+        int *d_indices,
+        float *d_dist,
+
+        const int n_vert,
+        const int n_neigh,
+        const int n_coords,
+
+        const int j_rs,
+        const float max_radius,
+        selknn::mask_mode_en mask_mode,
+        selknn::mask_logic_en mask_logic,
+        const int max_shells) {
+
+    const int start_vert = d_row_splits[j_rs];
+    int end_vert = d_row_splits[j_rs+1];
+    if(end_vert > n_vert)
+        end_vert = n_vert;//safety net as above
+    if(end_vert <= start_vert)
+        return;
+
+    //protection against n_vert<n_neigh, as above
+    const int nvert_in_row = end_vert - start_vert;
+    const int max_neighbours = std::min(n_neigh, nvert_in_row);
+    if(max_neighbours < 2)
+        return;
+
+    std::vector<int> candidates;
+    candidates.reserve(nvert_in_row);
+    for(int j_v=start_vert;j_v<end_vert;j_v++){
+        if(is_scatterer(d_mask, j_v, mask_mode, mask_logic))
+            candidates.push_back(j_v);
+    }
+
+    binning::vertex_grid grid;
+    grid.build(d_coord, n_coords, candidates, n_neigh);
+
+    auto work = [&](Eigen::Index first, Eigen::Index last){
+        std::vector<binning::dist_idx> selected;
+        selected.reserve(max_neighbours);
+
+        for(int i_v = start_vert+first; i_v < start_vert+last; i_v++){
+            if(!is_accumulator(d_mask, i_v, mask_mode, mask_logic))
+                continue;
+
+            binning::knn_search(grid, d_coord, n_coords, i_v, max_neighbours-1, max_radius, selected, max_shells);
+
+            for(size_t n=0;n<selected.size();n++){
+                d_indices[I2D(i_v,n+1,n_neigh)] = selected[n].second;
+                d_dist[I2D(i_v,n+1,n_neigh)] = selected[n].first;
+            }
+        }
+    };
+
+    //rough estimate: a few cells worth of candidates per vertex
+    const double cost_per_vertex = 8. * n_neigh * n_coords;
+    d.parallelFor(nvert_in_row,
+            Eigen::TensorOpCost(cost_per_vertex * sizeof(float), n_neigh * (sizeof(int)+sizeof(float)), cost_per_vertex),
+            work);
+}
+
 // CPU specialization
 template<typename dummy>
 struct SelectKnnOpFunctor<CPUDevice, dummy> {
@@ -196,7 +300,9 @@ struct SelectKnnOpFunctor<CPUDevice, dummy> {
             const bool tf_compat,
             const float max_radius,
             selknn::mask_mode_en mask_mode,
-            selknn::mask_logic_en mask_logic) {
+            selknn::mask_logic_en mask_logic,
+            const bool binned,
+            const int max_shells) {
 
 
         set_defaults(d_indices,
@@ -204,6 +310,28 @@ struct SelectKnnOpFunctor<CPUDevice, dummy> {
                 tf_compat,
                 n_vert,
                 n_neigh);
+
+        if(binned){
+            for(int j_rs=0;j_rs<n_rs-1;j_rs++){
+                select_knn_binned_kernel(d,
+                        d_coord,
+                        d_row_splits,
+                        d_mask,
+                        d_indices,
+                        d_dist,
+
+                        n_vert,
+                        n_neigh,
+                        n_coords,
+
+                        j_rs,
+                        max_radius,
+                        mask_mode,
+                        mask_logic,
+                        max_shells);
+            }
+            return;
+        }
         //really no buffering at all here
 
         for(size_t j_rs=0;j_rs<n_rs-1;j_rs++){
@@ -236,6 +364,10 @@ public:
                         context->GetAttr("tf_compatible", &tf_compat_));
         OP_REQUIRES_OK(context,
                         context->GetAttr("max_radius", &max_radius_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("binned", &binned_));
+        OP_REQUIRES_OK(context,
+                        context->GetAttr("max_shells", &max_shells_));
 
         int mm_ml_int=0;
         OP_REQUIRES_OK(context,
@@ -310,7 +442,9 @@ public:
                 tf_compat_,
                 max_radius_,
                 mask_mode,
-                mask_logic
+                mask_logic,
+                binned_,
+                max_shells_
         );
 
 
@@ -321,6 +455,8 @@ private:
     int K_;
     bool tf_compat_;
     float max_radius_;
+    bool binned_;
+    int max_shells_;
     selknn::mask_mode_en mask_mode;
     selknn::mask_logic_en mask_logic;
 };
@@ -27,7 +27,9 @@ struct SelectKnnOpFunctor {
             const bool tf_compat,
             const float max_radius,
             selknn::mask_mode_en mask_mode,
-            selknn::mask_logic_en mask_logic
+            selknn::mask_logic_en mask_logic,
+            const bool binned,
+            const int max_shells
             );
 };
 
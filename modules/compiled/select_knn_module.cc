@@ -9,6 +9,8 @@ REGISTER_OP("SelectKnn")
     .Attr("tf_compatible: bool")
     .Attr("max_radius: float")
     .Attr("mask_mode: int")
+    .Attr("binned: bool = false")
+    .Attr("max_shells: int = -1") //binned only, approximate search if >= 0
     .Input("coords: float32")
     .Input("row_splits: int32")
     .Input("mask: int32")
@@ -26,6 +26,47 @@ asso_idx, is_cpoint,n = BuildCondensates(ccoords=ccoords, betas=betas,  row_spli
 #print(is_cpoint)
 #exit()
 
+def reference_condensates(ccoords, betas, row_splits, radius, min_beta, soft):
+    '''
+    straight-forward numpy version of the O(N*N_cond) algorithm, float32 throughout
+    '''
+    ccoords = ccoords.numpy()
+    betas = betas.numpy()[:,0]
+    radius = np.float32(radius)**2
+    asso = np.zeros(betas.shape[0], dtype='int32')
+    iscp = np.zeros(betas.shape[0], dtype='int32')
+    rs = row_splits.numpy()
+    for i in range(len(rs)-1):
+        s, e = rs[i], rs[i+1]
+        asso[s:e] = -s-1
+        tb = betas[s:e].copy()
+        while True:
+            cand = np.where(asso[s:e] < 0, tb, -np.inf)
+            ref = np.argmax(cand)
+            if not cand[ref] > min_beta:
+                break
+            asso[s+ref] = s+ref
+            iscp[s+ref] = 1
+            free = asso[s:e] < 0
+            distsq = np.zeros(e-s, dtype='float32')
+            for c in range(ccoords.shape[1]):
+                distsq += (ccoords[s+ref,c]-ccoords[s:e,c])**2
+            if soft:
+                moddist = np.maximum(np.float32(1) - distsq/radius, 0)
+                tb[free] -= moddist[free]*betas[s+ref]
+                sel = free & (tb <= min_beta) & (moddist > 0)
+            else:
+                sel = free & (distsq <= radius)
+            asso[s:e][sel] = s+ref
+    return asso, iscp
+
+for soft_ in [False, True]:
+    asso_idx, is_cpoint,n = BuildCondensates(ccoords=ccoords, betas=betas,  row_splits=row_splits, radius=radius, min_beta=0.1, soft=soft_)
+    ref_asso, ref_iscp = reference_condensates(ccoords, betas, row_splits, radius, 0.1, soft_)
+    assert np.all(ref_asso == asso_idx.numpy()), ('soft', soft_, 'associations differ from the reference')
+    assert np.all(ref_iscp == is_cpoint.numpy()), ('soft', soft_, 'condensation points differ from the reference')
+    print('soft',soft_,'same as reference')
+
 print('starting taking time')
 t0 = time.time()
 for _ in range(0):
@@ -0,0 +1,29 @@
+import numpy as np
+
+from hit_budget_batching import pack_events, sequential_batches, batch_statistics
+
+'''
+checks that the hit budget packing uses every event at most once, respects
+the budget, and compares the fill fraction to the sequential batching
+'''
+
+np.random.seed(3)
+
+budget = 70000
+hit_counts = np.random.lognormal(np.log(4000), 0.9, size=20000).astype('int64')
+
+for skip in [True, False]:
+    batches = pack_events(hit_counts, budget, shuffle_window=2000, skip_too_large=skip)
+    used = np.concatenate(batches)
+    assert len(np.unique(used)) == len(used), 'events used more than once'
+    expected = np.sum(hit_counts <= budget) if skip else len(hit_counts)
+    assert len(used) == expected, ('events missing', len(used), expected)
+    for b in batches:
+        assert len(b) == 1 or np.sum(hit_counts[b]) <= budget, 'budget exceeded'
+
+packed = batch_statistics(pack_events(hit_counts, budget), hit_counts, budget)
+sequential = batch_statistics(sequential_batches(hit_counts, budget), hit_counts, budget)
+print('packed    ', packed)
+print('sequential', sequential)
+assert packed['padding_waste'] < sequential['padding_waste']
+assert packed['n_batches'] < sequential['n_batches']
@@ -0,0 +1,34 @@
+import tensorflow as tf
+import numpy as np
+import time
+
+from latent_space_grid_op import LatentSpaceGrid
+
+'''
+checks the counting sort in LatentSpaceGrid against a stable argsort of the
+cell indices, and that every cell only contains its own vertices
+'''
+
+np.random.seed(4)
+
+for rs in [[0, 100], [0, 5000, 5000, 12000], [0] + list(range(3000, 60001, 3000))]:
+    nvert = rs[-1]
+    x = tf.constant(np.random.rand(nvert, 3)*10., dtype='float32')
+    rs = tf.constant(rs, dtype='int32')
+    idxs, psrs, ncc, vert_to_cell = LatentSpaceGrid(size=1., min_cells=3, coords=x, row_splits=rs)
+    idxs, psrs, vert_to_cell = idxs.numpy(), psrs.numpy(), vert_to_cell.numpy()
+
+    assert np.all(idxs == np.argsort(vert_to_cell, kind='stable')), 'resort indices differ'
+    counts = np.bincount(vert_to_cell, minlength=psrs.shape[0]-1)
+    assert np.all(psrs == np.concatenate([[0], np.cumsum(counts)])), 'pseudo row splits differ'
+    for i in range(psrs.shape[0]-1):
+        assert np.all(vert_to_cell[idxs[psrs[i]:psrs[i+1]]] == i)
+print('LatentSpaceGrid agrees with the reference')
+
+x = tf.constant(np.random.rand(320000, 3)*10., dtype='float32')
+rs = tf.constant([0, 160000, 320000], dtype='int32')
+LatentSpaceGrid(size=1., min_cells=3, coords=x, row_splits=rs)
+t0 = time.time()
+for _ in range(10):
+    LatentSpaceGrid(size=1., min_cells=3, coords=x, row_splits=rs)
+print('op time', (time.time()-t0)/10)
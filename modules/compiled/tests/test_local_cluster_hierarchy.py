@@ -0,0 +1,46 @@
+import tensorflow as tf
+import numpy as np
+import time
+from select_knn_op import SelectKnn
+from local_cluster_op import LocalCluster, LocalClusterHierarchy
+
+'''
+compares LocalClusterHierarchy (sorting inside the op, row splits in parallel)
+to LocalCluster with the hierarchy sorted per row split in python
+'''
+
+np.random.seed(2)
+
+def sorted_hierarchy_idxs(hier, row_splits):
+    hierarchy_idxs=[]
+    for i in range(len(row_splits.numpy())-1):
+        a = tf.argsort(hier[row_splits[i]:row_splits[i+1]],axis=0, direction='DESCENDING')
+        hierarchy_idxs.append(a+row_splits[i])
+    return tf.concat(hierarchy_idxs,axis=0)
+
+def make_data(row_splits, K):
+    nvert = row_splits[-1]
+    coords = tf.constant(np.random.rand(nvert, 2), dtype='float32')
+    #rounded to have ties
+    hier = tf.constant(np.round(np.random.rand(nvert, 1)*20.), dtype='float32')
+    row_splits = tf.constant(row_splits, dtype='int32')
+    neighs,_ = SelectKnn(K = K, coords=coords,  row_splits=row_splits, tf_compatible=False,max_radius=0.1)
+    return neighs, hier, row_splits
+
+for rs in [[0, 1000], [0, 300, 300, 2000, 2001, 5000], [0] + list(range(50, 10001, 50))]:
+    neighs, hier, row_splits = make_data(rs, 10)
+    rs_a, sel_a, bg_a = LocalCluster(neighs, sorted_hierarchy_idxs(hier, row_splits), row_splits)
+    rs_b, sel_b, bg_b = LocalClusterHierarchy(neighs, hier, row_splits)
+    assert np.all(rs_a.numpy() == rs_b.numpy()), 'row splits differ'
+    assert np.all(sel_a.numpy() == sel_b.numpy()), 'selection differs'
+    assert np.all(bg_a.numpy() == bg_b.numpy()), 'back gather indices differ'
+print('LocalCluster and LocalClusterHierarchy agree')
+
+neighs, hier, row_splits = make_data([0] + list(range(20000, 400001, 20000)), 10)
+LocalClusterHierarchy(neighs, hier, row_splits)
+t0 = time.time()
+LocalCluster(neighs, sorted_hierarchy_idxs(hier, row_splits), row_splits)
+t1 = time.time()
+LocalClusterHierarchy(neighs, hier, row_splits)
+t2 = time.time()
+print('python sort + LocalCluster', t1-t0, 's, LocalClusterHierarchy', t2-t1, 's')
@@ -0,0 +1,85 @@
+import numpy as np
+import awkward0
+import sys
+
+from datastructures.TrainData_OC import TrainData_OC
+
+'''
+checks the chunked conversion of TrainData_OC with block sizes that are not
+aligned with the baskets:
+- on a synthetic tree that returns block reads like uproot3, with the content
+  starting before entrystart, at a different position for each branch
+- if a source file is given as argument, against the full conversion
+  (base_convertFromSourceFile) of this file
+'''
+
+np.random.seed(5)
+
+class BlockTree(object):
+    '''
+    returns jagged arrays whose content starts at a random basket boundary before entrystart
+    '''
+    def __init__(self, branches):
+        self.branches = branches
+        self.numentries = branches['recHitEnergy'].shape[0]
+
+    def arrays(self, branches, entrystart, entrystop, namedecode=None):
+        out = {}
+        for b in branches:
+            a = self.branches[b]
+            basket_start = np.random.randint(0, a.starts[entrystart] + 1)
+            out[b] = awkward0.JaggedArray(a.starts[entrystart:entrystop] - basket_start,
+                                          a.stops[entrystart:entrystop] - basket_start,
+                                          a.content[basket_start:])
+        return out
+
+
+def make_branches(n_events, n_classes=4):
+    counts = np.random.randint(0, 60, size=n_events)
+    n_hits = np.sum(counts)
+    branches = {}
+    for b in set(TrainData_OC.feature_branches + TrainData_OC.truth_branches):
+        if b == 'truthHitAssignedPIDs':
+            content = np.eye(n_classes)[np.random.randint(0, n_classes, size=n_hits)]
+        else:
+            content = np.random.rand(n_hits).astype('float32')
+        branches[b] = awkward0.JaggedArray.fromcounts(counts, content)
+    branches['recHitEnergy'] = awkward0.JaggedArray.fromcounts(
+        counts, np.where(np.random.rand(n_hits) < 0.2, 0., np.random.rand(n_hits)).astype('float32'))
+    branches['recHitID'] = awkward0.JaggedArray.fromcounts(
+        counts, np.where(np.random.rand(n_hits) < 0.1, -1., 0.).astype('float32'))
+    return branches
+
+
+def reference(td, branches, removeTracks):
+    selection = td.hitSelection(branches['recHitEnergy'], branches['recHitID'], removeTracks)
+    features = np.stack([branches[b][selection].flatten() for b in td.feature_branches], axis=1)
+    truth = np.stack([np.argmax(branches[b][selection].flatten(), axis=-1) if b == 'truthHitAssignedPIDs'
+                      else branches[b][selection].flatten() for b in td.truth_branches], axis=1)
+    rs = np.concatenate([[0], np.cumsum(selection.sum())])
+    return features, truth.astype('float32'), rs
+
+
+td = TrainData_OC()
+branches = make_branches(101)
+for removeTracks in [True, False]:
+    f_ref, t_ref, rs_ref = reference(td, branches, removeTracks)
+    for chunk_events in [1, 7, 33, 100, 1000]:
+        f, t, rs = td.convertChunked(BlockTree(branches), removeTracks, chunk_events)
+        assert np.all(rs == rs_ref), ('row splits differ', chunk_events)
+        assert np.all(f == f_ref), ('features differ', chunk_events)
+        assert np.all(t == t_ref), ('truth differs', chunk_events)
+print('chunked conversion agrees with the masked jagged arrays')
+
+if len(sys.argv) > 1:
+    def convert(chunk_events):
+        td = TrainData_OC()
+        td.conversion_chunk_events = chunk_events
+        td.readFromSourceFile(sys.argv[1], {}, True)
+        return td.transferFeatureListToNumpy() + td.transferTruthListToNumpy()
+
+    full = convert(0)
+    for chunk_events in [7, 33, 101]:
+        for a, b in zip(full, convert(chunk_events)):
+            assert np.all(a == b), ('differs from the full conversion', chunk_events)
+    print('chunked conversion agrees with the full conversion of', sys.argv[1])
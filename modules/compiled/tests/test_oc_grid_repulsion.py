@@ -0,0 +1,54 @@
+import tensorflow as tf
+import numpy as np
+import time
+
+from object_condensation import oc_loss
+
+'''
+compares the grid based repulsive term of the object condensation loss
+to the dense K x V evaluation, values and gradients
+'''
+
+np.random.seed(1)
+
+def make_inputs(nvert, nobj, ncoords, spread):
+    row_splits = tf.constant([0, nvert//3, nvert], dtype='int32')
+    x = tf.constant(np.random.rand(nvert, ncoords) * spread, dtype='float32')
+    beta = tf.constant(np.random.rand(nvert, 1) * 0.98 + 0.01, dtype='float32')
+    truth_idx = tf.constant(np.random.randint(-1, nobj, size=(nvert, 1)), dtype='float32')
+    payload = tf.constant(np.random.rand(nvert, 2), dtype='float32')
+    return x, beta, truth_idx, row_splits, payload
+
+
+def loss_and_grads(x, beta, truth_idx, row_splits, payload, **kwargs):
+    with tf.GradientTape() as tape:
+        tape.watch([x, beta])
+        att, rep, noise, min_b, pll, tmb = oc_loss(x, beta, truth_idx, row_splits, tf.zeros_like(beta), payload,
+                                                   **kwargs)
+    grads = tape.gradient(rep, [x, beta])
+    return rep.numpy(), [g.numpy() for g in grads]
+
+
+def compare(nvert, nobj, ncoords, spread, **kwargs):
+    inputs = make_inputs(nvert, nobj, ncoords, spread)
+    rep_dense, grads_dense = loss_and_grads(*inputs, grid_repulsion=False, **kwargs)
+    rep_grid, grads_grid = loss_and_grads(*inputs, grid_repulsion=True, **kwargs)
+    assert np.allclose(rep_dense, rep_grid, rtol=1e-4, atol=1e-7), ('repulsion differs', rep_dense, rep_grid)
+    for gd, gg in zip(grads_dense, grads_grid):
+        assert np.allclose(gd, gg, rtol=1e-4, atol=1e-6), 'gradients differ'
+
+
+for ncoords in [1, 2, 3, 4]:
+    for spread in [0.5, 3., 20.]:
+        compare(600, 20, ncoords, spread)
+        compare(600, 20, ncoords, spread, alt_potential_norm=True)
+        compare(600, 20, ncoords, spread, use_average_cc_pos=True)
+print('grid and dense repulsion agree')
+
+
+x, beta, truth_idx, row_splits, payload = make_inputs(30000, 500, 3, 30.)
+for grid in [False, True]:
+    oc_loss(x, beta, truth_idx, row_splits, tf.zeros_like(beta), payload, grid_repulsion=grid)
+    t0 = time.time()
+    oc_loss(x, beta, truth_idx, row_splits, tf.zeros_like(beta), payload, grid_repulsion=grid)
+    print('grid' if grid else 'dense', 'time', time.time() - t0)
@@ -0,0 +1,71 @@
+import tensorflow as tf
+import numpy as np
+
+from object_condensation import oc_loss
+
+'''
+compares the batched object condensation loss (all events at once) to the
+loop over the events, all terms and their gradients
+'''
+
+np.random.seed(3)
+
+def make_inputs(event_sizes, ncoords=3, noise_events=[], spectators=False):
+    row_splits = np.concatenate([[0], np.cumsum(event_sizes)])
+    nvert = row_splits[-1]
+    truth_idx = np.zeros((nvert, 1))
+    for b in range(len(event_sizes)):
+        ids = np.random.choice(1000, size=8, replace=False) #not contiguous
+        t = np.random.choice(np.concatenate([[-1], ids]), size=(event_sizes[b], 1))
+        if b in noise_events:
+            t[:] = -1
+        truth_idx[row_splits[b]:row_splits[b+1]] = t
+    is_spectator = np.zeros((nvert, 1))
+    if spectators:
+        is_spectator = (np.random.rand(nvert, 1) < 0.15) * 1.
+    return [tf.constant(np.random.rand(nvert, ncoords) * 2., dtype='float32'), # x
+            tf.constant(np.random.rand(nvert, 1) * 0.98 + 0.01, dtype='float32'), # beta
+            tf.constant(truth_idx, dtype='float32'),
+            tf.constant(row_splits, dtype='int32'),
+            tf.constant(is_spectator, dtype='float32'),
+            tf.constant(np.random.rand(nvert, 2), dtype='float32'), # payload loss
+            tf.constant(np.random.rand(nvert, 1) + 0.5, dtype='float32')] # energy weights
+
+
+def loss_and_grads(x, beta, truth_idx, row_splits, is_spectator, payload, energyweights, **kwargs):
+    with tf.GradientTape(persistent=True) as tape:
+        tape.watch([x, beta, payload, energyweights])
+        terms = oc_loss(x, beta, truth_idx, row_splits, is_spectator, payload,
+                        energyweights=energyweights, **kwargs)
+    grads = [tape.gradient(t, [x, beta, payload, energyweights],
+                           unconnected_gradients=tf.UnconnectedGradients.ZERO) for t in terms]
+    return [t.numpy() for t in terms], [[g.numpy() for g in gs] for gs in grads]
+
+
+names = ['attractive', 'repulsive', 'noise', 'beta', 'payload', 'too much beta']
+
+def compare(inputs, **kwargs):
+    terms_loop, grads_loop = loss_and_grads(*inputs, batched=False, **kwargs)
+    terms_batch, grads_batch = loss_and_grads(*inputs, batched=True, **kwargs)
+    for name, tl, tb, gl, gb in zip(names, terms_loop, terms_batch, grads_loop, grads_batch):
+        assert tl.shape == tb.shape, (name, kwargs, 'shapes differ', tl.shape, tb.shape)
+        assert np.allclose(tl, tb, rtol=1e-4, atol=1e-6), (name, kwargs, 'differs', tl, tb)
+        for a, b in zip(gl, gb):
+            assert np.allclose(a, b, rtol=1e-3, atol=1e-5), (name, kwargs, 'gradients differ')
+
+
+options = [{},
+           {'alt_potential_norm': True},
+           {'cont_beta_loss': True},
+           {'phase_transition': True},
+           {'use_average_cc_pos': True},
+           {'prob_repulsion': True},
+           {'alt_potential_norm': True, 'phase_transition': True, 'use_average_cc_pos': True}]
+
+for inputs in [make_inputs([300, 120, 500]),
+               make_inputs([200, 150, 80, 300], noise_events=[1, 3]),
+               make_inputs([400, 250], spectators=True),
+               make_inputs([100, 90, 300], ncoords=2, noise_events=[0], spectators=True)]:
+    for kwargs in options:
+        compare(inputs, **kwargs)
+print('batched and per event loss agree')
@@ -0,0 +1,63 @@
+import tensorflow as tf
+import numpy as np
+
+from lossLayers import LLFullObjectCondensation
+
+'''
+compares the loss values of LLFullObjectCondensation in eager mode
+and traced with tf.function (with unknown number of vertices and row splits)
+on a fixed batch
+'''
+
+np.random.seed(42)
+
+def make_batch(row_splits, n_ccoords=2, n_classes=3):
+    nvert = row_splits[-1]
+    truth_idx = np.zeros((nvert, 1), dtype='float32')
+    for b in range(len(row_splits) - 1):
+        nv = row_splits[b + 1] - row_splits[b]
+        truth_idx[row_splits[b]:row_splits[b + 1], 0] = np.random.randint(-1, 6, size=nv)
+
+    return [
+        tf.constant(np.random.rand(nvert, 1) * 0.98 + 0.01, dtype='float32'),  # pred beta
+        tf.constant(np.random.rand(nvert, n_ccoords), dtype='float32'),  # pred ccoords
+        tf.constant(np.random.rand(nvert, 1) * 10., dtype='float32'),  # pred energy
+        tf.constant(np.random.rand(nvert, 2) * 10., dtype='float32'),  # pred pos
+        tf.constant(np.random.rand(nvert, 1), dtype='float32'),  # pred time
+        tf.constant(np.random.rand(nvert, n_classes), dtype='float32'),  # pred id
+        tf.constant(truth_idx),  # truth idx
+        tf.constant(np.random.rand(nvert, 1) * 10., dtype='float32'),  # truth energy
+        tf.constant(np.random.rand(nvert, 2) * 10., dtype='float32'),  # truth pos
+        tf.constant(np.random.rand(nvert, 1) * 1e-9, dtype='float32'),  # truth time
+        tf.constant(np.random.randint(0, n_classes, size=(nvert, 1)), dtype='float32'),  # truth pid
+        tf.constant(row_splits, dtype='int32')
+    ]
+
+
+def compare(inputs, **kwargs):
+    layer = LLFullObjectCondensation(print_time=False, return_lossval=True, **kwargs)
+
+    _, eager_loss = layer(inputs)
+
+    signature = [tf.TensorSpec([None] + list(t.shape[1:]), t.dtype) for t in inputs]
+
+    @tf.function(input_signature=[signature])
+    def graph_loss(inputs):
+        _, lossval = layer(inputs)
+        return lossval
+
+    graph_lossval = graph_loss(inputs)
+
+    print(kwargs, 'eager', eager_loss.numpy(), 'graph', graph_lossval.numpy())
+    assert np.allclose(eager_loss.numpy(), graph_lossval.numpy(), rtol=1e-5, atol=1e-7), 'eager and graph loss differ'
+
+
+batch = make_batch([0, 200, 350, 1000])
+
+compare(batch)
+compare(batch, phase_transition=1.)
+compare(batch, cont_beta_loss=True)
+compare(batch, alt_potential_norm=True, use_average_cc_pos=True)
+compare(batch, prob_repulsion=True, print_loss=True)
+
+print('eager and graph loss agree')
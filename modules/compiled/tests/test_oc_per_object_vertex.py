@@ -0,0 +1,159 @@
+import tensorflow as tf
+import numpy as np
+
+from object_condensation import oc_per_batch_element
+
+'''
+compares oc_per_batch_element, which calculates all terms but the repulsive one
+per object vertex, to the previous dense K x V formulation (kept here as reference),
+all terms and their gradients
+'''
+
+np.random.seed(4)
+
+def dense_payload_weights(w, w2, threshold):
+    # K x V x 1, normalised in V
+    w = tf.clip_by_value(w, 0., 1.-1e-6)
+    w = w2*tf.math.atanh(w)**2
+    w = tf.math.divide_no_nan(w, tf.reduce_max(w, axis=1, keepdims=True))
+    if threshold>0:
+        w = tf.nn.relu(w-threshold)
+    return tf.math.divide_no_nan(w, tf.reduce_sum(w, axis=1, keepdims=True))
+
+
+def oc_dense_reference(beta, x, q_min, object_weights, truth_idx, is_spectator, payload_loss,
+                       S_B=1., payload_weight_threshold=0.8, use_mean_x=False, cont_beta_loss=False,
+                       prob_repulsion=False, phase_transition=False, alt_potential_norm=False):
+    beta_in = beta
+    beta = tf.clip_by_value(beta, 0.,1.-1e-4)
+    beta *= (1. - is_spectator)
+    q = tf.math.atanh(beta)**2 + q_min * (1. - is_spectator)
+
+    obj_ids,_ = tf.unique(tf.squeeze(truth_idx,axis=1))
+    obj_ids = obj_ids[obj_ids>-0.1]
+    K = tf.cast(obj_ids.shape[0], dtype='float32')
+    N = tf.cast(beta.shape[0], dtype='float32')
+    obj_ids = tf.expand_dims(obj_ids, axis=1)
+    is_noise = tf.where(truth_idx<0., tf.zeros_like(truth_idx), 1.)
+
+    M = tf.expand_dims(obj_ids, axis=1) - tf.expand_dims(truth_idx, axis=0) # K x V x 1
+    M_not = tf.where(tf.abs(M) > 0.1, tf.zeros_like(M) + 1., tf.zeros_like(M))
+    M = tf.where(tf.abs(M) < 0.1, tf.zeros_like(M) + 1., tf.zeros_like(M))
+    N_per_obj = tf.reduce_sum(M, axis=1) # K x 1
+
+    kalpha = tf.argmax(M * tf.expand_dims(beta_in, axis=0), axis=1)[:,0] # K
+    gather = lambda v: tf.expand_dims(tf.gather(v, kalpha), axis=1) # K x 1 x X
+
+    x_kalpha = gather(x)
+    if use_mean_x:
+        x_kalpha = tf.reduce_sum(M * tf.expand_dims(q, axis=0) * tf.expand_dims(x,axis=0), axis=1, keepdims=True)
+        x_kalpha = tf.math.divide_no_nan(x_kalpha, tf.reduce_sum(M * tf.expand_dims(q, axis=0), axis=1, keepdims=True))
+    q_kalpha = gather(q)
+    beta_kalpha = gather(beta_in)
+    object_weights_kalpha = gather(object_weights)
+
+    distancesq = tf.reduce_sum((x_kalpha - tf.expand_dims(x, axis=0)) ** 2, axis=-1, keepdims=True) # K x V x 1
+
+    def mean_N_K(v):
+        return tf.math.divide_no_nan(tf.reduce_sum(v, axis=[0,1]), tf.expand_dims(N*K, axis=0))
+
+    V_att = object_weights_kalpha * M * q_kalpha * tf.expand_dims(q, axis=0) * distancesq
+    if alt_potential_norm:
+        V_att = tf.math.divide_no_nan(tf.reduce_sum(V_att,axis=1), N_per_obj)
+        V_att = tf.math.divide_no_nan(tf.reduce_sum(V_att,axis=0), K)
+    else:
+        V_att = mean_N_K(V_att)
+
+    if prob_repulsion:
+        V_rep = -2.*tf.math.log(1.-tf.math.exp(-distancesq/2.)+1e-5)
+    else:
+        V_rep = tf.nn.relu(1. - tf.sqrt(distancesq + 1e-4))
+    V_rep = object_weights_kalpha * V_rep * M_not * q_kalpha * tf.expand_dims(q, axis=0)
+    if alt_potential_norm:
+        V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=1),
+                                      tf.expand_dims(tf.expand_dims(N,axis=0),axis=0)-N_per_obj)
+        V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=0), K)
+    else:
+        V_rep = mean_N_K(V_rep)
+
+    beta_kalpha_sm = beta_kalpha
+    if cont_beta_loss:
+        b_exp = M * tf.expand_dims(beta, axis=0)
+        meanb = tf.math.divide_no_nan(tf.reduce_sum(b_exp, axis = 1, keepdims=True),
+                                      tf.reduce_sum(M,  axis = 1, keepdims=True))
+        sqsum = tf.reduce_sum(b_exp**2, axis = 1, keepdims=True)
+        beta_kalpha_sm = 1. - (tf.math.divide_no_nan(meanb+0.2, beta_kalpha+0.1) + tf.math.exp(-sqsum))
+
+    B_pen = 0.
+    if phase_transition:
+        B_pen = - object_weights_kalpha * M * beta_kalpha * 1./(20*distancesq + 1.)
+        B_pen = tf.where(distancesq==0. , 0., B_pen)
+        B_pen = tf.math.divide_no_nan(tf.reduce_sum(B_pen,axis=1), N_per_obj)
+        B_pen = tf.math.divide_no_nan(tf.reduce_sum(B_pen,axis=0), K)
+    else:
+        B_pen += tf.math.divide_no_nan(tf.reduce_sum(object_weights_kalpha*(1. - beta_kalpha_sm)),
+                                       tf.reduce_sum(object_weights_kalpha))
+
+    to_much_B_pen = tf.constant([0.],dtype='float32')
+    if not cont_beta_loss:
+        to_much_B_pen = tf.reduce_sum( beta_in*object_weights ) - tf.reduce_sum(object_weights_kalpha)
+        to_much_B_pen = tf.math.divide_no_nan(tf.nn.relu(to_much_B_pen),tf.reduce_sum(object_weights))
+
+    Noise_pen = S_B*tf.math.divide_no_nan(tf.reduce_sum(is_noise * beta_in), tf.reduce_sum(is_noise))
+
+    p_w = object_weights_kalpha * dense_payload_weights(M * tf.expand_dims(beta,axis=0),
+                                                        tf.expand_dims(object_weights,axis=0),
+                                                        payload_weight_threshold)
+    pll = tf.math.divide_no_nan(tf.reduce_sum(p_w * tf.expand_dims(payload_loss, axis=0),axis=[0,1]), K)
+
+    return V_att, V_rep, Noise_pen, B_pen, pll, to_much_B_pen
+
+
+def make_inputs(nvert, nobj, spectators):
+    truth_idx = np.random.choice(np.concatenate([[-1], np.random.choice(100, size=nobj, replace=False)]),
+                                 size=(nvert, 1))
+    is_spectator = (np.random.rand(nvert, 1) < 0.15) * 1. if spectators else np.zeros((nvert, 1))
+    return [tf.constant(np.random.rand(nvert, 1) * 0.98 + 0.01, dtype='float32'), # beta
+            tf.constant(np.random.rand(nvert, 3) * 2., dtype='float32'), # x
+            0.1, # q_min
+            tf.constant(np.random.rand(nvert, 1) + 0.5, dtype='float32'), # object weights
+            tf.constant(truth_idx, dtype='float32'),
+            tf.constant(is_spectator, dtype='float32'),
+            tf.constant(np.random.rand(nvert, 2), dtype='float32')] # payload loss
+
+
+def loss_and_grads(func, inputs, **kwargs):
+    watched = [inputs[0], inputs[1], inputs[3], inputs[6]]
+    with tf.GradientTape(persistent=True) as tape:
+        tape.watch(watched)
+        terms = func(*inputs, **kwargs)
+    grads = [tape.gradient(t, watched, unconnected_gradients=tf.UnconnectedGradients.ZERO) for t in terms]
+    return [np.array(t) for t in terms], [[g.numpy() for g in gs] for gs in grads]
+
+
+names = ['attractive', 'repulsive', 'noise', 'beta', 'payload', 'too much beta']
+
+def compare(inputs, **kwargs):
+    terms_ref, grads_ref = loss_and_grads(oc_dense_reference, inputs, **kwargs)
+    terms, grads = loss_and_grads(oc_per_batch_element, inputs, **kwargs)
+    for name, tr, t, gr, g in zip(names, terms_ref, terms, grads_ref, grads):
+        assert tr.shape == t.shape, (name, kwargs, 'shapes differ', tr.shape, t.shape)
+        assert np.allclose(tr, t, rtol=1e-4, atol=1e-6), (name, kwargs, 'differs', tr, t)
+        for a, b in zip(gr, g):
+            assert np.allclose(a, b, rtol=1e-3, atol=1e-5), (name, kwargs, 'gradients differ')
+
+
+options = [{},
+           {'alt_potential_norm': True},
+           {'cont_beta_loss': True},
+           {'phase_transition': True},
+           {'use_mean_x': True},
+           {'prob_repulsion': True},
+           {'payload_weight_threshold': 0.},
+           {'alt_potential_norm': True, 'cont_beta_loss': True, 'phase_transition': True}]
+
+for nvert, nobj, spectators in [(300, 10, False), (800, 40, True), (50, 1, False), (200, 0, True)]:
+    inputs = make_inputs(nvert, nobj, spectators)
+    for kwargs in options:
+        compare(inputs, **kwargs)
+print('per object vertex terms agree with the dense formulation')
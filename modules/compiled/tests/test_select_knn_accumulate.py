@@ -0,0 +1,96 @@
+import tensorflow as tf
+import numpy as np
+import time
+
+from select_knn_op import SelectKnn
+from accknn_op import AccumulateKnn
+from select_knn_accumulate_op import SelectKnnAccumulate
+
+'''
+compares SelectKnnAccumulate to SelectKnn followed by AccumulateKnn,
+and its gradients to a plain tensorflow implementation with the same neighbours
+'''
+
+np.random.seed(5)
+
+K = 12
+scale = 10.
+
+def separate(coords, feat, rs, max_radius=-1.):
+    idx, dist = SelectKnn(K, coords, rs, max_radius=max_radius, tf_compatible=False, binned=True)
+    f, maxidx = AccumulateKnn(scale*dist[:,1:], feat, idx[:,1:])
+    return f, maxidx, idx[:,1:], dist[:,1:]
+
+def tf_reference(coords, feat, idx):
+    #no -1 padding here
+    nidx = tf.expand_dims(idx, axis=2)
+    distsq = tf.reduce_sum((tf.expand_dims(coords, axis=1) - tf.gather_nd(coords, nidx))**2, axis=-1)
+    wfeat = tf.gather_nd(feat, nidx) * tf.expand_dims(tf.exp(-scale*distsq), axis=2)
+    return tf.concat([tf.reduce_mean(wfeat, axis=1), tf.reduce_max(wfeat, axis=1)], axis=-1), distsq
+
+for rs, max_radius in [([0, 500], -1.), ([0, 200, 1200, 3000], -1.), ([0, 5, 1000], 0.1)]:
+    nvert = rs[-1]
+    coords = tf.constant(np.random.rand(nvert, 3), dtype='float32')
+    feat = tf.constant(np.random.rand(nvert, 70), dtype='float32')
+    rs = tf.constant(rs, dtype='int32')
+
+    f_a, maxidx_a, idx_a, dist_a = separate(coords, feat, rs, max_radius)
+    f_b, maxidx_b, idx_b, dist_b = SelectKnnAccumulate(K, coords, feat, rs, distance_scale=scale,
+                                                       max_radius=max_radius, return_neighbours=True)
+    assert np.all(f_a.numpy() == f_b.numpy()), 'features differ'
+    assert np.all(maxidx_a.numpy() == maxidx_b.numpy()), 'max indices differ'
+    assert np.all(idx_a.numpy() == idx_b.numpy()), 'indices differ'
+    assert np.all(dist_a.numpy() == dist_b.numpy()), 'distances differ'
+
+    f_c, _, idx_c, dist_c = SelectKnnAccumulate(K, coords, feat, rs, distance_scale=scale, max_radius=max_radius)
+    assert np.all(f_a.numpy() == f_c.numpy()), 'features differ without neighbours'
+    assert idx_c.shape[1] == 0 and dist_c.shape[1] == 0
+print('SelectKnnAccumulate agrees with SelectKnn and AccumulateKnn')
+
+nvert = 2000
+coords = tf.constant(np.random.rand(nvert, 3), dtype='float32')
+feat = tf.constant(np.random.rand(nvert, 16), dtype='float32')
+rs = tf.constant([0, 800, nvert], dtype='int32')
+gf = tf.constant(np.random.rand(nvert, 32), dtype='float32')
+gd = tf.constant(np.random.rand(nvert, K-1), dtype='float32')
+
+with tf.GradientTape(persistent=True) as tape:
+    tape.watch(coords)
+    tape.watch(feat)
+    f, _, idx, dist = SelectKnnAccumulate(K, coords, feat, rs, distance_scale=scale, return_neighbours=True)
+    loss = tf.reduce_sum(f*gf) + tf.reduce_sum(dist*gd)
+    f_ref, dist_ref = tf_reference(coords, feat, tf.stop_gradient(idx))
+    loss_ref = tf.reduce_sum(f_ref*gf) + tf.reduce_sum(dist_ref*gd)
+
+for x, name in [(coords, 'coordinate'), (feat, 'feature')]:
+    g = tape.gradient(loss, x).numpy()
+    g_ref = tape.gradient(loss_ref, x).numpy()
+    assert np.allclose(g, g_ref, rtol=1e-3, atol=1e-4), name+' gradients differ'
+
+#without the neighbours, only the gradients from the features
+with tf.GradientTape(persistent=True) as tape:
+    tape.watch(coords)
+    tape.watch(feat)
+    f, _, _, _ = SelectKnnAccumulate(K, coords, feat, rs, distance_scale=scale)
+    loss = tf.reduce_sum(f*gf)
+    f_ref, _ = tf_reference(coords, feat, tf.stop_gradient(idx))
+    loss_ref = tf.reduce_sum(f_ref*gf)
+
+for x, name in [(coords, 'coordinate'), (feat, 'feature')]:
+    g = tape.gradient(loss, x).numpy()
+    g_ref = tape.gradient(loss_ref, x).numpy()
+    assert np.allclose(g, g_ref, rtol=1e-3, atol=1e-4), name+' gradients differ without neighbours'
+print('gradients agree with the tensorflow reference')
+
+nvert = 200000
+coords = tf.constant(np.random.rand(nvert, 4), dtype='float32')
+feat = tf.constant(np.random.rand(nvert, 32), dtype='float32')
+rs = tf.constant([0, nvert//2, nvert], dtype='int32')
+for K in [64, 128]:
+    separate(coords, feat, rs)
+    t0 = time.time()
+    separate(coords, feat, rs)
+    t1 = time.time()
+    SelectKnnAccumulate(K, coords, feat, rs, distance_scale=scale)
+    t2 = time.time()
+    print('K', K, 'SelectKnn + AccumulateKnn', t1-t0, 's, SelectKnnAccumulate', t2-t1, 's')
@@ -0,0 +1,48 @@
+import tensorflow as tf
+import numpy as np
+
+from select_knn_op import SelectKnn
+from knn_recall import knn_recall_scan
+
+'''
+checks the approximate binned SelectKnn (max_shells >= 0): a large shell limit
+gives the exact result, and the recall does not decrease with more shells.
+Prints the recall and timing for a few shell limits
+'''
+
+np.random.seed(6)
+
+K = 16
+
+for ncoords in [3, 4]:
+    nvert = 20000
+    coords = tf.constant(np.random.rand(nvert, ncoords), dtype='float32')
+    rs = tf.constant([0, 5000, nvert], dtype='int32')
+
+    idx_exact, dist_exact = SelectKnn(K, coords, rs, tf_compatible=False, binned=True)
+    idx_big, dist_big = SelectKnn(K, coords, rs, tf_compatible=False, binned=True, max_shells=1000)
+    assert np.all(idx_exact.numpy() == idx_big.numpy()), 'indices differ for large max_shells'
+    assert np.all(dist_exact.numpy() == dist_big.numpy()), 'distances differ for large max_shells'
+
+    results = knn_recall_scan(K, coords, rs, max_shells=[0, 1, 2, 1000])
+    recalls = [r['mean_recall'] for r in results]
+    assert np.all(np.diff(recalls) >= 0), 'recall decreases with more shells'
+    assert recalls[-1] == 1.
+    for r in results:
+        print(ncoords, 'coordinates', r)
+
+#padded neighbour lists: radius and a row split with fewer than K vertices
+coords = tf.constant(np.random.rand(6010, 3), dtype='float32')
+rs = tf.constant([0, 10, 6000, 6010], dtype='int32')
+for max_radius in [-1., 0.05]:
+    results = knn_recall_scan(K, coords, rs, max_shells=[0, 1000], max_radius=max_radius)
+    assert results[-1]['mean_recall'] == 1. and results[-1]['min_recall'] == 1., ('padded recall', results[-1])
+    assert results[-1]['complete_fraction'] == 1.
+    print('max_radius', max_radius, results[0])
+print('approximate SelectKnn is consistent with the exact search')
+
+nvert = 200000
+coords = tf.constant(np.random.rand(nvert, 4), dtype='float32')
+rs = tf.constant([0, nvert//2, nvert], dtype='int32')
+for r in knn_recall_scan(64, coords, rs, max_shells=[0, 1, 2], n_repeat=3):
+    print('K 64', r)
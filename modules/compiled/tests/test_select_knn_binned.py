@@ -0,0 +1,86 @@
+import tensorflow as tf
+import numpy as np
+
+import time
+from select_knn_op import SelectKnn
+
+'''
+compares the binned CPU implementation of SelectKnn to the brute-force one.
+The binned version returns the neighbours sorted by distance, the brute-force
+one does not, so the rows are sorted before comparing.
+With ties at the largest selected distance (quantised coordinates), only the
+distances and the neighbours closer than that are the same. The default
+(binned=False) gives the unsorted brute-force output.
+'''
+
+def sort_rows(idx, dist):
+    idx = idx.numpy()
+    dist = dist.numpy()
+    order = np.lexsort((idx, dist), axis=-1)
+    return np.take_along_axis(idx, order, axis=-1), np.take_along_axis(dist, order, axis=-1)
+
+
+def compare(nvert, ncoords, K, max_radius=-1., mask_mode='none', mask_logic='xor'):
+    coords = tf.constant(np.random.rand(nvert, ncoords), dtype='float32')
+    row_splits = tf.constant([0, nvert//3, nvert], dtype='int32')
+    masking_values = None
+    if mask_mode != 'none':
+        masking_values = tf.constant(np.random.rand(nvert, 1), dtype='float32')
+
+    with tf.device('/cpu:0'):
+        res = []
+        for binned in [False, True]:
+            idx, dist = SelectKnn(K, coords, row_splits, masking_values=masking_values,
+                                  max_radius=max_radius, tf_compatible=False,
+                                  mask_mode=mask_mode, mask_logic=mask_logic, binned=binned)
+            res.append(sort_rows(idx, dist))
+
+    assert np.all(res[0][0] == res[1][0]), 'indices differ'
+    assert np.all(res[0][1] == res[1][1]), 'distances differ'
+
+
+for ncoords in [1, 2, 3, 4, 6]:
+    for K in [1, 5, 40]:
+        compare(2000, ncoords, K)
+        compare(2000, ncoords, K, max_radius=0.1)
+        for mm in ['acc', 'scat']:
+            for ml in ['xor', 'and']:
+                compare(2000, ncoords, K, mask_mode=mm, mask_logic=ml)
+                compare(2000, ncoords, K, max_radius=0.1, mask_mode=mm, mask_logic=ml)
+print('binned and brute-force SelectKnn agree')
+
+
+def compare_ties(nvert, ncoords, K):
+    coords = tf.constant(np.round(np.random.rand(nvert, ncoords) * 4.) / 4., dtype='float32')
+    row_splits = tf.constant([0, nvert//3, nvert], dtype='int32')
+    with tf.device('/cpu:0'):
+        idx_d, dist_d = SelectKnn(K, coords, row_splits, tf_compatible=False)
+        idx_b, dist_b = SelectKnn(K, coords, row_splits, tf_compatible=False, binned=False)
+        idx_g, dist_g = SelectKnn(K, coords, row_splits, tf_compatible=False, binned=True)
+
+    assert np.all(idx_d.numpy() == idx_b.numpy()), 'default indices differ from brute-force (unsorted)'
+    assert np.all(dist_d.numpy() == dist_b.numpy()), 'default distances differ from brute-force (unsorted)'
+
+    idx_b, dist_b = sort_rows(idx_b, dist_b)
+    idx_g, dist_g = sort_rows(idx_g, dist_g)
+    assert np.all(dist_b == dist_g), 'distances differ with ties'
+    below_max = dist_b < np.max(dist_b, axis=-1, keepdims=True)
+    assert np.all(np.where(below_max, idx_b == idx_g, True)), 'indices below the largest distance differ'
+    return np.mean(np.any(idx_b != idx_g, axis=-1))
+
+
+for ncoords in [2, 3]:
+    for K in [5, 40]:
+        frac = compare_ties(2000, ncoords, K)
+        print(ncoords, 'coordinates, K', K, ': fraction of rows with different tie choices', frac)
+print('binned and brute-force SelectKnn agree up to ties at the largest distance')
+
+
+coords = tf.constant(np.random.rand(100000, 4), dtype='float32')
+row_splits = tf.constant([0, 50000, 100000], dtype='int32')
+with tf.device('/cpu:0'):
+    for binned in [False, True]:
+        SelectKnn(64, coords, row_splits, binned=binned)
+        t0 = time.time()
+        SelectKnn(64, coords, row_splits, binned=binned)
+        print('binned' if binned else 'brute-force', 'time', time.time()-t0)
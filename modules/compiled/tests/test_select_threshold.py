@@ -1,4 +1,5 @@
 
+
 import tensorflow as tf
 from select_threshold_op import SelectThreshold
 import numpy as np
@@ -6,6 +7,21 @@ import time
 
 # SelectThreshold(x, pl, rowsplits, threshold=0.5)
 
+def reference(xs, pl, rs, threshold, hardness=20.):
+    '''
+    straight forward numpy implementation, loops over the row splits
+    '''
+    xs, pl, rs = xs.numpy(), pl.numpy(), rs.numpy()
+    threshold = min(min([np.max(xs[rs[i]:rs[i+1]]) for i in range(len(rs)-1)]) - 1e-6, threshold)
+    weight = 1./(1. + np.exp(-hardness*(xs - 4.6/hardness - threshold)))
+    idxs = []
+    newrs = [0]
+    for i in range(len(rs)-1):
+        sel = [j for j in range(rs[i], rs[i+1]) if xs[j,0] >= threshold]
+        idxs += sel
+        newrs.append(len(idxs))
+    return (weight*pl)[idxs], np.array(newrs), np.array(idxs)
+
 
 nvert=10000
 nfeat=128
@@ -15,13 +31,23 @@ xs = tf.reshape(xs, [-1,1])
 rs = tf.constant([0,int(nvert/4),int(nvert/2),nvert],dtype='int32')
 pl = tf.constant( np.random.rand(nvert,nfeat) ,dtype='float32')
 
-print(xs, pl, rs)
+for threshold in [0.5, 0.99]:
+    #the second row split is below the threshold and keeps (at least) one vertex
+    xs_low = tf.concat([xs[:int(nvert/4)], xs[int(nvert/4):int(nvert/2)]*0.5, xs[int(nvert/2):]], axis=0)
+    for x in [xs, xs_low]:
+        newfeat, newrs, scatter_idxs, tvals = SelectThreshold(x,pl,rs,threshold=threshold)
+        ref_feat, ref_rs, ref_idxs = reference(x, pl, rs, threshold)
+        assert np.all(newrs.numpy() == ref_rs), 'row splits differ'
+        assert np.all(np.diff(newrs.numpy()) > 0), 'empty row split'
+        assert np.all(scatter_idxs.numpy()[:,0] == ref_idxs), 'indices differ'
+        assert np.allclose(newfeat.numpy(), ref_feat, rtol=1e-5, atol=1e-6), 'weighted features differ'
+print('SelectThreshold agrees with the reference')
 
-newfeat, newrs, scatter_idxs = SelectThreshold(xs,pl,rs,threshold=0.5)
+newfeat, newrs, scatter_idxs, tvals = SelectThreshold(xs,pl,rs,threshold=0.5)
 
 bef = time.time()
 for  _ in range(20):
-    newfeat, newrs, scatter_idxs = SelectThreshold(xs,pl,rs,threshold=0.5)
+    newfeat, newrs, scatter_idxs, tvals = SelectThreshold(xs,pl,rs,threshold=0.5)
 totaltime = time.time() - bef
 
 
@@ -32,4 +58,4 @@ print(newfeat, rs, scatter_idxs)
 print('scattered back')
 print(tf.scatter_nd(scatter_idxs, newfeat ,shape=pl.shape))
 
-print('total time', totaltime)
\ No newline at end of file
+print('total time', totaltime)
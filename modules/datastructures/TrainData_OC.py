@@ -6,16 +6,308 @@ from DeepJetCore.compiled.c_simpleArray import simpleArray
 import numpy as np
 import uproot3 as uproot
 from numba import jit
-import ROOT
 import os
 import pickle
 import gzip
+import json
+import zlib
 import tensorflow as tf
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+
+def _convert_file_worker(args):
+    '''
+    converts one source file to one output file, used by convertFileList
+    '''
+    td_class, infile, outfile, chunk_events, columnar = args
+    td = td_class()
+    td.conversion_chunk_events = chunk_events
+    td.readFromSourceFile(infile, {}, True)
+    td.writeToFile(outfile)
+    if columnar:
+        td.writeColumnar(os.path.splitext(outfile)[0] + '.columnar')
+    return outfile
+
+
+class ColumnarArrays(object):
+    '''
+    Read access to the columnar layout written by TrainData_OC.writeColumnar.
+    Each array is a raw contiguous buffer that is opened with np.memmap, the
+    row splits (event offsets) are read fully. Selecting an event only reads
+    the hits of this event from disk.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.n_events = index['n_events']
+        self.features = [self._open(e) for e in index['features']]
+        self.truth = [self._open(e) for e in index['truth']]
+    
+    def _open(self, entry):
+        shape = tuple(entry['shape'])
+        if shape[0] == 0: #empty files cannot be mapped
+            data = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            data = np.memmap(os.path.join(self.path, entry['data']), dtype=entry['dtype'],
+                             mode='r', shape=shape)
+        rs = np.load(os.path.join(self.path, entry['rowsplits']))
+        return data, rs
+    
+    def nElements(self):
+        return self.n_events
+    
+    def _select(self, arrays, events):
+        out = []
+        for data, rs in arrays:
+            out.append(np.concatenate([data[rs[i]:rs[i+1]] for i in events], axis=0))
+        return out
+    
+    def getEvents(self, events):
+        '''
+        returns the feature arrays, the truth arrays (as in-memory numpy arrays)
+        and the row splits of the selected events, in the order given
+        '''
+        for i in events:
+            if i < 0 or i >= self.n_events:
+                raise IndexError("Event wrongly selected")
+        rs = self.features[0][1]
+        counts = np.array([rs[i+1]-rs[i] for i in events], dtype='int64')
+        new_rs = np.concatenate([np.zeros(1, dtype='int64'), np.cumsum(counts)])
+        return self._select(self.features, events), self._select(self.truth, events), new_rs
+    
+    def getEvent(self, i):
+        feat, truth, _ = self.getEvents([i])
+        return feat, truth
+
+
+class ColumnarWriter(object):
+    '''
+    Writes the columnar layout read by ColumnarArrays. Blocks of events can be
+    appended one after the other, the row splits and the index are written by close().
+    '''
+    def __init__(self, outdir):
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self.outdir = outdir
+        self.rs = [np.zeros(1, dtype='int64')]
+        self.n_hits = 0
+        self.entries = None
+        self.files = []
+    
+    def _create(self, features, truth):
+        self.entries = {}
+        for group, arrays in [('features', features), ('truth', truth)]:
+            self.entries[group] = []
+            for i, a in enumerate(arrays):
+                name = group+'_'+str(i)
+                self.entries[group].append({'data': name+'.bin', 'rowsplits': name+'_rs.npy',
+                                            'dtype': a.dtype.str, 'shape': [0] + list(a.shape[1:])})
+                self.files.append(open(os.path.join(self.outdir, name+'.bin'), 'wb'))
+    
+    def append(self, features, truth, rs):
+        '''
+        appends the events defined by the row splits rs,
+        features and truth are lists of arrays with one entry per hit
+        '''
+        if self.entries is None:
+            self._create(features, truth)
+        for f, a, e in zip(self.files, list(features) + list(truth),
+                           self.entries['features'] + self.entries['truth']):
+            a = np.ascontiguousarray(a, dtype=e['dtype'])
+            a.tofile(f)
+            e['shape'][0] += a.shape[0]
+        self.rs.append(np.asarray(rs[1:], dtype='int64') + self.n_hits)
+        self.n_hits += int(rs[-1])
+    
+    def close(self):
+        for f in self.files:
+            f.close()
+        if self.entries is None:
+            self.entries = {'features': [], 'truth': []}
+        rs = np.concatenate(self.rs)
+        for e in self.entries['features'] + self.entries['truth']:
+            np.save(os.path.join(self.outdir, e['rowsplits']), rs)
+        with open(os.path.join(self.outdir, 'index.json'), 'w') as f:
+            json.dump({'n_events': rs.shape[0]-1, 'features': self.entries['features'],
+                       'truth': self.entries['truth']}, f)
+
+
+def _unpadded_row_splits(rs):
+    #row splits as returned by transferToNumpy: padded, the last entry is the number of row splits
+    rs = np.asarray(rs).reshape(-1)
+    return np.asarray(rs[:int(rs[-1])], dtype='int64')
+
+
+def _is_row_splits(a, offsets):
+    #padded row splits of the written events (can have the same length as the per-hit arrays)
+    if a.ndim == 2 and a.shape[1] == 1:
+        a = a[:, 0]
+    if a.ndim != 1 or a.shape[0] < offsets.shape[0] or a[-1] != offsets.shape[0]:
+        return False
+    return bool(np.all(a[:offsets.shape[0]] == offsets))
+
+
+def write_prediction_columns(outdir, predicted, features, truth, chunk_events=500, n_threads=4, level=6):
+    '''
+    Writes the prediction output (lists of arrays, as passed to writeOutPrediction) to outdir.
+    Each array is split into blocks of chunk_events events that are zlib compressed
+    in parallel with n_threads threads and written to one file each.
+    The event offsets (row splits) are taken from the first feature row splits.
+    Arrays that do not have one entry per hit are stored as one block: the interleaved
+    row splits of features and truth (odd entries), row splits in any group and
+    arrays of another length.
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    offsets = _unpadded_row_splits(features[1])
+    n_events = offsets.shape[0]-1
+    n_chunks = max(1, (n_events + chunk_events - 1) // chunk_events)
+    chunk_hits = offsets[np.minimum(np.arange(n_chunks+1) * chunk_events, n_events)]
+    
+    index = {'n_events': n_events, 'chunk_events': chunk_events, 'groups': {}}
+    blocks = []
+    for group, arrays in [('predicted', predicted), ('features', features), ('truth', truth)]:
+        entries = []
+        for i, a in enumerate(arrays):
+            a = np.asarray(a)
+            name = group+'_'+str(i)
+            per_hit = not (group != 'predicted' and i % 2 == 1) and a.ndim > 0 and a.shape[0] == offsets[-1] \
+                and not _is_row_splits(a, offsets)
+            entries.append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape), 'per_hit': per_hit})
+            if per_hit:
+                for c in range(n_chunks):
+                    blocks.append((os.path.join(outdir, name+'_'+str(c)+'.zz'),
+                                   a[chunk_hits[c]:chunk_hits[c+1]]))
+            else:
+                blocks.append((os.path.join(outdir, name+'.zz'), a))
+        index['groups'][group] = entries
+    
+    def write_block(block):
+        filename, a = block
+        with open(filename, 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(a).tobytes(), level))#releases the GIL
+    
+    with ThreadPool(n_threads) as pool:
+        pool.map(write_block, blocks, chunksize=1)
+    np.save(os.path.join(outdir, 'offsets.npy'), offsets)
+    #written last, so that incomplete outputs cannot be read
+    with open(os.path.join(outdir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+class PredictionColumns(object):
+    '''
+    Lazy read access to prediction files written by write_prediction_columns.
+    Only the blocks of the requested fields and events are read and decompressed.
+    '''
+    def __init__(self, path, n_threads=4):
+        self.path = path
+        self.n_threads = n_threads
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.n_events = index['n_events']
+        self.chunk_events = index['chunk_events']
+        self.groups = index['groups']
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        n_chunks = max(1, (self.n_events + self.chunk_events - 1) // self.chunk_events)
+        self.chunk_hits = self.offsets[np.minimum(np.arange(n_chunks+1) * self.chunk_events, self.n_events)]
+    
+    def nElements(self):
+        return self.n_events
+    
+    def _readBlock(self, entry, chunk=None):
+        filename = entry['name'] + ('.zz' if chunk is None else '_'+str(chunk)+'.zz')
+        with open(os.path.join(self.path, filename), 'rb') as f:
+            a = np.frombuffer(bytearray(zlib.decompress(f.read())), dtype=entry['dtype'])#writable
+        return a.reshape([-1] + entry['shape'][1:])
+    
+    def _readField(self, entry, chunks, pool):
+        if not entry['per_hit']:
+            return self._readBlock(entry)
+        blocks = pool.map(lambda c: self._readBlock(entry, c), chunks, chunksize=1)
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks, axis=0)
+    
+    def read(self, groups=None, fields=None):
+        '''
+        returns a dict with the same structure as the pickled prediction files:
+        group name ('predicted', 'features', 'truth') -> list of arrays.
+        Only the given groups are read, and if fields is given (dict: group -> list of indices)
+        only these fields, the others are None.
+        '''
+        if groups is None:
+            groups = list(self.groups.keys())
+        chunks = range(len(self.chunk_hits)-1)
+        out = {}
+        with ThreadPool(self.n_threads) as pool:
+            for group in groups:
+                selected = None if fields is None else fields.get(group)
+                out[group] = [self._readField(e, chunks, pool) if selected is None or i in selected else None
+                              for i, e in enumerate(self.groups[group])]
+        return out
+    
+    def readEvents(self, events, groups=None):
+        '''
+        returns the per-hit arrays of the selected events (dict as in read, arrays without
+        one entry per hit are None) and the row splits of the selection.
+        Only the blocks containing the selected events are decompressed.
+        '''
+        if groups is None:
+            groups = list(self.groups.keys())
+        for i in events:
+            if i < 0 or i >= self.n_events:
+                raise IndexError("Event wrongly selected")
+        chunks = sorted(set([i // self.chunk_events for i in events]))
+        counts = np.array([self.offsets[i+1]-self.offsets[i] for i in events], dtype='int64')
+        rs = np.concatenate([np.zeros(1, dtype='int64'), np.cumsum(counts)])
+        out = {}
+        with ThreadPool(self.n_threads) as pool:
+            for group in groups:
+                out[group] = []
+                for e in self.groups[group]:
+                    if not e['per_hit']:
+                        out[group].append(None)
+                        continue
+                    blocks = dict(zip(chunks, pool.map(lambda c: self._readBlock(e, c), chunks, chunksize=1)))
+                    sel = []
+                    for i in events:
+                        c = i // self.chunk_events
+                        first = self.offsets[i] - self.chunk_hits[c]
+                        sel.append(blocks[c][first:first + self.offsets[i+1] - self.offsets[i]])
+                    out[group].append(np.concatenate(sel, axis=0))
+        return out, rs
 
     
 class TrainData_OC(TrainData):
+    
+    #feature columns, same order as in base_convertFromSourceFile
+    feature_branches = ['recHitEnergy', 'recHitEta', 'recHitID', 'recHitTheta', 'recHitR',
+                        'recHitX', 'recHitY', 'recHitZ', 'recHitTime']
+    #truth columns, the energy is taken from the deposited energy for now
+    #the PIDs are reduced to the class index
+    truth_branches = ['truthHitAssignementIdx', 'truthHitAssignedDepEnergies', 
+                      'truthHitAssignedX', 'truthHitAssignedY', 'truthHitAssignedZ',
+                      'truthHitAssignedDirX', 'truthHitAssignedDirY', 'truthHitAssignedDirZ',
+                      'truthHitAssignedEta', 'truthHitAssignedPhi', 'truthHitAssignedT',
+                      'truthHitAssignedDirEta', 'truthHitAssignedDirR', 'truthHitAssignedDepEnergies',
+                      'ticlHitAssignementIdx', 'ticlHitAssignedEnergies', 'truthHitAssignedPIDs']
+    
     def __init__(self):
         TrainData.__init__(self)
+        #if > 0, the source files are read in blocks of this many events
+        #with a memory footprint of the output plus one block
+        self.conversion_chunk_events = 0
+        #print statistics during the conversion
+        self.conversion_verbose = False
+        #if set, fileIsValid results are stored in (and read from) this file
+        self.validation_cache_file = None
+        self._validation_cache = None
+        #'pickle' (one gzipped pickle file) or 'columnar' (see write_prediction_columns)
+        self.prediction_format = 'pickle'
+        self.prediction_compression_threads = 4
         
     
     def branchToFlatArray(self, b, returnRowSplits=False, selectmask=None, is3d=None):
@@ -30,7 +322,8 @@ class TrainData_OC(TrainData):
                 allba.append(ba)
             
             a = np.concatenate(allba,axis=0)
-            print(a.shape)
+            if self.conversion_verbose:
+                print(a.shape)
             
         if selectmask is not None:
             if is3d:
@@ -40,51 +333,189 @@ class TrainData_OC(TrainData):
         #use select(flattened) to select
         contentarr=None
         if  is3d is  None:
-            contentarr = a.content
-            contentarr = np.expand_dims(contentarr, axis=1)
+            contentarr = np.expand_dims(a.content, axis=1) #view, no copy
         else:
             contentarr=a
         
         if not returnRowSplits:
-            return np.array(contentarr,dtype='float32')
-        
-        nevents = a.shape[0]
-        rowsplits = [0]
-        
-        max_per_rs=0
-        #not super fast but ok given there aren't many events per file
-        for i in range(nevents):
-            #make a[i] np array
-            #get select[i] -> the truth mask
-            #apply, then fill RS
-            if selectmask is None:
-                rowsplits.append(rowsplits[-1] + a[i].shape[0])
-            else:
-                select = selectmask[i]
-                nonzero = np.count_nonzero(select)
-                if nonzero > max_per_rs:
-                    max_per_rs=nonzero
-                rowsplits.append(rowsplits[-1] + nonzero)
-                
-        rowsplits = np.array(rowsplits, dtype='int64')
-        print('mean hits per rs', contentarr.shape[0]/rowsplits.shape[0], ' max hits per rs: ',max_per_rs)
-        return np.expand_dims(a.content, axis=1),np.array(rowsplits, dtype='int64') 
+            return np.asarray(contentarr,dtype='float32') #no copy if already float32
+        
+        #the jagged array is already masked, so the counts are the selected hits per event
+        counts = a.counts
+        rowsplits = np.zeros(counts.shape[0]+1, dtype='int64')
+        np.cumsum(counts, out=rowsplits[1:])
+        
+        if self.conversion_verbose:
+            max_per_rs = np.max(counts) if counts.shape[0] else 0
+            print('mean hits per rs', contentarr.shape[0]/rowsplits.shape[0], ' max hits per rs: ',max_per_rs)
+        return contentarr, rowsplits
 
+    def _validationCacheKey(self, filename):
+        st = os.stat(filename)
+        return [os.path.abspath(filename), st.st_size, st.st_mtime_ns]
+    
+    def _readValidationCache(self):
+        '''
+        the cache file has one json entry [path, size, mtime, valid] per line,
+        later entries overwrite earlier ones
+        '''
+        self._validation_cache = {}
+        if not os.path.isfile(self.validation_cache_file):
+            return
+        with open(self.validation_cache_file) as f:
+            for line in f:
+                try:
+                    path, size, mtime, valid = json.loads(line)
+                except ValueError: #e.g. partially written line
+                    continue
+                self._validation_cache[path] = (size, mtime, valid)
+    
+    def _cachedValidation(self, filename):
+        if self.validation_cache_file is None:
+            return None
+        if self._validation_cache is None:
+            self._readValidationCache()
+        path, size, mtime = self._validationCacheKey(filename)
+        cached = self._validation_cache.get(path)
+        if cached is None or cached[0] != size or cached[1] != mtime:
+            return None
+        return cached[2]
+    
+    def _storeValidation(self, filename, valid):
+        if self.validation_cache_file is None:
+            return
+        path, size, mtime = self._validationCacheKey(filename)
+        self._validation_cache[path] = (size, mtime, valid)
+        #append only, so parallel writers do not overwrite each other
+        with open(self.validation_cache_file, 'a') as f:
+            f.write(json.dumps([path, size, mtime, valid])+'\n')
+    
     def fileIsValid(self, filename):
+        '''
+        opens the file once and checks that the tree has entries and that all
+        branches needed for the conversion exist with the same number of entries.
+        If validation_cache_file is set, the result is cached for unchanged files
+        (same path, size and modification time), failures to open the file are not cached.
+        '''
         try:
             fileTimeOut(filename, 2)
-            tree = uproot.open(filename)["WindowNTupler/tree"]
-            f=ROOT.TFile.Open(filename)
-            t=f.Get("WindowNTupler/tree")
-            if t.GetEntries() < 1:
-                raise ValueError("")
+            cached = self._cachedValidation(filename)
+            if cached is not None:
+                return cached
         except Exception as e:
             print(e)
             return False
-        return True
+        
+        try:
+            tree = uproot.open(filename)["WindowNTupler/tree"]
+            nentries = tree.numentries
+            for branch in set(self.feature_branches + self.truth_branches):
+                tree[branch] #raises if missing
+        except Exception as e:
+            print(e) #could be a temporary problem with the storage, so not cached
+            return False
+        
+        valid = nentries > 0
+        if not valid:
+            print(filename+": no entries")
+        for branch in set(self.feature_branches + self.truth_branches):
+            if tree[branch].numentries != nentries:
+                print(filename+": branch "+branch+" has "+str(tree[branch].numentries)
+                      +" entries, tree has "+str(nentries))
+                valid = False
+        
+        self._storeValidation(filename, valid)
+        return valid
 
     
     
+    def hitSelection(self, energy, hitid, removeTracks):
+        '''
+        jagged mask of the rechits to be kept
+        '''
+        selection = energy > 0
+        if removeTracks:
+            selection = np.logical_and(selection, hitid > -0.5)
+        return selection
+    
+    def pidsToClass(self, a, selection):
+        '''
+        one-hot PIDs (jagged per hit) to the class index, for the hits in the jagged selection
+        '''
+        allba=[]
+        for b in range(a.shape[0]):
+            allba.append(np.array(a[b]))
+        a = np.concatenate(allba,axis=0)[selection.flatten()]
+        return np.argmax(a, axis=-1)
+    
+    def convertChunked(self, tree, removeTracks, chunk_events):
+        '''
+        Reads the tree in blocks of chunk_events events, with one arrays() call per block,
+        and fills preallocated feature and truth buffers.
+        A first pass only reads the selection branches to determine the row splits.
+        The jagged arrays are masked before flattening: the content of a block read
+        can start before entrystart, and differently for each branch (basket boundaries).
+        Returns features, truth, row splits as numpy arrays
+        '''
+        nevents = tree.numentries
+        blocks = [(start, min(nevents, start+chunk_events)) for start in range(0, nevents, chunk_events)]
+        
+        counts=[np.zeros(0, dtype='int64')]
+        for start, stop in blocks:
+            arrs = tree.arrays(["recHitEnergy", "recHitID"], entrystart=start, entrystop=stop, namedecode="utf-8")
+            selection = self.hitSelection(arrs["recHitEnergy"], arrs["recHitID"], removeTracks)
+            counts.append(np.array(selection.sum(), dtype='int64'))
+        rs = np.concatenate([np.zeros(1, dtype='int64'), np.cumsum(np.concatenate(counts))]).astype('int64')
+        
+        features = np.empty((rs[-1], len(self.feature_branches)), dtype='float32')
+        truth = np.empty((rs[-1], len(self.truth_branches)), dtype='float32')
+        branches = list(set(self.feature_branches + self.truth_branches))
+        
+        for start, stop in blocks:
+            arrs = tree.arrays(branches, entrystart=start, entrystop=stop, namedecode="utf-8")
+            selection = self.hitSelection(arrs["recHitEnergy"], arrs["recHitID"], removeTracks)
+            first, last = rs[start], rs[stop]
+            
+            for i, b in enumerate(self.feature_branches):
+                features[first:last, i] = arrs[b][selection].flatten()
+            for i, b in enumerate(self.truth_branches):
+                if b == 'truthHitAssignedPIDs':
+                    truth[first:last, i] = self.pidsToClass(arrs[b], selection)
+                else:
+                    truth[first:last, i] = arrs[b][selection].flatten()
+            del arrs
+            
+        print('mean hits per rs', features.shape[0]/max(1, rs.shape[0]-1), ' max hits per rs: ',np.max(rs[1:]-rs[:-1], initial=0))
+        return features, truth, rs
+    
+    def createSimpleArrays(self, features, truth, rs):
+        '''
+        creates the feature and truth simpleArray lists from the full feature and truth arrays
+        '''
+        farr = simpleArray()
+        farr.createFromNumpy(features, rs)
+        
+        t_idxarr = simpleArray()
+        t_idxarr.createFromNumpy(np.ascontiguousarray(truth[:,0:1]), rs)
+        
+        t_energyarr = simpleArray()
+        t_energyarr.createFromNumpy(np.ascontiguousarray(truth[:,1:2]),rs)
+        
+        t_posarr = simpleArray()
+        t_posarr.createFromNumpy(np.ascontiguousarray(truth[:,2:4]),rs)
+        
+        t_time = simpleArray()
+        t_time.createFromNumpy(np.ascontiguousarray(truth[:,10:11]),rs)
+        
+        t_pid = simpleArray()
+        t_pid.createFromNumpy(np.ascontiguousarray(truth[:,16:17]),rs)
+        
+        #remaining truth is mostly for consistency in the plotting tools
+        t_rest = simpleArray()
+        t_rest.createFromNumpy(truth,rs)
+        
+        return [farr, t_idxarr, t_energyarr, t_posarr, t_time, t_pid],[t_rest], []
+    
     def base_convertFromSourceFile(self, filename, weighterobjects, istraining, treename="WindowNTupler/tree",
                                    removeTracks=True):
         
@@ -95,10 +526,11 @@ class TrainData_OC(TrainData):
         
         print("n entries: ",nevents )
         
-        selection = (tree["recHitEnergy"]).array() > 0
+        if self.conversion_chunk_events > 0:
+            features, truth, rs = self.convertChunked(tree, removeTracks, self.conversion_chunk_events)
+            return self.createSimpleArrays(features, truth, rs)
         
-        if removeTracks:
-            selection = np.logical_and(selection, (tree["recHitID"]).array() > -0.5)
+        selection = self.hitSelection(tree["recHitEnergy"].array(), tree["recHitID"].array(), removeTracks)
             
         
         recHitEnergy , rs        = self.branchToFlatArray(tree["recHitEnergy"], True,selection)
@@ -165,12 +597,6 @@ class TrainData_OC(TrainData):
         
         
 
-        farr = simpleArray()
-        farr.createFromNumpy(features, rs)
-        del features
-        
-        
-        
         truth = np.concatenate([
             truthHitAssignementIdx  , # 0
             truthHitAssignedEnergies ,
@@ -193,28 +619,25 @@ class TrainData_OC(TrainData):
             
             ], axis=-1)
         
-        
-        
-        t_idxarr = simpleArray()
-        t_idxarr.createFromNumpy(truthHitAssignementIdx, rs)
-        
-        t_energyarr = simpleArray()
-        t_energyarr.createFromNumpy(truthHitAssignedEnergies,rs)
-        
-        t_posarr = simpleArray()
-        t_posarr.createFromNumpy(np.concatenate([truthHitAssignedX, truthHitAssignedY],axis=-1),rs)
-        
-        t_time = simpleArray()
-        t_time.createFromNumpy(truthHitAssignedT,rs)
-        
-        t_pid = simpleArray()
-        t_pid.createFromNumpy(truthHitAssignedPIDs,rs)
-        
-        #remaining truth is mostly for consistency in the plotting tools
-        t_rest = simpleArray()
-        t_rest.createFromNumpy(truth,rs)
-        
-        return [farr, t_idxarr, t_energyarr, t_posarr, t_time, t_pid],[t_rest], []
+        return self.createSimpleArrays(features, truth, rs)
+    
+    def convertFileList(self, infiles, outdir, n_workers=1, columnar=False):
+        '''
+        Converts each input file to one output file in outdir, using a pool of n_workers processes.
+        The chunked conversion setting of this instance is used by all workers.
+        If columnar is True, each file is also written in the columnar layout (see writeColumnar)
+        to a directory with the same name and the extension .columnar
+        Returns the list of output files
+        '''
+        jobs = []
+        for infile in infiles:
+            outfile = os.path.join(outdir, os.path.splitext(os.path.basename(infile))[0] + '.djctd')
+            jobs.append((self.__class__, infile, outfile, self.conversion_chunk_events, columnar))
+        
+        if n_workers < 2:
+            return [_convert_file_worker(j) for j in jobs]
+        with Pool(n_workers) as pool:
+            return pool.map(_convert_file_worker, jobs, chunksize=1)
     
     def createFeatureDict(self,feat,addxycomb=True):
         d = {
@@ -261,18 +684,60 @@ class TrainData_OC(TrainData):
         
         return out
     
-    def createPandasDataFrame(self, eventno):
+    def writeColumnar(self, outdir):
+        '''
+        Writes all feature and truth arrays to outdir, each as a raw contiguous buffer
+        with its row splits and a json index. Can be read with readColumnar or
+        ColumnarArrays, which use np.memmap, such that selecting single events
+        does not require to load the full file.
+        '''
+        tdc = self.copy()
+        features = tdc.transferFeatureListToNumpy()
+        truth = tdc.transferTruthListToNumpy()
+        writer = ColumnarWriter(outdir)
+        writer.append(features[0::2], truth[0::2], _unpadded_row_splits(features[1]))
+        writer.close()
+    
+    def readColumnar(self, path, events=None):
+        '''
+        Reads the selected events (all if None) from a directory written by writeColumnar.
+        Only the data of the selected events is read from disk.
+        '''
+        arrs = ColumnarArrays(path)
+        if events is None:
+            events = range(arrs.nElements())
+        feat, truth, rs = arrs.getEvents(events)
+        
+        def to_simple_arrays(arrays):
+            out = []
+            for a in arrays:
+                sa = simpleArray()
+                sa.createFromNumpy(a, rs)
+                out.append(sa)
+            return out
+        
+        self.clear()
+        self._store(to_simple_arrays(feat), to_simple_arrays(truth), [])
+    
+    def createPandasDataFrame(self, eventno, columnar_path=None):
+        '''
+        If columnar_path is given, the event is read from this directory
+        (see writeColumnar) instead of the data loaded in this instance
+        '''
         #since this is only needed occationally
         import pandas as pd
         
-        if self.nElements() <= eventno:
-            raise IndexError("Event wrongly selected")
-        tdc = self.copy()
-        tdc.skim(eventno)
+        if columnar_path is not None:
+            f, t = ColumnarArrays(columnar_path).getEvent(eventno)
+        else:
+            if self.nElements() <= eventno:
+                raise IndexError("Event wrongly selected")
+            tdc = self.copy()
+            tdc.skim(eventno)
+            f = tdc.transferFeatureListToNumpy()
+            t = tdc.transferTruthListToNumpy()
         
-        f = tdc.transferFeatureListToNumpy()
         featd = self.createFeatureDict(f[0])
-        t = tdc.transferTruthListToNumpy()
         truthd = self.createTruthDict(t[0])
         
         featd.update(truthd)
@@ -313,6 +778,14 @@ class TrainData_OC(TrainData):
       
       
     def writeOutPrediction(self, predicted, features, truth, weights, outfilename, inputfile):
+        if self.prediction_format == 'columnar':
+            outfilename = os.path.splitext(outfilename)[0] + '.predcol'
+            print("Writing to ", outfilename)
+            write_prediction_columns(outfilename, predicted, features, truth,
+                                     n_threads=self.prediction_compression_threads)
+            print("Done")
+            return
+        
         outfilename = os.path.splitext(outfilename)[0] + '.bin.gz'
         # print("hello", outfilename, inputfile)
 
@@ -327,6 +800,12 @@ class TrainData_OC(TrainData):
         print("Done")
     
     def readPredicted(self, predfile):
+        '''
+        reads both prediction formats, for lazy access to the columnar
+        format use PredictionColumns directly
+        '''
+        if os.path.isdir(predfile):
+            return PredictionColumns(predfile, n_threads=self.prediction_compression_threads).read()
         with gzip.open(predfile) as mypicklefile:
             return pickle.load(mypicklefile)
         
@@ -354,7 +833,92 @@ class TrainData_OC_toyset(TrainData_OC):
         return a
 
 
-    def combineToySet(self, filename, outputfilename, treename="B4"):
+    def combineToySelected(self, c_rechitEnergy, selected, offsets, cell_features, event_truth):
+        '''
+        Produces several combinations at once.
+        selected: indices of the events of all combinations, sorted within each combination
+        offsets: first entry of each combination in selected, plus the total length
+        cell_features: H x 8 features of each cell, apart from the energy
+        event_truth: list of the per event truth (energy, x, y, deposited energy, class), N each
+        Each cell is assigned to the selected event with the highest energy in this cell
+        (first in case of ties), only cells with non-zero energy sum are kept.
+        Returns the features, truth and row splits of the combinations
+        '''
+        e_sel = c_rechitEnergy[selected] # S x H
+        starts = offsets[:-1]
+        r_recHitEnergy = np.add.reduceat(e_sel, starts, axis=0) # C x H, same summation order as np.sum
+        e_max = np.maximum.reduceat(e_sel, starts, axis=0)
+        is_max = e_sel == np.repeat(e_max, offsets[1:] - starts, axis=0)
+        first_max = np.where(is_max, np.arange(len(selected))[:, np.newaxis], len(selected))
+        r_rechitAssignment = selected[np.minimum.reduceat(first_max, starts, axis=0)] # C x H
+        
+        comb, cell = np.nonzero(r_recHitEnergy != 0)
+        rs = np.concatenate([np.zeros(1, dtype=np.int64),
+                             np.cumsum(np.bincount(comb, minlength=len(starts)))]).astype(np.int64)
+        r_rechitAssignment = r_rechitAssignment[comb, cell] # hits
+        
+        r_truthHitAssignedEnergies, r_truthHitAssignedX, r_truthHitAssignedY, \
+            r_truthHitAssignedDepEnergies, r_truthHitAssignedClass = [t[r_rechitAssignment][..., np.newaxis]
+                                                                      for t in event_truth]
+        r_truthHitAssignementIdx = r_rechitAssignment[..., np.newaxis]
+        
+        r_truthHitAssignedZ = r_truthHitAssignedX * 0 + 320
+        r_truthHitAssignedR = np.sqrt(r_truthHitAssignedX**2 + r_truthHitAssignedY**2)
+        r_truthHitAssignedEta = np.arctan2(r_truthHitAssignedR, r_truthHitAssignedZ)
+        r_truthHitAssignedPhi = np.arctan2(r_truthHitAssignedY, r_truthHitAssignedX)
+        equal_zeros = np.zeros_like(r_truthHitAssignedX)
+        
+        feature_array = np.concatenate([
+            r_recHitEnergy[comb, cell][..., np.newaxis],
+            cell_features[cell] #eta, track indicator, theta, r, x, y, z, time
+        ], axis=-1)
+        
+        truth_array = np.concatenate([
+            r_truthHitAssignementIdx,  # 0
+            r_truthHitAssignedEnergies,
+            r_truthHitAssignedX,
+            r_truthHitAssignedY,
+            r_truthHitAssignedZ,  # 4
+            r_truthHitAssignedX,
+            r_truthHitAssignedY,  # 6
+            r_truthHitAssignedZ,
+            r_truthHitAssignedEta,
+            r_truthHitAssignedPhi,
+            equal_zeros,  # 10 time
+            r_truthHitAssignedEta,
+            r_truthHitAssignedR,
+            r_truthHitAssignedDepEnergies,  # 16
+
+            equal_zeros,  # 17
+            equal_zeros,  # 18
+            r_truthHitAssignedClass  # 19 - 19+n_classes #won't be used anymore
+
+        ], axis=-1)
+        
+        feature_array = np.ascontiguousarray(feature_array.astype(np.float32))
+        truth_array = np.ascontiguousarray(truth_array.astype(np.float32))
+        return feature_array, truth_array, rs
+    
+    def toyArrays(self, feature_arrays, truth_arrays):
+        '''
+        splits the toy set truth into the arrays as stored (same order as createSimpleArrays)
+        '''
+        return [feature_arrays,
+                np.ascontiguousarray(truth_arrays[:, 0:1]),
+                np.ascontiguousarray(truth_arrays[:, 3:4]),
+                np.ascontiguousarray(np.concatenate([truth_arrays[:, 4:5], truth_arrays[:, 5:6]], axis=-1)),
+                np.ascontiguousarray(truth_arrays[:, 0:1]),
+                np.ascontiguousarray(truth_arrays[:, 10:11])], [truth_arrays]
+
+    def combineToySet(self, filename, outputfilename, treename="B4", n_combinations=100,
+                      combinations_per_batch=10, stream=False):
+        '''
+        Combines randomly selected single particle events to n_combinations events.
+        The combinations are produced in batches of combinations_per_batch.
+        If stream is True, each batch is appended to outputfilename in the columnar
+        layout (see writeColumnar) as soon as it is produced, instead of writing
+        one TrainData file at the end.
+        '''
         fileTimeOut(filename, 10)  # 10 seconds for eos to recover
 
         tree = uproot.open(filename)[treename]
@@ -363,10 +927,6 @@ class TrainData_OC_toyset(TrainData_OC):
         nevents = tree.numentries
         # print("n entries: ", nevents)
 
-
-        feature_arrays = []
-        truth_arrays = []
-
         recHitEta = (tree["rechit_eta"].array()[0])[..., np.newaxis]
         recHitPhi = (tree["rechit_phi"].array()[0])[..., np.newaxis]
         recHitX = (tree["rechit_x"].array()[0])[..., np.newaxis] / 10
@@ -377,167 +937,74 @@ class TrainData_OC_toyset(TrainData_OC):
         equal_zeros = recHitX * 0
         recHitTime = equal_zeros
 
+        cell_features = np.concatenate([
+            recHitEta,
+            equal_zeros,  # indicator if it is track or not
+            recHitTheta,
+            recHitR,
+            recHitX,
+            recHitY,
+            recHitZ,
+            recHitTime
+        ], axis=-1)
+
+        #all events have the same cells
         recHitEnergy = tree["rechit_energy"].array()
-        c_rechitEnergy = np.array(np.concatenate([np.array(recHitEnergy[i].tolist())[np.newaxis, ...] for i in range(nevents)], axis=0))
-
-        truthHitAssignedEnergies = tree["true_energy"].array()
-        c_truthHitAssignedEnergies = np.array([truthHitAssignedEnergies[i] for i in range(nevents)])
-        truthHitAssignedX = tree["true_x"].array() / 10
-        c_truthHitAssignedX = np.array([truthHitAssignedX[i] for i in range(nevents)])
-        truthHitAssignedY = tree["true_y"].array() / 10
-        c_truthHitAssignedY = np.array([truthHitAssignedY[i] for i in range(nevents)])
-
-        isElectron = tree['isElectron'].array()
-        c_isElectron = np.array([isElectron[i] for i in range(nevents)])
-        isMuon = tree['isMuon'].array()
-        c_isMuon = np.array([isMuon[i] for i in range(nevents)])
-        isPionCharged = tree['isPionCharged'].array()
-        c_isPionCharged = np.array([isPionCharged[i] for i in range(nevents)])
-        isK0Long = tree['isK0Long'].array()
-        c_isK0Long = np.array([isK0Long[i] for i in range(nevents)])
-        isK0Short = tree['isK0Short'].array()
-        c_isK0Short = np.array([isK0Short[i] for i in range(nevents)])
-        isGamma = tree['isGamma'].array()
-        c_isGamma = np.array([isGamma[i] for i in range(nevents)])
-
-        c_truthHitAssignedClass = c_isElectron * 1 + c_isMuon * 2 + \
-                                c_isPionCharged * 3 + c_isK0Long * 4 + \
-                                  c_isK0Short * 5 + c_isGamma * 6
+        c_rechitEnergy = np.asarray(recHitEnergy.content, dtype=np.float64).reshape(nevents, -1)
 
+        c_truthHitAssignedEnergies = np.asarray(tree["true_energy"].array())
+        c_truthHitAssignedX = np.asarray(tree["true_x"].array()) / 10
+        c_truthHitAssignedY = np.asarray(tree["true_y"].array()) / 10
+
+        c_truthHitAssignedClass = np.asarray(tree['isElectron'].array()) * 1 + np.asarray(tree['isMuon'].array()) * 2 + \
+                                  np.asarray(tree['isPionCharged'].array()) * 3 + np.asarray(tree['isK0Long'].array()) * 4 + \
+                                  np.asarray(tree['isK0Short'].array()) * 5 + np.asarray(tree['isGamma'].array()) * 6
 
         c_truthHitAssignedDepEnergies = np.sum(c_rechitEnergy, axis=1)
         c_truthHitAssignementIdx = np.arange(0, nevents)
 
         print(c_rechitEnergy.shape, c_truthHitAssignedEnergies.shape, c_truthHitAssignedX.shape, c_truthHitAssignedY.shape, c_truthHitAssignedDepEnergies.shape, c_truthHitAssignementIdx.shape)
 
+        event_truth = [c_truthHitAssignedEnergies, c_truthHitAssignedX, c_truthHitAssignedY,
+                       c_truthHitAssignedDepEnergies, c_truthHitAssignedClass]
 
-        rs = [0]
-
-        for i in range(100):
-            print("\tGenerating combination ", i)
-            selection_mask = self.event_selector(nevents, 50, 20, 20, min(110, nevents))
-
-            r_recHitEnergy = np.sum(c_rechitEnergy * selection_mask[..., np.newaxis], axis=0)[..., np.newaxis]
-            r_rechitAssignment = np.argmax(c_rechitEnergy * selection_mask[..., np.newaxis], axis=0)
-
-            with tf.device('/cpu:0'):
-               r_truthHitAssignedEnergies = tf.gather_nd(c_truthHitAssignedEnergies, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-               r_truthHitAssignedX = tf.gather_nd(c_truthHitAssignedX, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-               r_truthHitAssignedY = tf.gather_nd(c_truthHitAssignedY, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-               r_truthHitAssignedDepEnergies = tf.gather_nd(c_truthHitAssignedDepEnergies, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-               r_truthHitAssignementIdx = tf.gather_nd(c_truthHitAssignementIdx, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-               r_truthHitAssignedClass = tf.gather_nd(c_truthHitAssignedClass, r_rechitAssignment[..., np.newaxis]).numpy()[..., np.newaxis]
-
-            r_truthHitAssignedZ = r_truthHitAssignedX * 0 + 320
-            r_truthHitAssignedR = np.sqrt(r_truthHitAssignedX**2 + r_truthHitAssignedY**2)
-            r_truthHitAssignedEta = np.arctan2(r_truthHitAssignedR, r_truthHitAssignedZ)
-            r_truthHitAssignedPhi = np.arctan2(r_truthHitAssignedY, r_truthHitAssignedX)
-
-            ragged_indices = np.argwhere(r_recHitEnergy[:, 0] != 0)[:, 0]
-
-            # feature_array = np.concatenate((
-            #     r_recHitEnergy,
-            #     recHitEta,
-            #     recHitPhi,
-            #     recHitTheta,
-            #     recHitR,
-            #     recHitX,
-            #     recHitY,
-            #     recHitZ,
-            #     recHitTime,), axis=1
-            # )
-
-            feature_array = np.concatenate([
-                r_recHitEnergy,
-                recHitEta,
-                equal_zeros,  # indicator if it is track or not
-                recHitTheta,
-                recHitR,
-                recHitX,
-                recHitY,
-                recHitZ,
-                recHitTime
-            ], axis=-1)
-
-            # truth_array = np.concatenate((
-            #     r_truthHitAssignementIdx,
-            #     equal_zeros,
-            #     equal_zeros + 1,
-            #     r_truthHitAssignedEnergies,
-            #     r_truthHitAssignedX,
-            #     r_truthHitAssignedY,
-            #     r_truthHitAssignedZ,
-            #     equal_zeros,
-            #     r_truthHitAssignedEta,
-            #     r_truthHitAssignedPhi,
-            #     r_truthHitAssignedDepEnergies,
-            #     r_truthHitAssignedEnergies,
-            #     equal_zeros,
-            #     r_truthHitAssignedClass,
-            #     equal_zeros,
-            #     equal_zeros,), axis=1)
-
-            truth_array = np.concatenate([
-                r_truthHitAssignementIdx,  # 0
-                r_truthHitAssignedEnergies,
-                r_truthHitAssignedX,
-                r_truthHitAssignedY,
-                r_truthHitAssignedZ,  # 4
-                r_truthHitAssignedX,
-                r_truthHitAssignedY,  # 6
-                r_truthHitAssignedZ,
-                r_truthHitAssignedEta,
-                r_truthHitAssignedPhi,
-                equal_zeros,  # 10 time
-                r_truthHitAssignedEta,
-                r_truthHitAssignedR,
-                r_truthHitAssignedDepEnergies,  # 16
-
-                equal_zeros,  # 17
-                equal_zeros,  # 18
-                r_truthHitAssignedClass  # 19 - 19+n_classes #won't be used anymore
-
-            ], axis=-1)
-
-            feature_array = feature_array[ragged_indices]
-            truth_array = truth_array[ragged_indices]
-
+        writer = ColumnarWriter(outputfilename) if stream else None
+        feature_arrays = []
+        truth_arrays = []
+        row_splits = [np.zeros(1, dtype=np.int64)]
+
+        for first in range(0, n_combinations, combinations_per_batch):
+            last = min(n_combinations, first + combinations_per_batch)
+            print("\tGenerating combinations ", first, "to", last - 1)
+            selected = [np.flatnonzero(self.event_selector(nevents, 50, 20, 20, min(110, nevents)))
+                        for _ in range(first, last)]
+            offsets = np.cumsum([0] + [len(sel) for sel in selected])
+            feature_array, truth_array, rs = self.combineToySelected(c_rechitEnergy, np.concatenate(selected),
+                                                                     offsets, cell_features, event_truth)
+            if stream:
+                writer.append(*self.toyArrays(feature_array, truth_array), rs)
+                continue
             feature_arrays.append(feature_array)
             truth_arrays.append(truth_array)
+            row_splits.append(rs[1:] + row_splits[-1][-1])
 
-            rs.append(rs[-1] + len(feature_array))
-
-        rs = np.array(rs, np.int64)
-
-
-        feature_arrays = np.ascontiguousarray(np.concatenate(feature_arrays, axis=0).astype(np.float32))
-        truth_arrays = np.ascontiguousarray(np.concatenate(truth_arrays, axis=0).astype(np.float32))
-
-        t_idxarr = simpleArray()
-        t_idxarr.createFromNumpy(np.ascontiguousarray(truth_arrays[:, 0:1]), rs)
-
-        t_energyarr = simpleArray()
-        t_energyarr.createFromNumpy(np.ascontiguousarray(truth_arrays[:, 3:4]), rs)
-
-        t_posarr = simpleArray()
-        t_posarr.createFromNumpy(np.ascontiguousarray(np.concatenate([truth_arrays[:, 4:5], truth_arrays[:, 5:6]], axis=-1)), rs)
-
-        t_time = simpleArray()
-        t_time.createFromNumpy(np.ascontiguousarray(truth_arrays[:, 0:1]), rs)
+        if stream:
+            writer.close()
+            return
 
-        t_pid = simpleArray()
-        t_pid.createFromNumpy(np.ascontiguousarray(truth_arrays[:, 10:11]), rs)
+        rs = np.concatenate(row_splits)
+        feature_arrays = np.concatenate(feature_arrays, axis=0)
+        truth_arrays = np.concatenate(truth_arrays, axis=0)
 
-        # remaining truth is mostly for consistency in the plotting tools
-        t_rest = simpleArray()
-        t_rest.createFromNumpy(truth_arrays, rs)
+        features, truth = self.toyArrays(feature_arrays, truth_arrays)
 
-        farr = simpleArray()
-        farr.createFromNumpy(feature_arrays, rs)
-        # del feature_arrays
+        def to_simple_arrays(arrays):
+            out = []
+            for a in arrays:
+                sa = simpleArray()
+                sa.createFromNumpy(a, rs)
+                out.append(sa)
+            return out
 
-        # return [farr, t_idxarr, t_energyarr, t_posarr, t_time, t_pid], [t_rest], []
-
-        self._store([farr, t_idxarr, t_energyarr, t_posarr, t_time, t_pid], [t_rest], [])
+        self._store(to_simple_arrays(features), to_simple_arrays(truth), [])
         self.writeToFile(outputfilename)
-
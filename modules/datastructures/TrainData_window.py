@@ -13,35 +13,31 @@ import pickle
 import gzip
 from index_dicts import n_classes
 
-#@jit(nopython=True)   
 def _findRechitsSum(showerIdx, recHitEnergy, rs):
-
-    rechitEnergySums = []
-
-    for i in range(len(rs)-1):
-        ishowerIdx = showerIdx[rs[i]:rs[i+1]]
-        ishowerIdx = np.where(ishowerIdx<0,ishowerIdx-0.2,ishowerIdx)
-        ishowerIdx += 0.1
-        ishowerIdx = np.array(ishowerIdx,dtype='int64')
-        irechitEnergy = recHitEnergy[rs[i]:rs[i+1]]
-
-        uniques = np.unique(ishowerIdx)
-
-        irechitEnergySums = np.zeros_like(irechitEnergy)
-        for j in range(len(uniques)):
-            s=uniques[j]
-            
-            energySum = np.sum(irechitEnergy[ishowerIdx==s])
-            irechitEnergySums[ishowerIdx==s] = energySum
-            if s < 0:
-                irechitEnergySums[ishowerIdx==s] = 0
-
-        rechitEnergySums.append(irechitEnergySums)
-    return rechitEnergySums
+    '''
+    sum of the rechit energies of each shower, assigned to every hit of the shower
+    (0 for noise). The shower indices are made unique per event by an offset, so
+    all events are summed at once.
+    '''
+    ishowerIdx = np.where(showerIdx<0,showerIdx-0.2,showerIdx)
+    ishowerIdx = np.array(ishowerIdx+0.1,dtype='int64').ravel()
+    if ishowerIdx.shape[0] < 1:
+        return np.zeros_like(recHitEnergy)
+    
+    rs = np.asarray(rs, dtype='int64')
+    event = np.repeat(np.arange(rs.shape[0]-1, dtype='int64'), rs[1:]-rs[:-1])
+    
+    minidx = np.min(ishowerIdx)
+    key = event * (np.max(ishowerIdx) - minidx + 1) + (ishowerIdx - minidx)
+    _, inverse = np.unique(key, return_inverse=True)
+    
+    energySums = np.bincount(inverse, weights=np.ravel(recHitEnergy))
+    rechitEnergySums = np.where(ishowerIdx < 0, 0., energySums[inverse])
+    return np.reshape(rechitEnergySums, np.shape(recHitEnergy)).astype(recHitEnergy.dtype)
     
 
 def findRechitsSum(showerIdx, recHitEnergy, rs):
-    return np.concatenate(_findRechitsSum(showerIdx, recHitEnergy, rs), axis=0)
+    return _findRechitsSum(showerIdx, recHitEnergy, rs)
     
 class TrainData_window(TrainData):
     def __init__(self):
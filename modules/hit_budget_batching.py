@@ -0,0 +1,160 @@
+'''
+Batching of ragged windows/events with a fixed budget of hits per batch.
+
+The standard generator fills batches with the events in file order until the
+next event does not fit anymore, so that the number of hits per batch varies a lot
+if the event sizes vary. Here, the events are shuffled, sorted by their number of
+hits within a shuffle window and packed first-fit into batches, such that most
+batches are filled close to the budget.
+
+Example (files in the columnar layout, see TrainData_OC.writeColumnar):
+
+    gen = HitBudgetBatchGenerator('train.columnar', budget=70000)
+    model.fit(gen.generator(), steps_per_epoch=gen.nBatches(), ...)
+    print(gen.statistics())
+'''
+
+import numpy as np
+
+
+def pack_events(hit_counts, budget, shuffle_window=2000, rng=None, skip_too_large=True):
+    '''
+    Distributes the events, given by their number of hits, into batches with at most
+    budget hits. The events are shuffled, then within windows of shuffle_window events
+    sorted by decreasing number of hits and packed first-fit.
+    Events with more hits than the budget are skipped, or form a batch on their own
+    if skip_too_large is False.
+    Returns a list of arrays of event indices, the batches are in random order
+    '''
+    if rng is None:
+        rng = np.random
+    hit_counts = np.asarray(hit_counts)
+    order = rng.permutation(hit_counts.shape[0])
+    batches = []
+    for first in range(0, order.shape[0], shuffle_window):
+        window = order[first:first + shuffle_window]
+        window = window[np.argsort(-hit_counts[window], kind='stable')]
+        free = [] #remaining hits per open batch
+        members = []
+        for i in window:
+            n = hit_counts[i]
+            if n > budget:
+                if not skip_too_large:
+                    batches.append(np.array([i]))
+                continue
+            for b in range(len(free)):
+                if free[b] >= n:
+                    break
+            else:
+                b = len(free)
+                free.append(budget)
+                members.append([])
+            free[b] -= n
+            members[b].append(i)
+        batches += [np.array(m) for m in members]
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+def sequential_batches(hit_counts, budget, skip_too_large=True):
+    '''
+    Batches as filled by the standard generator: events in order, a new batch is
+    started if the next event does not fit anymore. Useful for comparisons.
+    '''
+    batches = []
+    current = []
+    n_current = 0
+    for i, n in enumerate(hit_counts):
+        if n > budget:
+            if not skip_too_large:
+                batches.append(np.array([i]))
+            continue
+        if n_current + n > budget:
+            batches.append(np.array(current))
+            current = []
+            n_current = 0
+        current.append(i)
+        n_current += n
+    if len(current):
+        batches.append(np.array(current))
+    return batches
+
+
+def batch_statistics(batches, hit_counts, budget):
+    '''
+    fill fraction: hits per batch / budget
+    padding waste: fraction of the hit budget that is not used,
+    if all batches were padded to the budget
+    '''
+    hit_counts = np.asarray(hit_counts)
+    hits = np.array([np.sum(hit_counts[b]) for b in batches], dtype='float64')
+    if hits.shape[0] == 0:
+        return {'n_batches': 0, 'n_events': 0, 'mean_fill': 0., 'std_fill': 0., 'min_fill': 0.,
+                'max_fill': 0., 'padding_waste': 0.}
+    fill = hits / budget
+    return {'n_batches': hits.shape[0],
+            'n_events': int(sum([len(b) for b in batches])),
+            'mean_fill': float(np.mean(fill)),
+            'std_fill': float(np.std(fill)),
+            'min_fill': float(np.min(fill)),
+            'max_fill': float(np.max(fill)),
+            'padding_waste': float(1. - np.sum(hits) / (hits.shape[0] * budget))}
+
+
+def padded_row_splits(row_splits, n_hits):
+    '''
+    row splits in the format the model expects: V x 1, the last entry is the number of row splits
+    '''
+    rs = np.zeros((max(n_hits, row_splits.shape[0]+1),1),dtype="int64")
+    rs[:row_splits.shape[0],0] = row_splits
+    rs[-1] = row_splits.shape[0]
+    return rs
+
+
+class HitBudgetBatchGenerator(object):
+    def __init__(self, columnar_path, budget, shuffle_window=2000, seed=None, skip_too_large=True):
+        '''
+        Generates batches with at most budget hits from a file in the columnar layout
+        (see TrainData_OC.writeColumnar), only the events of each batch are read.
+        The batches of each epoch are determined with pack_events.
+        '''
+        from datastructures.TrainData_OC import ColumnarArrays
+        self.arrays = ColumnarArrays(columnar_path)
+        rs = self.arrays.features[0][1]
+        self.hit_counts = rs[1:] - rs[:-1]
+        self.budget = budget
+        self.shuffle_window = shuffle_window
+        self.skip_too_large = skip_too_large
+        self.rng = np.random.RandomState(seed)
+        self.batches = None
+        self.newEpoch()
+
+    def newEpoch(self):
+        self.batches = pack_events(self.hit_counts, self.budget, self.shuffle_window,
+                                   self.rng, self.skip_too_large)
+
+    def nBatches(self):
+        return len(self.batches)
+
+    def statistics(self):
+        '''
+        fill fraction and padding waste of the batches of the current epoch
+        '''
+        return batch_statistics(self.batches, self.hit_counts, self.budget)
+
+    def _modelInputs(self, arrays, rs):
+        out = []
+        for a in arrays:
+            out += [a, padded_row_splits(rs, a.shape[0])]
+        return out
+
+    def generator(self):
+        '''
+        yields (features, truth) in the same format as the standard generator
+        (each array followed by its row splits), indefinitely, a new epoch is
+        packed after all batches were used
+        '''
+        while True:
+            for b in self.batches:
+                feat, truth, rs = self.arrays.getEvents(b)
+                yield self._modelInputs(feat, rs), self._modelInputs(truth, rs)
+            self.newEpoch()
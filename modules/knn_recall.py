@@ -0,0 +1,72 @@
+'''
+Recall of the approximate neighbour search (binned SelectKnn with max_shells >= 0)
+with respect to the exact binned search, to measure the speed/accuracy trade-off
+on real data before setting knn_max_shells in RaggedGravNet.
+
+Example:
+
+    for r in knn_recall_scan(K, coords, row_splits, max_shells=[0, 1, 2]):
+        print(r)
+'''
+
+import tensorflow as tf
+import numpy as np
+import time
+
+from select_knn_op import SelectKnn
+from compare_knn_outputs_op import CompareKnnOutputs
+
+
+def _timed_knn(K, coords, row_splits, max_shells, max_radius, n_repeat):
+    idx, _ = SelectKnn(K, coords, row_splits, max_radius=max_radius, tf_compatible=False,
+                       binned=True, max_shells=max_shells)
+    t0 = time.time()
+    for _ in range(n_repeat):
+        SelectKnn(K, coords, row_splits, max_radius=max_radius, tf_compatible=False,
+                  binned=True, max_shells=max_shells)
+    return idx, (time.time() - t0) / n_repeat
+
+
+def knn_recall(K : int, coords, row_splits, max_shells : int, max_radius=-1., n_repeat=1,
+               exact=None):
+    '''
+    Compares the neighbours found with max_shells to the exact ones using CompareKnnOutputs.
+    The recall of a vertex is the fraction of its exact neighbours (without self and
+    without the -1 padding) that is also found by the approximate search.
+    exact: optional (indices, time) of the exact search to avoid recomputing it
+
+    returns a dict with max_shells, the mean and minimum recall over the vertices,
+    the fraction of vertices with all neighbours found, and the exact and approximate
+    search time (seconds, averaged over n_repeat calls)
+    '''
+    assert K > 1
+    if exact is None:
+        exact = _timed_knn(K, coords, row_splits, -1, max_radius, n_repeat)
+    idx_exact, t_exact = exact
+    idx_approx, t_approx = _timed_knn(K, coords, row_splits, max_shells, max_radius, n_repeat)
+
+    #CompareKnnOutputs compares the rows as sets, so the -1 padding (max_radius, small
+    #row splits) counts as one matched entry if present in both
+    unmatched = CompareKnnOutputs(idx_exact, idx_approx).numpy()[:, 0]
+    idx_exact, idx_approx = idx_exact.numpy(), idx_approx.numpy()
+    both_padded = np.logical_and(np.any(idx_exact < 0, axis=1), np.any(idx_approx < 0, axis=1))
+    matched = K - unmatched - both_padded # valid neighbours found, including self
+    n_valid = np.sum(idx_exact >= 0, axis=1)
+    recall = np.where(n_valid > 1, (matched - 1.) / np.maximum(n_valid - 1., 1.), 1.)
+
+    return {'max_shells': max_shells,
+            'mean_recall': float(np.mean(recall)),
+            'min_recall': float(np.min(recall)),
+            'complete_fraction': float(np.mean(recall == 1.)),
+            'time_exact': t_exact,
+            'time_approx': t_approx}
+
+
+def knn_recall_scan(K : int, coords, row_splits, max_shells=[0, 1, 2, 3], max_radius=-1., n_repeat=1):
+    '''
+    knn_recall for several max_shells values, the exact search is only done once.
+    returns a list of the knn_recall dicts
+    '''
+    exact = _timed_knn(K, coords, row_splits, -1, max_radius, n_repeat)
+    return [knn_recall(K, coords, row_splits, s, max_radius, n_repeat, exact=exact)
+            for s in max_shells]
@@ -24,7 +24,28 @@ def LocalCluster(neighbour_idxs, hierarchy_idxs, row_splits):
     return rs,sel,ggather
     
 
+def LocalClusterHierarchy(neighbour_idxs, hierarchy, row_splits):
+    '''
+    Same as LocalCluster, but takes the hierarchy values (V x 1, float) instead of
+    the sorted indices. The vertices are sorted by decreasing hierarchy value
+    within each row split inside the op, and the row splits are processed in parallel.
+    '''
+    global_idxs = tf.range(tf.shape(hierarchy)[0],dtype='int32')
+    rs,sel,ggather = _op.LocalClusterHierarchy(neighbour_idxs=neighbour_idxs, 
+                            hierarchy=hierarchy, 
+                            global_idxs=global_idxs, 
+                            row_splits=row_splits)
+    
+    return rs,sel,ggather
+    
+
 @ops.RegisterGradient("LocalCluster")
 def _LocalClusterGrad(op, asso_grad, is_cgrad,ncondgrad):
     
-    return [None, None, None, None, None]
\ No newline at end of file
+    return [None, None, None, None, None]
+
+
+@ops.RegisterGradient("LocalClusterHierarchy")
+def _LocalClusterHierarchyGrad(op, asso_grad, is_cgrad,ncondgrad):
+    
+    return [None, None, None, None]
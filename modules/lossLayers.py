@@ -385,6 +385,7 @@ class LLFullObjectCondensation(LossLayerBase):
                  prob_repulsion=False,
                  phase_transition=0.,
                  alt_potential_norm=False,
+                 grid_repulsion=False,
                  print_time=True,
                  standard_configuration=None,
                  **kwargs):
@@ -421,13 +422,16 @@ class LLFullObjectCondensation(LossLayerBase):
                           is applied
         :param prob_repulsion
         :param phase_transition
+        :param alt_potential_norm
+        :param grid_repulsion: evaluate the repulsive potential only for pairs in neighbouring unit cells
+                               of the clustering space (same result, scales with local density instead of K x V)
+        :param print_time: prints the time spent in the loss calculation (also works in graph mode)
         :param standard_configuration:
         :param kwargs:
+        
+        The layer is traceable by tf.function (not dynamic by default), printing uses tf.print
         """
-        if 'dynamic' in kwargs:
-            super(LLFullObjectCondensation, self).__init__(**kwargs)
-        else:
-            super(LLFullObjectCondensation, self).__init__(dynamic=True,**kwargs)
+        super(LLFullObjectCondensation, self).__init__(**kwargs)
 
         self.energy_loss_weight = energy_loss_weight
         self.use_energy_weights = use_energy_weights
@@ -458,10 +462,9 @@ class LLFullObjectCondensation(LossLayerBase):
         self.prob_repulsion = prob_repulsion
         self.phase_transition = phase_transition
         self.alt_potential_norm = alt_potential_norm
+        self.grid_repulsion = grid_repulsion
         self.print_time = print_time
 
-        self.loc_time=time.time()
-
         if standard_configuration is not None:
             raise NotImplemented('Not implemented yet')
         
@@ -496,16 +499,13 @@ class LLFullObjectCondensation(LossLayerBase):
         
         start_time = 0
         if self.print_time:
-            start_time = time.time()
+            start_time = tf.timestamp()
         
         
         pred_beta, pred_ccoords, pred_energy, pred_pos, pred_time, pred_id,\
         t_idx, t_energy, t_pos, t_time, t_pid,\
         rowsplits = inputs
         
-        if rowsplits.shape[0] is None:
-            return tf.constant(0,dtype='float32')
-        
         energy_weights = self.calc_energy_weights(t_energy)
         if not self.use_energy_weights:
             energy_weights = tf.zeros_like(energy_weights)+1.
@@ -534,7 +534,8 @@ class LLFullObjectCondensation(LossLayerBase):
                                            cont_beta_loss=self.cont_beta_loss,
                                            prob_repulsion=self.prob_repulsion,
                                            phase_transition=self.phase_transition>0. ,
-                                           alt_potential_norm=self.alt_potential_norm
+                                           alt_potential_norm=self.alt_potential_norm,
+                                           grid_repulsion=self.grid_repulsion
                                            )
 
         
@@ -556,25 +557,23 @@ class LLFullObjectCondensation(LossLayerBase):
         lossval = tf.reduce_mean(lossval)
         
         if self.print_time:
-            print('loss layer',self.name,'took',int((time.time()-start_time)*100000.)/100.,'ms')
-            print('loss layer info:',self.name,'batch took',int((time.time()-self.loc_time)*100000.)/100.,'ms')
-            self.loc_time = time.time()
+            tf.print('loss layer',self.name,'took',tf.round((tf.timestamp()-start_time)*100000.)/100.,'ms')
             
         if self.print_loss:
             minbtext = 'min_beta_loss'
             if self.phase_transition>0:
                 minbtext = 'phase transition loss'
-                print('avg beta', tf.reduce_mean(pred_beta))
-            print('loss', lossval.numpy(),
-                  'attractive_loss', att.numpy(),
-                  'rep_loss', rep.numpy(),
-                  minbtext, min_b.numpy(),
-                  'noise_loss', noise.numpy(),
-                  'energy_loss', energy_loss.numpy(),
-                  'pos_loss', pos_loss.numpy(),
-                  'time_loss', time_loss.numpy(),
-                  'class_loss', class_loss.numpy(),
-                  'exceed_beta', exceed_beta.numpy(),'\n')
+                tf.print('avg beta', tf.reduce_mean(pred_beta))
+            tf.print('loss', lossval,
+                  'attractive_loss', att,
+                  'rep_loss', rep,
+                  minbtext, min_b,
+                  'noise_loss', noise,
+                  'energy_loss', energy_loss,
+                  'pos_loss', pos_loss,
+                  'time_loss', time_loss,
+                  'class_loss', class_loss,
+                  'exceed_beta', exceed_beta,'\n')
 
         return lossval
 
@@ -609,6 +608,7 @@ class LLFullObjectCondensation(LossLayerBase):
             'prob_repulsion': self.prob_repulsion,
             'phase_transition': self.phase_transition,
             'alt_potential_norm': self.alt_potential_norm,
+            'grid_repulsion': self.grid_repulsion,
             'print_time' : self.print_time
         }
         base_config = super(LLFullObjectCondensation, self).get_config()
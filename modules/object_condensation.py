@@ -4,6 +4,7 @@ import tensorflow as tf
 import numpy as np
 import sys
 import time
+import itertools
 
 
 def remove_zero_length_elements_from_ragged_tensors(row_splits):
@@ -13,38 +14,29 @@ def remove_zero_length_elements_from_ragged_tensors(row_splits):
 
 
 
-# create a few with fixed number and then make an if statement selecting the right one
-# @tf.function
-def normalize_weights(weights):
+def payload_weight_function_segments(w, w2, threshold, segment_ids, num_segments):
     '''
-    Input is X x V x X
-    Outputs are X x V x X
-    normalises across V
-    '''
-    weight_sum = tf.reduce_sum(weights, axis=1, keepdims=True) #K x 1 x X
-    return tf.math.divide_no_nan(weights,weight_sum)
-    
-
-def payload_weight_function(w, w2, threshold):
-    '''
-    Input/output  K x V x 1
-    normalised in V
+    Payload weights w2*atanh(w)**2, relative to the maximum within each segment
+    (e.g. the object index of each vertex), above the threshold and normalised
+    within each segment
+    In/output: E x 1
     '''
     w = tf.clip_by_value(w, 0., 1.-1e-6)
     w = w2*tf.math.atanh(w)**2
-    w_max = tf.reduce_max(w, axis = 1, keepdims=True) # K x 1 x 1
-    w = tf.math.divide_no_nan(w, w_max)
+    w_max = tf.math.unsorted_segment_max(w, segment_ids, num_segments) # K x 1
+    w = tf.math.divide_no_nan(w, tf.gather(w_max, segment_ids))
     if threshold>0:
         w = tf.nn.relu(w-threshold)
-    return normalize_weights(w)
-    
+    w_sum = tf.math.unsorted_segment_sum(w, segment_ids, num_segments) # K x 1
+    return tf.math.divide_no_nan(w, tf.gather(w_sum, segment_ids))
+
 
 def gather_for_obj_from_vert(v_prop, ids):
     '''
-    In: V x X , ids
+    In: V x X , ids K x 1
     Out: K x 1 x X
     '''
-    gathered = tf.gather_nd(tf.tile(tf.expand_dims(v_prop, axis=0), [ids.shape[0]]+[1]*len(v_prop.shape)), ids, batch_dims=1)
+    gathered = tf.gather_nd(v_prop, ids)
     gathered = tf.expand_dims(gathered, axis=1)
     return gathered
 
@@ -56,7 +48,83 @@ def mean_N_K(x, N, K):
     red = tf.reduce_sum(x, axis=0)#K
     red = tf.reduce_sum(red, axis=0)#V
     return tf.math.divide_no_nan(red, tf.expand_dims(N*K, axis=0))
+
+
+def grid_neighbour_pairs(x_a, x_b, cell_size=1., max_bin_dims=3):
+    '''
+    Finds all pairs of entries in x_a and x_b that are in the same or in
+    directly neighbouring cells of a grid with the given cell size.
+    Only the first (up to) max_bin_dims coordinates are binned, so all pairs
+    closer than cell_size (in the full space) are guaranteed to be included.
+    
+    In: x_a A x C, x_b B x C
+    Out: a indices P, b indices P (int64), sorted by a index
+    '''
+    n_dims = min(x_a.shape[-1], max_bin_dims)
+    cells_a = tf.cast(tf.floor(x_a[:, :n_dims] / cell_size), dtype='int64') # A x D
+    cells_b = tf.cast(tf.floor(x_b[:, :n_dims] / cell_size), dtype='int64') # B x D
+    
+    # shift the cells such that all neighbours of all cells are within [0, extent)
+    all_cells = tf.concat([cells_a, cells_b], axis=0)
+    cell_min = tf.reduce_min(all_cells, axis=0) - 1 # D
+    extent = tf.reduce_max(all_cells, axis=0) - cell_min + 2 # D
+    
+    def flat_key(cells):
+        key = tf.zeros_like(cells[:, 0])
+        for d in range(n_dims):
+            key = key * extent[d] + cells[:, d] - cell_min[d]
+        return key
+    
+    key_b = flat_key(cells_b)
+    order_b = tf.argsort(key_b, stable=True)
+    sorted_key_b = tf.gather(key_b, order_b)[tf.newaxis, :]
+    
+    starts, ends = [], []
+    for offset in itertools.product([-1, 0, 1], repeat=n_dims):
+        key_a = flat_key(cells_a + tf.constant(offset, dtype='int64')[tf.newaxis, :])[tf.newaxis, :]
+        starts.append(tf.searchsorted(sorted_key_b, key_a, side='left', out_type=tf.int64)[0])
+        ends.append(tf.searchsorted(sorted_key_b, key_a, side='right', out_type=tf.int64)[0])
+    
+    # A x O, the neighbouring cells of each entry in a
+    starts = tf.reshape(tf.stack(starts, axis=1), [-1])
+    ends = tf.reshape(tf.stack(ends, axis=1), [-1])
+    
+    ranges = tf.ragged.range(starts, ends)
+    a_idx = ranges.value_rowids() // (3 ** n_dims)
+    b_idx = tf.gather(tf.cast(order_b, 'int64'), ranges.flat_values)
+    return a_idx, b_idx
+
+
+def oc_grid_repulsion(x_kalpha, x, q_kalpha, q, object_weights_kalpha,
+                      obj_ids, truth_idx, N, K, N_per_obj, alt_potential_norm):
+    '''
+    Repulsive term (relu(1-distance) potential) of oc_per_batch_element, evaluated
+    only for the pairs of condensation points and vertices in neighbouring unit
+    cells. All other pairs are more than one unit apart and do not contribute.
+    
+    In: x_kalpha K x C, q_kalpha, object_weights_kalpha, obj_ids K x 1, 
+        all other inputs as in oc_per_batch_element
+    Out: 1
+    '''
+    pair_obj, pair_vert = grid_neighbour_pairs(x_kalpha, x) # P, P
+
+    M_not = tf.gather(obj_ids, pair_obj) - tf.gather(truth_idx, pair_vert) # P x 1
+    M_not = tf.where(tf.abs(M_not) > 0.1, tf.zeros_like(M_not) + 1., tf.zeros_like(M_not))
+
+    distancesq = tf.reduce_sum((tf.gather(x_kalpha, pair_obj) - tf.gather(x, pair_vert)) ** 2,
+                               axis=-1, keepdims=True) # P x 1
+
+    V_rep = tf.nn.relu(1. - tf.sqrt(distancesq + 1e-4))
+    V_rep = tf.gather(object_weights_kalpha, pair_obj) * V_rep * M_not * \
+        tf.gather(q_kalpha, pair_obj) * tf.gather(q, pair_vert) # P x 1
+
+    if alt_potential_norm:
+        V_rep = tf.math.unsorted_segment_sum(V_rep, pair_obj, tf.shape(x_kalpha, out_type=tf.int64)[0]) # K x 1
+        V_rep = tf.math.divide_no_nan(V_rep, tf.expand_dims(tf.expand_dims(N,axis=0),axis=0)-N_per_obj) # K x 1
+        return tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=0), K) # 1
     
+    return tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=0), tf.expand_dims(N*K, axis=0)) # 1
+
 
 def oc_per_batch_element(
         beta,
@@ -67,143 +135,339 @@ def oc_per_batch_element(
         is_spectator,
         payload_loss,
         S_B=1.,
-        payload_weight_function = payload_weight_function,  #receives betas as K x V x 1 as input, and a threshold val
+        payload_weight_function = payload_weight_function_segments,  #receives betas of the object vertices as V_m x 1, their object index and a threshold val
         payload_weight_threshold = 0.8,
         use_mean_x = False,
         cont_beta_loss=False,
         prob_repulsion=False,
         phase_transition=False,
-        alt_potential_norm=False
+        alt_potential_norm=False,
+        grid_repulsion=False
         ):
     '''
     all inputs
     V x X , where X can be 1
-    '''
+
+    Only the repulsive term needs all object-vertex combinations (K x V). All other
+    terms are calculated per vertex that belongs to an object (V_m),
+    using the object index of each vertex and segment operations.
     
+    grid_repulsion: only evaluate the object-vertex pairs in neighbouring unit cells
+    of the clustering space for the repulsive term (see oc_grid_repulsion).
+    The result is the same, not used with prob_repulsion (no compact support)
+    '''
+
     #set all spectators invalid here, everything scales with beta, so:
     beta_in = beta
     beta = tf.clip_by_value(beta, 0.,1.-1e-4)
     beta *= (1. - is_spectator)
-    qraw = tf.math.atanh(beta)**2 
+    qraw = tf.math.atanh(beta)**2
     q = qraw + q_min * (1. - is_spectator) # V x 1
     #q = tf.where(beta_in<1.-1e-4, q, tf.math.atanh(1.-1e-4)**2 + q_min + beta_in) #just give the rest above clip a gradient
-    
+
     #determine object associations
-    obj_ids,_ = tf.unique(tf.squeeze(truth_idx,axis=1)) # K+1
-    obj_ids = obj_ids[obj_ids>-0.1]
-    
-    K = tf.cast(obj_ids.shape[0], dtype='float32') 
-    N = tf.cast(beta.shape[0], dtype='float32')
-    
+    member_idx = tf.where(truth_idx[:,0]>-0.1) # V_m x 1
+    obj_ids, member_obj = tf.unique(tf.gather_nd(truth_idx[:,0], member_idx)) # K, V_m
+    n_obj = tf.shape(obj_ids)[0]
+
+    K = tf.cast(n_obj, dtype='float32')
+    N = tf.cast(tf.shape(beta)[0], dtype='float32')
+
     #print('objects',K)
-    
+
     obj_ids = tf.expand_dims(obj_ids, axis=1) #K x 1
-    
+
     is_noise = tf.where(truth_idx<0., tf.zeros_like(truth_idx), 1.)#V x 1
-    N_nonoise = N - tf.cast(tf.math.count_nonzero(is_noise), dtype='float32') #()
-    
-    M = tf.expand_dims(obj_ids, axis=1) - tf.expand_dims(truth_idx, axis=0) # K x V x 1
-    M_not = tf.where(tf.abs(M) > 0.1, tf.zeros_like(M) + 1., tf.zeros_like(M))
-    M = tf.where(tf.abs(M) < 0.1, tf.zeros_like(M) + 1., tf.zeros_like(M))
-    N_per_obj = tf.reduce_sum(M, axis=1) # K x 1
-    
-    kalpha = tf.argmax(M * tf.expand_dims(beta_in, axis=0), axis=1) # K x 1
-    
+
+    N_per_obj = tf.math.unsorted_segment_sum(tf.ones_like(member_obj, dtype='float32'), member_obj, n_obj)
+    N_per_obj = tf.expand_dims(N_per_obj, axis=1) # K x 1
+
+    #the vertex with the highest beta, lowest index in case of ties
+    beta_in_m = tf.gather_nd(beta_in, member_idx) # V_m x 1
+    max_beta_m = tf.gather(tf.math.unsorted_segment_max(beta_in_m, member_obj, n_obj), member_obj)
+    kalpha = tf.math.unsorted_segment_min(tf.where(beta_in_m == max_beta_m, member_idx,
+                                                   tf.shape(beta, out_type=tf.int64)[0]),
+                                          member_obj, n_obj) # K x 1
+
     x_kalpha = gather_for_obj_from_vert(x, kalpha) # K x 1 x C
     if use_mean_x: #q weighted mean here
-        x_kalpha = tf.reduce_sum( M * tf.expand_dims(q, axis=0) * tf.expand_dims(x,axis=0), axis=1, keepdims=True) # K x 1 x C
-        x_kalpha = tf.math.divide_no_nan(x_kalpha, tf.reduce_sum(M * tf.expand_dims(q, axis=0), axis=1, keepdims=True)) # K x 1 x C
-    
+        q_m = tf.gather_nd(q, member_idx)
+        x_kalpha = tf.math.unsorted_segment_sum(q_m * tf.gather_nd(x, member_idx), member_obj, n_obj) # K x C
+        x_kalpha = tf.math.divide_no_nan(x_kalpha, tf.math.unsorted_segment_sum(q_m, member_obj, n_obj)) # K x C
+        x_kalpha = tf.expand_dims(x_kalpha, axis=1) # K x 1 x C
+
     q_kalpha = gather_for_obj_from_vert(q, kalpha) # K x 1 x 1
-    qraw_kalpha = gather_for_obj_from_vert(qraw, kalpha) # K x 1 x 1
     beta_kalpha = gather_for_obj_from_vert(beta_in, kalpha) # K x 1 x 1
-    
+
     object_weights_kalpha = gather_for_obj_from_vert(object_weights, kalpha)# K x 1 x 1
-    
-    distancesq = tf.reduce_sum((x_kalpha - tf.expand_dims(x, axis=0)) ** 2, axis=-1, keepdims=True)# K x V x 1
-    
-    V_att = object_weights_kalpha * M * q_kalpha * tf.expand_dims(q, axis=0) * distancesq # K x V x 1
-    
+
+    #object properties for each vertex that belongs to an object
+    x_kalpha_m = tf.gather(x_kalpha[:,0], member_obj) # V_m x C
+    q_kalpha_m = tf.gather(q_kalpha[:,0], member_obj) # V_m x 1
+    beta_kalpha_m = tf.gather(beta_kalpha[:,0], member_obj) # V_m x 1
+    object_weights_kalpha_m = tf.gather(object_weights_kalpha[:,0], member_obj) # V_m x 1
+
+    distancesq_m = tf.reduce_sum((x_kalpha_m - tf.gather_nd(x, member_idx)) ** 2, axis=-1, keepdims=True)# V_m x 1
+
+    V_att = object_weights_kalpha_m * q_kalpha_m * tf.gather_nd(q, member_idx) * distancesq_m # V_m x 1
+
     if alt_potential_norm:
-        V_att = tf.math.divide_no_nan(tf.reduce_sum(V_att,axis=1), N_per_obj) # K x 1
+        V_att = tf.math.divide_no_nan(tf.math.unsorted_segment_sum(V_att, member_obj, n_obj), N_per_obj) # K x 1
         V_att = tf.math.divide_no_nan(tf.reduce_sum(V_att,axis=0), K) # 1
     else:
-        V_att = mean_N_K(V_att, N, K) # ()
-    
-    V_rep=None
-    if prob_repulsion:
-        # comes from 1-Gaus in LH space
-        V_rep = -2.*tf.math.log(1.-tf.math.exp(-distancesq/2.)+1e-5)
-        #V_rep = tf.exp(- distancesq * 6./2.)
-    else:
-        V_rep = tf.nn.relu(1. - tf.sqrt(distancesq + 1e-4))
-    
-    V_rep = object_weights_kalpha * V_rep * M_not * q_kalpha * tf.expand_dims(q, axis=0)     # K x V x 1
-    
-    if alt_potential_norm:
-        V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=1), 
-                                      tf.expand_dims(tf.expand_dims(N,axis=0),axis=0)-N_per_obj) # K x 1
-        V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=0), K) # 1
+        V_att = tf.math.divide_no_nan(tf.reduce_sum(V_att,axis=0), tf.expand_dims(N*K, axis=0)) # 1
+
+    if grid_repulsion and not prob_repulsion:
+        V_rep = oc_grid_repulsion(x_kalpha[:,0], x, q_kalpha[:,0], q, object_weights_kalpha[:,0],
+                                  obj_ids, truth_idx, N, K, N_per_obj, alt_potential_norm) # 1
     else:
-        V_rep = mean_N_K(V_rep, N, K) # ()
-    
+        #repulsion needs all combinations
+        M_not = tf.expand_dims(obj_ids, axis=1) - tf.expand_dims(truth_idx, axis=0) # K x V x 1
+        M_not = tf.where(tf.abs(M_not) > 0.1, tf.zeros_like(M_not) + 1., tf.zeros_like(M_not))
+
+        distancesq = tf.reduce_sum((x_kalpha - tf.expand_dims(x, axis=0)) ** 2, axis=-1, keepdims=True)# K x V x 1
+
+        V_rep=None
+        if prob_repulsion:
+            # comes from 1-Gaus in LH space
+            V_rep = -2.*tf.math.log(1.-tf.math.exp(-distancesq/2.)+1e-5)
+            #V_rep = tf.exp(- distancesq * 6./2.)
+        else:
+            V_rep = tf.nn.relu(1. - tf.sqrt(distancesq + 1e-4))
+
+        V_rep = object_weights_kalpha * V_rep * M_not * q_kalpha * tf.expand_dims(q, axis=0)     # K x V x 1
+
+        if alt_potential_norm:
+            V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=1),
+                                          tf.expand_dims(tf.expand_dims(N,axis=0),axis=0)-N_per_obj) # K x 1
+            V_rep = tf.math.divide_no_nan(tf.reduce_sum(V_rep,axis=0), K) # 1
+        else:
+            V_rep = mean_N_K(V_rep, N, K) # ()
+
     ##beta penalty
-    
+
     beta_kalpha_sm = beta_kalpha
     if cont_beta_loss:
-        
-        b_exp = M * tf.expand_dims(beta, axis=0)
+
+        b_exp = tf.gather_nd(beta, member_idx) # V_m x 1
         maxb = beta_kalpha
-        meanb = tf.math.divide_no_nan(tf.reduce_sum(b_exp, axis = 1, keepdims=True),
-                                      tf.reduce_sum(M,  axis = 1, keepdims=True))
-        sqsum = tf.reduce_sum(b_exp**2, axis = 1, keepdims=True)
-        beta_kalpha_sm = 1. - (tf.math.divide_no_nan(meanb+0.2, maxb+0.1) + tf.math.exp(-sqsum))
-        #b_exp = M * tf.expand_dims(beta, axis=0)
-        #b_exp_sum = tf.reduce_sum(b_exp, axis=1, keepdims=True) # K x 1 x 1
-        #b_exp_prod = tf.reduce_prod(b_exp, axis=1, keepdims=True)  # K x 1 x 1
-        #
-        ## 1 - X here to compensate 1 - down there
-        #beta_kalpha_sm = 1. - tf.math.exp(-b_exp_sum)+0.5*b_exp_prod-tf.math.exp(tf.constant([[[-1.]]])) # K x 1 x 1
-        
+        meanb = tf.math.divide_no_nan(tf.math.unsorted_segment_sum(b_exp, member_obj, n_obj), N_per_obj) # K x 1
+        sqsum = tf.math.unsorted_segment_sum(b_exp**2, member_obj, n_obj) # K x 1
+        beta_kalpha_sm = 1. - (tf.math.divide_no_nan(tf.expand_dims(meanb,axis=1)+0.2, maxb+0.1)
+                               + tf.math.exp(-tf.expand_dims(sqsum,axis=1))) # K x 1 x 1
+
     B_pen = 0.
     if phase_transition:
-        # K x V x 1
+        # V_m x 1
         # does not scale with q of each vertex, but only with beta_kalpha
-        B_pen = - object_weights_kalpha * M * beta_kalpha * 1./(20*distancesq + 1.)#tf.exp(-10. * tf.sqrt(distancesq + 1e-9))
-        B_pen = tf.where(distancesq==0. , 0., B_pen) #exclude exact self-potential (not needed in the other cases)
-        #B_pen = mean_N_K(B_pen, N, K)
-        B_pen = tf.math.divide_no_nan(tf.reduce_sum(B_pen,axis=1), N_per_obj) # K x 1
+        B_pen = - object_weights_kalpha_m * beta_kalpha_m * 1./(20*distancesq_m + 1.)
+        B_pen = tf.where(distancesq_m==0. , 0., B_pen) #exclude exact self-potential (not needed in the other cases)
+        B_pen = tf.math.divide_no_nan(tf.math.unsorted_segment_sum(B_pen, member_obj, n_obj), N_per_obj) # K x 1
         B_pen = tf.math.divide_no_nan(tf.reduce_sum(B_pen,axis=0), K) # 1
     else:
-        B_pen += tf.math.divide_no_nan(tf.reduce_sum(object_weights_kalpha*(1. - beta_kalpha_sm)), 
+        B_pen += tf.math.divide_no_nan(tf.reduce_sum(object_weights_kalpha*(1. - beta_kalpha_sm)),
                                   tf.reduce_sum(object_weights_kalpha)) # ()
-        
+
 
     # beta_in V x 1
     # object_weights V x 1
-    
+
     to_much_B_pen = tf.constant([0.],dtype='float32')
     if not cont_beta_loss:
         to_much_B_pen = tf.reduce_sum( beta_in*object_weights ) - tf.reduce_sum(object_weights_kalpha)
         to_much_B_pen = tf.nn.relu(to_much_B_pen)#min=0
         to_much_B_pen = tf.math.divide_no_nan(to_much_B_pen,tf.reduce_sum(object_weights))
-    
+
     ##noise penalty
     Noise_pen = S_B*tf.math.divide_no_nan(tf.reduce_sum(is_noise * beta_in), tf.reduce_sum(is_noise))
-    
+
     #### payload
     ## beta_nograd kill beta gradient? maybe..?
-    
-    p_w = object_weights_kalpha * payload_weight_function(M * tf.expand_dims(beta,axis=0), 
-                                  tf.expand_dims(object_weights,axis=0), 
-                                  payload_weight_threshold) #K x V x 1
-    pll = p_w * tf.expand_dims(payload_loss, axis=0) #K x V x X
+
+    p_w = object_weights_kalpha_m * payload_weight_function(tf.gather_nd(beta, member_idx),
+                                  tf.gather_nd(object_weights, member_idx),
+                                  payload_weight_threshold,
+                                  member_obj, n_obj) #V_m x 1
+    pll = p_w * tf.gather_nd(payload_loss, member_idx) #V_m x X
     pll = tf.math.divide_no_nan(
-        tf.reduce_sum(pll,axis=[0,1]), K  )# (), weights are already normalised in V
-    
+        tf.reduce_sum(pll,axis=0), K  )# (), weights are already normalised per object
+
     return V_att, V_rep, Noise_pen, B_pen, pll, to_much_B_pen
 
+
+def oc_loss_batched(
+        x,
+        beta,
+        truth_indices,
+        row_splits,
+        is_spectator,
+        payload_loss,
+        Q_MIN=0.1,
+        S_B=1.,
+        energyweights=None,
+        use_average_cc_pos=False,
+        payload_rel_threshold=0.1,
+        cont_beta_loss=False,
+        prob_repulsion=False,
+        phase_transition=False,
+        alt_potential_norm=False
+        ):
+    '''
+    Same as oc_loss (with the default payload weight function), but all events
+    of the ragged batch are processed at once.
+    Objects are identified by (event, truth index). All terms but the repulsive
+    one are calculated per vertex that belongs to an object. For the repulsion,
+    all object-vertex pairs within the same event are processed as one flat list.
+    Everything is reduced with segment operations per object and per event.
+
+    all per-vertex inputs are V x X, row_splits define the events
+    '''
+    if energyweights is None:
+        energyweights=tf.zeros_like(beta)+1.
+
+    n_events = tf.shape(row_splits)[0] - 1
+    row_ids = tf.ragged.row_splits_to_segment_ids(row_splits, out_type=tf.int64) # V
+    n_per_event = tf.cast(row_splits[1:] - row_splits[:-1], dtype='float32') # B
+
+    #same as per event
+    beta_in = beta
+    beta = tf.clip_by_value(beta, 0.,1.-1e-4)
+    beta *= (1. - is_spectator)
+    qraw = tf.math.atanh(beta)**2
+    q = qraw + Q_MIN * (1. - is_spectator) # V x 1
+
+    #object association: unique (event, truth index) pairs
+    t_idx = truth_indices[:,0]
+    t_int = tf.cast(tf.round(t_idx), dtype='int64')
+    member_idx = tf.where(t_idx > -0.1)[:,0] # V_m
+    t_stride = tf.reduce_max(tf.concat([t_int, tf.constant([0],dtype='int64')], axis=0)) + 1
+    obj_keys, member_obj = tf.unique(tf.gather(row_ids, member_idx) * t_stride + tf.gather(t_int, member_idx),
+                                     out_idx=tf.int64) # K, V_m
+    n_obj = tf.shape(obj_keys, out_type=tf.int64)[0]
+    obj_event = obj_keys // t_stride # K
+
+    K = tf.math.unsorted_segment_sum(tf.ones_like(obj_event, dtype='float32'), obj_event, n_events) # B
+    N_per_obj = tf.math.unsorted_segment_sum(tf.ones_like(member_obj, dtype='float32'), member_obj, n_obj) # K
+
+    #condensation point per object: max beta, lowest index for ties (as argmax)
+    beta_in_m = tf.gather(beta_in[:,0], member_idx)
+    max_beta_m = tf.gather(tf.math.unsorted_segment_max(beta_in_m, member_obj, n_obj), member_obj)
+    kalpha = tf.math.unsorted_segment_min(tf.where(beta_in_m == max_beta_m, member_idx,
+                                                   tf.shape(beta, out_type=tf.int64)[0]),
+                                          member_obj, n_obj) # K
+
+    x_kalpha = tf.gather(x, kalpha) # K x C
+    if use_average_cc_pos: #q weighted mean here
+        q_w = tf.gather(q, member_idx)
+        x_kalpha = tf.math.divide_no_nan(
+            tf.math.unsorted_segment_sum(q_w * tf.gather(x, member_idx), member_obj, n_obj),
+            tf.math.unsorted_segment_sum(q_w, member_obj, n_obj)) # K x C
+
+    q_kalpha = tf.gather(q, kalpha) # K x 1
+    beta_kalpha = tf.gather(beta_in, kalpha) # K x 1
+    object_weights_kalpha = tf.gather(energyweights, kalpha) # K x 1
+
+    #object properties for each vertex that belongs to an object
+    w_m = tf.gather(object_weights_kalpha, member_obj) # V_m x 1
+    q_kalpha_m = tf.gather(q_kalpha, member_obj) # V_m x 1
+    q_m = tf.gather(q, member_idx) # V_m x 1
+    distancesq_m = tf.reduce_sum((tf.gather(x_kalpha, member_obj) - tf.gather(x, member_idx)) ** 2,
+                               axis=-1, keepdims=True) # V_m x 1
+    
+    def per_event(per_obj, obj_norm=None):
+        '''
+        K -> B, normalised by N*K per event, or by obj_norm per object and by K
+        '''
+        if obj_norm is None:
+            return tf.math.divide_no_nan(tf.math.unsorted_segment_sum(per_obj, obj_event, n_events), n_per_event * K)
+        per_obj = tf.math.divide_no_nan(per_obj, obj_norm)
+        return tf.math.divide_no_nan(tf.math.unsorted_segment_sum(per_obj, obj_event, n_events), K)
+    
+    V_att = w_m * q_kalpha_m * q_m * distancesq_m # V_m x 1
+    V_att = tf.math.unsorted_segment_sum(V_att[:,0], member_obj, n_obj) # K
+    if alt_potential_norm:
+        V_att = per_event(V_att, N_per_obj)
+    else:
+        V_att = per_event(V_att)
     
+    #repulsion: all object-vertex pairs in the same event, sorted by object
+    pair_vert = tf.ragged.range(tf.gather(tf.cast(row_splits, 'int64'), obj_event),
+                                tf.gather(tf.cast(row_splits, 'int64'), obj_event+1)) # K x (V_event)
+    pair_obj = pair_vert.value_rowids() # P
+    pair_vert = pair_vert.flat_values # P
+
+    vert_obj = tf.scatter_nd(member_idx[:,tf.newaxis], member_obj+1, tf.shape(row_ids, out_type=tf.int64)) - 1 # V
+    M_not = tf.cast(tf.gather(vert_obj, pair_vert) != pair_obj, dtype='float32')[:,tf.newaxis] # P x 1
+
+    q_v = tf.gather(q, pair_vert) # P x 1
+    w_k = tf.gather(object_weights_kalpha, pair_obj) # P x 1
+    q_k = tf.gather(q_kalpha, pair_obj) # P x 1
+
+    distancesq = tf.reduce_sum((tf.gather(x_kalpha, pair_obj) - tf.gather(x, pair_vert)) ** 2,
+                               axis=-1, keepdims=True) # P x 1
+
+    V_rep=None
+    if prob_repulsion:
+        V_rep = -2.*tf.math.log(1.-tf.math.exp(-distancesq/2.)+1e-5)
+    else:
+        V_rep = tf.nn.relu(1. - tf.sqrt(distancesq + 1e-4))
+    V_rep = w_k * V_rep * M_not * q_k * q_v # P x 1
+    V_rep = tf.math.segment_sum(V_rep[:,0], pair_obj) # K
+    if alt_potential_norm:
+        V_rep = per_event(V_rep, tf.gather(n_per_event, obj_event) - N_per_obj)
+    else:
+        V_rep = per_event(V_rep)
+
+    ##beta penalty
+    beta_kalpha_sm = beta_kalpha
+    if cont_beta_loss:
+        beta_m = tf.gather(beta, member_idx)
+        meanb = tf.math.divide_no_nan(tf.math.unsorted_segment_sum(beta_m, member_obj, n_obj),
+                                      N_per_obj[:,tf.newaxis])
+        sqsum = tf.math.unsorted_segment_sum(beta_m**2, member_obj, n_obj)
+        beta_kalpha_sm = 1. - (tf.math.divide_no_nan(meanb+0.2, beta_kalpha+0.1) + tf.math.exp(-sqsum))
+
+    if phase_transition:
+        B_pen = - w_m * tf.gather(beta_kalpha, member_obj) * 1./(20*distancesq_m + 1.)
+        B_pen = tf.where(distancesq_m==0. , 0., B_pen) #exclude exact self-potential
+        B_pen = per_event(tf.math.unsorted_segment_sum(B_pen[:,0], member_obj, n_obj), N_per_obj)
+    else:
+        B_pen = tf.math.divide_no_nan(
+            tf.math.unsorted_segment_sum(object_weights_kalpha[:,0]*(1. - beta_kalpha_sm[:,0]), obj_event, n_events),
+            tf.math.unsorted_segment_sum(object_weights_kalpha[:,0], obj_event, n_events)) # B
+
+    to_much_B_pen = tf.zeros_like(n_per_event)
+    if not cont_beta_loss:
+        to_much_B_pen = tf.math.unsorted_segment_sum(beta_in[:,0]*energyweights[:,0], row_ids, n_events)
+        to_much_B_pen -= tf.math.unsorted_segment_sum(object_weights_kalpha[:,0], obj_event, n_events)
+        to_much_B_pen = tf.nn.relu(to_much_B_pen)
+        to_much_B_pen = tf.math.divide_no_nan(to_much_B_pen,
+                                              tf.math.unsorted_segment_sum(energyweights[:,0], row_ids, n_events))
+
+    ##noise penalty (as in the per event version, 'is_noise' is 1 for non-noise)
+    is_noise = tf.where(truth_indices<0., tf.zeros_like(truth_indices), 1.)[:,0]
+    Noise_pen = S_B*tf.math.divide_no_nan(tf.math.unsorted_segment_sum(is_noise * beta_in[:,0], row_ids, n_events),
+                                          tf.math.unsorted_segment_sum(is_noise, row_ids, n_events)) # B
+
+    #### payload
+    p_w = w_m * payload_weight_function_segments(tf.gather(beta, member_idx),
+                                                 tf.gather(energyweights, member_idx),
+                                                 payload_rel_threshold, member_obj, n_obj) # V_m x 1
+    pll = tf.math.unsorted_segment_sum(p_w * tf.gather(payload_loss, member_idx), member_obj, n_obj) # K x X
+    pll = tf.math.divide_no_nan(tf.math.unsorted_segment_sum(pll, obj_event, n_events),
+                                K[:,tf.newaxis]) # B x X
+
+    bsize = tf.cast(n_events, dtype='float32') + 1e-6
+    V_att = tf.reduce_sum(V_att, keepdims=True) / bsize
+    V_rep = tf.reduce_sum(V_rep, keepdims=True) / bsize
+    Noise_pen = tf.reduce_sum(Noise_pen) / bsize
+    B_pen = tf.reduce_sum(B_pen, keepdims=phase_transition) / bsize
+    pll = tf.reduce_sum(pll, axis=0) / bsize
+    to_much_B_pen = tf.reduce_sum(to_much_B_pen, keepdims=True) / bsize
+
+    return V_att, V_rep, Noise_pen, B_pen, pll, to_much_B_pen
+
+
 def oc_loss(
         x, 
         beta, 
@@ -219,17 +483,42 @@ def oc_loss(
         cont_beta_loss=False,
         prob_repulsion=False,
         phase_transition=False,
-        alt_potential_norm=False
+        alt_potential_norm=False,
+        batched=False,
+        grid_repulsion=False
         ):   
+    '''
+    batched: process all events at once instead of looping over them,
+    see oc_loss_batched
+    grid_repulsion: evaluate the repulsive term only for object-vertex pairs
+    in neighbouring unit cells, see oc_per_batch_element (not used if batched)
+    
+    The loop over the events is traceable by tf.function: the number of
+    events is taken from the dynamic shape and the accumulated terms
+    keep their shapes throughout the loop.
+    '''
+    
+    if batched:
+        return oc_loss_batched(x, beta, truth_indices, row_splits, is_spectator, payload_loss,
+                               Q_MIN=Q_MIN, S_B=S_B, energyweights=energyweights,
+                               use_average_cc_pos=use_average_cc_pos,
+                               payload_rel_threshold=payload_rel_threshold,
+                               cont_beta_loss=cont_beta_loss,
+                               prob_repulsion=prob_repulsion,
+                               phase_transition=phase_transition,
+                               alt_potential_norm=alt_potential_norm)
     
     if energyweights is None:
         energyweights=tf.zeros_like(beta)+1.
         
-    if row_splits.shape[0] is None:
-        return tf.constant(0,dtype='float32')
-    batch_size = row_splits.shape[0] - 1
+    batch_size = tf.shape(row_splits)[0] - 1
     
-    V_att, V_rep, Noise_pen, B_pen, pll,to_much_B_pen = 6*[tf.constant(0., tf.float32)]
+    V_att = tf.zeros([1], tf.float32)
+    V_rep = tf.zeros([1], tf.float32)
+    Noise_pen = tf.constant(0., tf.float32)
+    B_pen = tf.zeros([1], tf.float32) if phase_transition else tf.constant(0., tf.float32)
+    pll = tf.zeros([payload_loss.shape[-1]], tf.float32)
+    to_much_B_pen = tf.zeros([1], tf.float32)
     
     for b in tf.range(batch_size):
         att,rep,noise,bp,pl,tmb = oc_per_batch_element(
@@ -244,7 +533,7 @@ def oc_loss(
             is_spectator[row_splits[b]:row_splits[b + 1]],
             payload_loss[row_splits[b]:row_splits[b + 1]],
             
-            payload_weight_function=payload_weight_function,
+            payload_weight_function=payload_weight_function_segments,
             payload_weight_threshold=payload_rel_threshold,
             
             use_mean_x=use_average_cc_pos,
@@ -252,7 +541,8 @@ def oc_loss(
             S_B=S_B,
             prob_repulsion=prob_repulsion,
             phase_transition=phase_transition,
-            alt_potential_norm=alt_potential_norm
+            alt_potential_norm=alt_potential_norm,
+            grid_repulsion=grid_repulsion
             )
         V_att += att
         V_rep += rep
@@ -14,6 +14,7 @@ from obc_data import convert_dataset_dict_elements_to_numpy
 import index_dicts
 from matplotlib.patches import Patch
 import networkx as nx
+from scipy.optimize import linear_sum_assignment
 import tensorflow as tf
 from obc_data import build_window_analysis_dict, build_window_visualization_dict, append_window_dict_to_dataset_dict
 
@@ -387,78 +388,88 @@ def find_uniques_from_betas(betas, coords, dist_threshold, beta_threshold, soft)
     return labels, representative_indices, asso_idx.numpy()
 
 
+def _shower_index(sid, shower_sid):
+    '''
+    index of each hit's shower id in shower_sid.
+    Hits with an id that is not in shower_sid get index 0 (as for the one-hot
+    version before), for duplicated ids the last occurrence is used.
+    '''
+    order = np.argsort(shower_sid, kind='stable')
+    sorted_sid = shower_sid[order]
+    pos = np.searchsorted(sorted_sid, sid, side='right') - 1
+    found = pos >= 0
+    found[found] = sorted_sid[pos[found]] == sid[found]
+    return np.where(found, order[np.maximum(pos, 0)], 0)
+
+
 def calculate_all_iou_tf_3(truth_sid,
                            pred_sid,
                            truth_shower_sid,
                            pred_shower_sid,
                            hit_weight,
                            iou_threshold):
-    truth_sid = tf.cast(tf.convert_to_tensor(truth_sid), tf.int32)
-    pred_sid = tf.cast(tf.convert_to_tensor(pred_sid), tf.int32)
-    hit_weight = tf.cast(tf.convert_to_tensor(hit_weight), tf.float32)
+    '''
+    Energy weighted intersection over union for all pairs of predicted and truth showers.
+    Each hit is encoded as pred_idx * n_truth + truth_idx, a single weighted bincount
+    then gives the full (sparse) contingency table, i.e. the intersections.
+    Returns the pairs above threshold and the P x T iou and intersection matrices,
+    the predicted shower sums as P x 1 and the truth shower sums as 1 x T
+    '''
+    truth_sid = np.asarray(truth_sid).astype(np.int32)
+    pred_sid = np.asarray(pred_sid).astype(np.int32)
+    hit_weight = np.asarray(hit_weight).astype(np.float32)
 
-    truth_shower_sid = tf.convert_to_tensor(truth_shower_sid)
-    pred_shower_sid = tf.convert_to_tensor(pred_shower_sid)
+    truth_shower_sid = np.asarray(truth_shower_sid)
+    pred_shower_sid = np.asarray(pred_shower_sid)
     len_pred_showers = len(pred_shower_sid)
     len_truth_showers = len(truth_shower_sid)
 
-    truth_idx_2 = tf.zeros_like(truth_sid)
-    pred_idx_2 = tf.zeros_like(pred_sid)
-    hit_weight_2 = tf.zeros_like(hit_weight)
-
-    for i in range(len(pred_shower_sid)):
-        pred_idx_2 = tf.where(pred_sid == pred_shower_sid[i], i, pred_idx_2)
-
-    for i in range(len(truth_shower_sid)):
-        truth_idx_2 = tf.where(truth_sid == truth_shower_sid[i], i, truth_idx_2)
+    intersection_sum_matrix = np.zeros((len_pred_showers, len_truth_showers), np.float32)
+    if len_pred_showers > 0 and len_truth_showers > 0:
+        pred_idx = _shower_index(pred_sid, pred_shower_sid)
+        truth_idx = _shower_index(truth_sid, truth_shower_sid)
+        contingency = np.bincount(pred_idx * len_truth_showers + truth_idx, weights=hit_weight,
+                                  minlength=len_pred_showers * len_truth_showers)
+        intersection_sum_matrix = np.reshape(contingency, (len_pred_showers, len_truth_showers)).astype(np.float32)
 
-    one_hot_pred = tf.one_hot(pred_idx_2, depth=len_pred_showers)
-    one_hot_truth = tf.one_hot(truth_idx_2, depth=len_truth_showers)
+    pred_sum_matrix = np.sum(intersection_sum_matrix, axis=1, keepdims=True)
+    truth_sum_matrix = np.sum(intersection_sum_matrix, axis=0, keepdims=True)
 
-    intersection_sum_matrix = tf.linalg.matmul(one_hot_pred * hit_weight[..., tf.newaxis], one_hot_truth, transpose_a=True)
-    # cross_sum_matrix = tf.linalg.matmul(one_hot_pred * hit_weight[..., tf.newaxis], tf.ones_like(one_hot_truth),
-    #                                 transpose_a=True)
+    union_sum_matrix = pred_sum_matrix + truth_sum_matrix - intersection_sum_matrix
 
-    pred_sum_matrix = tf.linalg.matmul(one_hot_pred * hit_weight[..., tf.newaxis], tf.ones_like(one_hot_truth),
-                                    transpose_a=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlap_matrix = intersection_sum_matrix / union_sum_matrix
 
-    truth_sum_matrix = tf.linalg.matmul(
-        tf.ones_like(one_hot_pred) * hit_weight[..., tf.newaxis], one_hot_truth, transpose_a=True)
+    pred_i, truth_j = np.nonzero(overlap_matrix > iou_threshold)
+    valid = (pred_shower_sid[pred_i] != -1) & (truth_shower_sid[truth_j] != -1)
+    pred_i, truth_j = pred_i[valid], truth_j[valid]
 
-    union_sum_matrix = pred_sum_matrix + truth_sum_matrix - intersection_sum_matrix
+    all_iou = list(zip(pred_shower_sid[pred_i], truth_shower_sid[truth_j], overlap_matrix[pred_i, truth_j]))
+    return all_iou, overlap_matrix, pred_sum_matrix, truth_sum_matrix, intersection_sum_matrix
 
+def match_showers_linear_sum_assignment(iou_matrix, pred_shower_sid, truth_shower_sid, iou_threshold):
+    '''
+    Maximum weight matching of predicted to truth showers on the bipartite graph
+    given by the IoU matrix (P x T, rectangular is fine), only pairs above
+    threshold and without id -1 are considered.
+    Gives the same matching as networkx max_weight_matching on the graph built from
+    the thresholded pairs whenever the optimum is unique.
+    Returns a list of (pred shower sid, truth shower sid)
+    '''
+    pred_shower_sid = np.asarray(pred_shower_sid)
+    truth_shower_sid = np.asarray(truth_shower_sid)
+    if iou_matrix.size == 0:
+        return []
 
-    overlap_matrix = (intersection_sum_matrix / union_sum_matrix).numpy()
-    pred_shower_sid = pred_shower_sid.numpy()
-    truth_shower_sid = truth_shower_sid.numpy()
+    weights = np.where(iou_matrix > iou_threshold, iou_matrix, 0.) # also removes nan
+    weights[pred_shower_sid == -1, :] = 0.
+    weights[:, truth_shower_sid == -1] = 0.
 
-    # print(overlap_matrix.shape)
-    # 0/0
+    pred_i, truth_j = linear_sum_assignment(weights, maximize=True)
+    # pairs without an edge are part of the assignment but not a match
+    matched = weights[pred_i, truth_j] > 0
+    return list(zip(pred_shower_sid[pred_i[matched]], truth_shower_sid[truth_j[matched]]))
 
-    all_iou = []
-    for i in range(len_pred_showers):
-        for j in range(len_truth_showers):
-            # # if does_intersect_matrix[i,j] == 0:
-            # #     continue
-            # intersection = tf.cast(tf.math.logical_and((truth_idx == truth_shower_idx[j]), (pred_idx == pred_shower_idx[i])), tf.float32)
-            #
-            # union = tf.reduce_sum(tf.cast(tf.math.logical_or ((truth_idx == truth_shower_idx[j]), (pred_idx == pred_shower_idx[i])), tf.float32) * hit_weight)
-            # # print(tf.reduce_sum(intersection), intersection_matrix[i,j], tf.reduce_sum(union), union_matrix[i,j])
-            # if union > 0:
-            #     print(tf.reduce_sum(union), union_matrix[i, j])
-            #
-            # overlap = tf.reduce_sum(hit_weight * intersection) / tf.reduce_sum(hit_weight * union)
-            #
-            # total_sum += (overlap - overlap_matrix[i,j])**2
-
-            overlap = overlap_matrix[i, j]
-
-            if overlap > iou_threshold:
-                if pred_shower_sid[i] == -1 or truth_shower_sid[j] == -1:
-                    continue
-                all_iou.append((pred_shower_sid[i], truth_shower_sid[j], overlap))
-                # G.add_edge('p%d'%index_shower_prediction, 't%d'%unique_showers_this_segment[i], weight=overlap)
-    return all_iou, overlap_matrix, pred_sum_matrix.numpy(), truth_sum_matrix.numpy(), intersection_sum_matrix.numpy()
 
 num_total_fakes = 0
 num_total_showers = 0
@@ -468,7 +479,8 @@ fake_max_iou_values = []
 
 class WindowAnalyser:
     def __init__(self, analysis_input_dict, beta_threshold,
-                 distance_threshold, iou_threshold, window_id, should_return_visualization_data=False, soft=False):
+                 distance_threshold, iou_threshold, window_id, should_return_visualization_data=False, soft=False,
+                 matching_backend='networkx'):
 
         # features, prediction = index_dicts.split_feat_pred(prediction)
         # pred_and_truth_dict = index_dicts.create_index_dict(truth, prediction)
@@ -520,6 +532,9 @@ class WindowAnalyser:
         self.distance_threshold = distance_threshold
         self.iou_threshold = iou_threshold
         self.is_soft = soft
+        if matching_backend not in ['networkx', 'linear_sum_assignment']:
+            raise ValueError("Unknown matching backend " + str(matching_backend))
+        self.matching_backend = matching_backend
         self.truth_sid = truth_sid
         self.results_dict = build_window_analysis_dict()
 
@@ -546,23 +561,27 @@ class WindowAnalyser:
             pred_shower_sid_to_energy[x] = pred_shower_energy[i]
 
 
-        G = nx.Graph()
         all_iou, iou_matrix, pred_sum_matrix, truth_sum_matrix, intersection_matrix = calculate_all_iou_tf_3(truth_sid, pred_sid,
                                                                                             truth_shower_sid, pred_shower_sid, hit_weight, self.iou_threshold)
-        for iou in all_iou:
-            # print(iou)
-            G.add_edge('p%d' % iou[0], 't%d' % iou[1], weight=iou[2])
-
-        X = nx.algorithms.max_weight_matching(G)
-        for x, y in X:
-            if x[0] == 'p':
-                prediction_index = int(x[1:])
-                truth_index = int(y[1:])
-            else:
-                truth_index = int(x[1:])
-                prediction_index = int(y[1:])
+        if self.matching_backend == 'linear_sum_assignment':
+            matches = match_showers_linear_sum_assignment(iou_matrix, pred_shower_sid, truth_shower_sid,
+                                                          self.iou_threshold)
+        else:
+            G = nx.Graph()
+            for iou in all_iou:
+                # print(iou)
+                G.add_edge('p%d' % iou[0], 't%d' % iou[1], weight=iou[2])
+
+            matches = []
+            X = nx.algorithms.max_weight_matching(G)
+            for x, y in X:
+                if x[0] == 'p':
+                    matches.append((int(x[1:]), int(y[1:])))
+                else:
+                    matches.append((int(y[1:]), int(x[1:])))
 
-            # print(x,y, truth_index, prediction_index)
+        for prediction_index, truth_index in matches:
+            # print(truth_index, prediction_index)
 
             truth_shower_sid_to_pred_shower_sid[truth_index] = prediction_index
             pred_shower_sid_to_truth_shower_sid[prediction_index] = truth_index
@@ -967,11 +986,11 @@ def analyse_one_window_cut(truth_sid, features, truth, prediction, beta_threshol
 
 def analyse_window_cut(analysis_input_dict, beta_threshold,
                            distance_threshold, iou_threshold, window_id, should_return_visualization_data=False,
-                           soft=False, ):
+                           soft=False, matching_backend='networkx'):
     results_dict = WindowAnalyser(analysis_input_dict, beta_threshold,
                                   distance_threshold, iou_threshold, window_id,
                                   should_return_visualization_data=should_return_visualization_data,
-                                  soft=soft).analyse()
+                                  soft=soft, matching_backend=matching_backend).analyse()
 
     return results_dict
 
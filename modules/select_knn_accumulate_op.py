@@ -0,0 +1,59 @@
+import tensorflow as tf
+from tensorflow.python.framework import ops
+
+'''
+Wrap the module
+'''
+
+_sknn_acc_op = tf.load_op_library('select_knn_accumulate.so')
+_sknn_acc_grad_op = tf.load_op_library('select_knn_accumulate_grad.so')
+
+def SelectKnnAccumulate(K : int, coords, features, row_splits, distance_scale=1., max_radius=-1.,
+                        return_neighbours=False, max_shells=-1):
+    '''
+    (CPU only) SelectKnn and AccumulateKnn in one op, same results as:
+
+        idx, dist = SelectKnn(K, coords, row_splits, max_radius=max_radius, tf_compatible=False, binned=True)
+        f, max_idxs = AccumulateKnn(distance_scale*dist[:,1:], features, idx[:,1:])
+
+    The neighbours of each vertex are only kept while accumulating, so the V x K
+    index and distance matrices are not created (the gradient recomputes them).
+
+    K includes the vertex itself, as for SelectKnn, but self is not accumulated.
+    max_shells: approximate search, see SelectKnn
+
+    returns out features (mean and max), max indices, indices, distances**2
+    If return_neighbours is False, indices and distances have shape V x 0,
+    otherwise V x K-1 (without self, padded with -1).
+    Gradients are implemented for coordinates, features and the distances.
+    '''
+    assert K > 1
+    return _sknn_acc_op.SelectKnnAccumulate(n_neighbours=K, max_radius=max_radius, distance_scale=distance_scale,
+                                            keep_neighbours=return_neighbours, max_shells=max_shells,
+                                            coords=coords, features=features, row_splits=row_splits)
+
+
+@ops.RegisterGradient("SelectKnnAccumulate")
+def _SelectKnnAccumulateGrad(op, grad, gradmaxidxs, gradidx, graddist):
+
+    coords = op.inputs[0]
+    features = op.inputs[1]
+    row_splits = op.inputs[2]
+    max_feat_indices = op.outputs[1]
+
+    if graddist is None:
+        graddist = tf.zeros_like(op.outputs[3])
+
+    coord_grad, feat_grad = _sknn_acc_grad_op.SelectKnnAccumulateGrad(
+        n_neighbours=op.get_attr('n_neighbours'),
+        max_radius=op.get_attr('max_radius'),
+        distance_scale=op.get_attr('distance_scale'),
+        max_shells=op.get_attr('max_shells'),
+        grad_from_out_features=grad,
+        grad_from_distances=graddist,
+        coords=coords,
+        features=features,
+        row_splits=row_splits,
+        max_feat_indices=max_feat_indices)
+
+    return coord_grad, feat_grad, None #no grad for row splits
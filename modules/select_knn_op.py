@@ -9,10 +9,23 @@ Wrap the module
 _sknn_op = tf.load_op_library('select_knn.so')
 
 def SelectKnn(K : int, coords,  row_splits, masking_values=None, threshold=0.5, tf_compatible=True, max_radius=-1.,
-              mask_mode='none', mask_logic='xor'):
+              mask_mode='none', mask_logic='xor', binned=False, max_shells=-1):
     '''
     returns indices and distances**2 , gradient for distances is implemented!
     
+    binned: (CPU only) bin the coordinates in a uniform grid per row split and
+    search only neighbouring cells, multithreaded. Selects neighbours with the same
+    distances as the brute-force search, but
+      - returns them sorted by distance (the brute-force order depends on the search history)
+      - for ties at the largest selected distance keeps the lower indices, the brute-force
+        search may keep others (frequent for discrete coordinates)
+    so the indices can differ. Therefore not the default.
+    
+    max_shells: (binned only) approximate search for faster inference. If >= 0, only the
+    grid cells up to max_shells cells away from the vertex are searched (more if fewer than K
+    neighbours were found there). Lower values are faster and have lower recall, use
+    knn_recall.knn_recall to measure it. -1: exact search.
+    
     new: mask (switch):
     masked:
       0) none = no masking
@@ -27,6 +40,7 @@ def SelectKnn(K : int, coords,  row_splits, masking_values=None, threshold=0.5,
     '''
     assert mask_mode=='none' or mask_mode=='acc' or  mask_mode=='scat'
     assert mask_mode=='none' or mask_logic=='xor' or mask_logic=='and' 
+    assert binned or max_shells < 0, 'max_shells needs binned=True'
     
     if masking_values is None:
         assert mask_mode=='none'
@@ -64,7 +78,8 @@ def SelectKnn(K : int, coords,  row_splits, masking_values=None, threshold=0.5,
     '''
     
     return _sknn_op.SelectKnn(n_neighbours=K, tf_compatible=tf_compatible, max_radius=max_radius,
-                                 coords=coords, row_splits=row_splits, mask=mask, mask_mode=op_mask_mode)
+                                 coords=coords, row_splits=row_splits, mask=mask, mask_mode=op_mask_mode,
+                                 binned=binned, max_shells=max_shells)
     
 
 
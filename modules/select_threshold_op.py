@@ -8,7 +8,6 @@ Description
 
 #_selthresh_op = tf.load_op_library('select_threshold.so')
 
-#@tf.function
 def SelectThreshold(x, pl, rowsplits, hardness = 20., threshold=0.5):
     
     
@@ -16,45 +15,32 @@ def SelectThreshold(x, pl, rowsplits, hardness = 20., threshold=0.5):
     
     x >= 0
     
-    '''
+    Selects all vertices with x >= threshold. The threshold is lowered if needed,
+    such that at least one vertex per row split remains.
+    The payload pl is weighted with a sigmoid of (x - threshold).
     
-    if x.shape[0] is None: #keras pre-compile
-        return pl, rowsplits, tf.zeros_like(rowsplits), x
+    Returns the weighted payload of the selected vertices, the new row splits,
+    the indices of the selected vertices (to scatter back), and their x values.
+    Everything is computed with segment operations, without a loop over row splits.
     
-    all_idxs = tf.expand_dims(tf.range(x.shape[0]),axis=1)
-    
-    #make sure at least two survive so that the gradient is not cut off and there is a gradient w.r.t. selection!
-    #do this per RS
+    '''
     
-    tf.print(x.shape, rowsplits.shape)
-    xragged = tf.RaggedTensor.from_row_splits(values=x,
-              row_splits=rowsplits)
+    n_rs = tf.shape(rowsplits)[0] - 1
+    row_ids = tf.ragged.row_splits_to_segment_ids(rowsplits)
     
     #make sure at least one vertex per RS remains
-    max_per_rs = tf.reduce_max(xragged, axis=1)
-    global_max = tf.expand_dims(tf.reduce_min(max_per_rs),axis=0)-1e-6
-    
-    threshold = tf.reduce_min(tf.concat([global_max, tf.zeros_like(global_max)+threshold],axis=0))
+    max_per_rs = tf.math.unsorted_segment_max(x[:,0], row_ids, n_rs)
+    threshold = tf.minimum(tf.reduce_min(max_per_rs)-1e-6, threshold)
     
-    tf.print('threshold',threshold)
     offset = -4.6/hardness # approx =  - tf.math.log(1/0.01 - 1.)/hardness
     weight = tf.nn.sigmoid( hardness*(x + offset - threshold) )
     weighted_pl = weight * pl
     
-    tf.print('xmean, xmin',tf.reduce_mean(x), tf.reduce_min(x))
+    selected = x[:,0] >= threshold
+    scatter_idxs = tf.cast(tf.where(selected), dtype='int32')
     
-    scatter_idxs = tf.expand_dims(all_idxs[x>=threshold],axis=1)
-    #print('scatter_idxs',scatter_idxs.shape)
-    
-    new_rs = [tf.zeros((1,), dtype='int32') for i in tf.range(tf.shape(rowsplits)[0])]
-    ntot = tf.zeros((1,), dtype='int32')
-    for i in tf.range(tf.shape(rowsplits)[0]-1):
-        x_s = x[rowsplits[i]:rowsplits[i+1]][:,0]
-        n = tf.shape(x_s[x_s>=threshold])[0]
-        ntot += n
-        new_rs[i+1] = ntot
-        
-    rs = tf.concat(new_rs, axis=0)
+    n_per_rs = tf.math.unsorted_segment_sum(tf.cast(selected, dtype='int32'), row_ids, n_rs)
+    rs = tf.concat([tf.zeros((1,), dtype='int32'), tf.cumsum(n_per_rs)], axis=0)
 
     gathered = tf.gather_nd(weighted_pl, scatter_idxs)
     gathered_threshvals = tf.gather_nd(x, scatter_idxs)
@@ -15,7 +15,6 @@ from LayersRagged import RaggedConstructTensor
 import os
 import argparse
 import matplotlib.pyplot as plt
-import gzip
 import pickle
 from ragged_plotting_tools import make_cluster_coordinates_plot, make_original_truth_shower_plot, createRandomizedColors
 from DeepJetCore.training.gpuTools import DJCSetGPUs
@@ -24,6 +23,7 @@ from obc_data import build_dataset_analysis_dict, build_window_analysis_dict, ap
 import copy
 import index_dicts
 import time
+from multiprocessing import get_context
 
 from ragged_plotting_tools import do_analysis_plots_to_pdf, get_analysis_plotting_configuration
 from ragged_plotting_tools import analyse_window_cut
@@ -53,11 +53,13 @@ ragged_constructor = RaggedConstructTensor()
 num_rechits_per_segment = []
 num_rechits_per_shower = []
 
-window_id = 0
-def analyse_one_file(_features, predictions, truth_in, soft=False):
-    global num_visualized_segments, num_segments_to_visualize
-    global dataset_analysis_dict, window_id
-
+def analyse_one_file(_features, predictions, truth_in, beta_threshold, distance_threshold, iou_threshold,
+                     first_window_id=0, num_to_visualize=0, soft=False, matching_backend='networkx'):
+    '''
+    Analyses all windows of one file, the windows are numbered starting from first_window_id,
+    visualization data is produced for the first num_to_visualize windows.
+    Returns the list of window analysis dicts
+    '''
 
     # predictions = tf.constant(predictions[0])
 
@@ -86,6 +88,7 @@ def analyse_one_file(_features, predictions, truth_in, soft=False):
 
     num_unique = []
     shower_sizes = []
+    window_dicts = []
 
     # here ..._s refers to quantities per window/segment
     #
@@ -123,32 +126,68 @@ def analyse_one_file(_features, predictions, truth_in, soft=False):
         analysis_input["pred_time"] = pred_time_s
         analysis_input["pred_pid"] = pred_pid_s
 
-        if num_visualized_segments < num_segments_to_visualize:
-            window_analysis_dict = analyse_window_cut(analysis_input, beta_threshold, distance_threshold, iou_threshold,
-                                                      window_id, True, soft=soft)
-        else:
-            window_analysis_dict = analyse_window_cut(analysis_input, beta_threshold, distance_threshold, iou_threshold,
-                                                      window_id, False, soft=soft)
+        window_id = first_window_id + len(window_dicts)
+        window_analysis_dict = analyse_window_cut(analysis_input, beta_threshold, distance_threshold, iou_threshold,
+                                                  window_id, len(window_dicts) < num_to_visualize, soft=soft,
+                                                  matching_backend=matching_backend)
+        window_dicts.append(window_analysis_dict)
+
+    return window_dicts
+
 
-        append_window_dict_to_dataset_dict(dataset_analysis_dict, window_analysis_dict)
-        num_visualized_segments += 1
-        window_id += 1
+def analyse_file_worker(args):
+    '''
+    Analyses one file in a worker process. The windows are numbered from 0 and the
+    first num_to_visualize windows of the file are visualized; the parent shifts the
+    ids and drops the surplus visualizations (see shift_window_ids)
+    '''
+    file, beta_threshold, distance_threshold, iou_threshold, num_to_visualize, soft, matching_backend = args
+    data_dict = TrainData_OC().readPredicted(file)
+    window_dicts = analyse_one_file(data_dict['features'], data_dict['predicted'], data_dict['truth'],
+                                    beta_threshold, distance_threshold, iou_threshold,
+                                    first_window_id=0, num_to_visualize=num_to_visualize, soft=soft,
+                                    matching_backend=matching_backend)
+    return {'file': file, 'windows': window_dicts}
 
-    i += 1
 
+def shift_window_ids(window_dict, offset):
+    for key in ['truth_shower_sample_id', 'pred_shower_sample_id', 'ticl_shower_sample_id']:
+        if key in window_dict:
+            window_dict[key] = [x + offset for x in window_dict[key]]
 
-def main(files, pdfpath, dumppath, soft, run_for=-1):
+
+def main(files, pdfpath, dumppath, soft, run_for=-1, matching_backend='networkx', n_workers=1):
     global dataset_analysis_dict, fake_max_iou_values
-    file_index = 0
-    for file in files:
-        print("\nFILE\n", file_index)
-        with gzip.open(file, 'rb') as f:
-            data_dict = pickle.load(f)
+    if run_for > 1:
+        files = files[:run_for - 1]
+
+    window_id = 0
+    if n_workers > 1:
+        # the results come back in file order, so window ids do not depend on scheduling
+        worker_args = [(file, beta_threshold, distance_threshold, iou_threshold, num_segments_to_visualize, soft,
+                        matching_backend) for file in files]
+        with get_context('spawn').Pool(n_workers) as pool:
+            for file_index, file_result in enumerate(pool.imap(analyse_file_worker, worker_args)):
+                print("\nFILE\n", file_index)
+                for window_dict in file_result['windows']:
+                    shift_window_ids(window_dict, window_id)
+                    if window_id >= num_segments_to_visualize:
+                        window_dict['visualization_data'] = -1
+                    append_window_dict_to_dataset_dict(dataset_analysis_dict, window_dict)
+                    window_id += 1
+    else:
+        for file_index, file in enumerate(files):
+            print("\nFILE\n", file_index)
+            data_dict = TrainData_OC().readPredicted(file)
             # print("XYZ", len(data_dict['features']), len(data_dict['predicted']), len(data_dict['truth']))
-            analyse_one_file(data_dict['features'], data_dict['predicted'], data_dict['truth'], soft=soft)
-            file_index += 1
-            if file_index == run_for-1:
-                break
+            window_dicts = analyse_one_file(data_dict['features'], data_dict['predicted'], data_dict['truth'],
+                                            beta_threshold, distance_threshold, iou_threshold,
+                                            first_window_id=window_id,
+                                            num_to_visualize=num_segments_to_visualize - window_id,
+                                            soft=soft, matching_backend=matching_backend)
+            for window_dict in window_dicts:
+                append_window_dict_to_dataset_dict(dataset_analysis_dict, window_dict)
+            window_id += len(window_dicts)
 
     if len(dumppath) > 0:
         print("Dumping analysis to bin file", dumppath)
@@ -170,7 +209,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         'Analyse predictions from object condensation and plot relevant results')
     parser.add_argument('output',
-                        help='Output directory with .bin.gz files (all will be analysed) or a text file containing lest of those which are to be analysed')
+                        help='Output directory with .bin.gz or .predcol prediction files (all will be analysed) or a text file containing lest of those which are to be analysed')
     parser.add_argument('-p',
                         help='Name of the output file (you have to manually append .pdf). Otherwise will be produced in the output directory.',
                         default='')
@@ -184,11 +223,13 @@ if __name__ == '__main__':
     parser.add_argument('--analysisoutpath', help='Can be used to remake plots. Will dump analysis to a file.',
                         default='')
     parser.add_argument('--gpu', help='GPU', default='')
+    parser.add_argument('-j', help='Number of files analysed in parallel (default 1)', default='1')
+    parser.add_argument('--matching', help='Shower matching backend (default networkx)', default='networkx',
+                        choices=['networkx', 'linear_sum_assignment'])
     args = parser.parse_args()
 
     # DJCSetGPUs(args.gpu)
     num_segments_to_visualize = int(args.v)
-    num_visualized_segments = 0
     dataset_analysis_dict = build_dataset_analysis_dict()
 
     beta_threshold = float(args.b)
@@ -207,7 +248,7 @@ if __name__ == '__main__':
     pdfpath = ''
     if os.path.isdir(args.output):
         for x in os.listdir(args.output):
-            if x.endswith('.bin.gz'):
+            if x.endswith('.bin.gz') or x.endswith('.predcol'):
                 files_to_be_tested.append(os.path.join(args.output, x))
         pdfpath = args.output
     elif os.path.isfile(args.output):
@@ -224,6 +265,7 @@ if __name__ == '__main__':
     if len(args.p) != 0:
         pdfpath = args.p
 
-    main(files_to_be_tested, pdfpath, args.analysisoutpath, soft=args.soft, run_for=n_files)
+    main(files_to_be_tested, pdfpath, args.analysisoutpath, soft=args.soft, run_for=n_files,
+         matching_backend=args.matching, n_workers=int(args.j))
 
 
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+
+parser = ArgumentParser('Convert a list of ntuples to TrainData_OC files in parallel, one output file per input file')
+parser.add_argument('inputFileList', help="text file listing all input files")
+parser.add_argument('outputDir')
+parser.add_argument('-c', help="data structure class", default="TrainData_OC")
+parser.add_argument('-j', help="number of parallel processes", default="1")
+parser.add_argument('--chunk', help="read the trees in blocks of this many events (0: all at once)", default="0")
+parser.add_argument('--columnar', help="also write each file in the memory mappable columnar layout", action='store_true')
+
+args = parser.parse_args()
+
+import os
+import datastructures
+
+with open(args.inputFileList) as f:
+    infiles = [l.strip() for l in f if len(l.strip())]
+
+if not os.path.isdir(args.outputDir):
+    os.makedirs(args.outputDir)
+
+td = getattr(datastructures, args.c)()
+td.conversion_chunk_events = int(args.chunk)
+
+outfiles = td.convertFileList(infiles, args.outputDir, n_workers=int(args.j), columnar=args.columnar)
+print('converted', len(outfiles), 'files')
@@ -5,7 +5,7 @@ from argparse import ArgumentParser
 parser = ArgumentParser('Apply a model to a (test) source sample and create friend trees to inject it inthe original ntuple')
 parser.add_argument('inputModel')
 parser.add_argument('outputDir')
-parser.add_argument('-i', help="input traindata file", default="/eos/cms/store/cmst3/group/hgcal/CMG_studies/hgcalsim/ml.TestDataSet/Xmas19/windowntup_99.djctd")
+parser.add_argument('-i', help="input traindata file, or directory in the columnar layout (see TrainData_OC.writeColumnar)", default="/eos/cms/store/cmst3/group/hgcal/CMG_studies/hgcalsim/ml.TestDataSet/Xmas19/windowntup_99.djctd")
 parser.add_argument("-e", help="event number ", default="0")
 
 args = parser.parse_args()
@@ -20,9 +20,15 @@ import matplotlib.pyplot as plt
 from ragged_plotting_tools import make_cluster_coordinates_plot, make_original_truth_shower_plot
 from index_dicts import create_index_dict, create_feature_dict
 
-td=TrainData()
-td.readFromFile(args.i)
-td.skim(int(args.e))
+import os
+if os.path.isdir(args.i):
+    from datastructures import TrainData_OC
+    td=TrainData_OC()
+    td.readColumnar(args.i, [int(args.e)])#only reads this event
+else:
+    td=TrainData()
+    td.readFromFile(args.i)
+    td.skim(int(args.e))
 #td=td.split(int(args.e)+1)#get the first e+1 elements
 #if int(args.e)>0:
 #    td.split(1) #reduce to the last element (the e'th one)
@@ -35,6 +35,7 @@ import random
 import glob
 import errno
 import os
+import struct
 
 # ############# HACK #############
 # tritongrpcclient python api is currently limiting
@@ -138,6 +139,50 @@ def encode_prediction(data_arr):
         enc+='\n'
     return enc
 
+
+'''
+Binary protocol (all little-endian):
+ request:  int64 n_hits, int64 n_features, int64 n_row_splits,
+           int64 row_splits[n_row_splits],
+           float32 features[n_hits * n_features]
+ response: int64 n_rows, int64 n_columns,
+           float32 prediction[n_rows * n_columns]
+'''
+
+def read_exact(stream, nbytes):
+    buf = bytearray()
+    while len(buf) < nbytes:
+        chunk = stream.read(nbytes - len(buf))
+        if not chunk:
+            raise EOFError("stream ended after "+str(len(buf))+" of "+str(nbytes)+" bytes")
+        buf += chunk
+    return bytes(buf)
+
+def decode_request_binary(stream):
+    n_hits, n_feat, n_rs = struct.unpack('<qqq', read_exact(stream, 24))
+    row_splits = np.frombuffer(read_exact(stream, 8*n_rs), dtype='<i8')
+    data = np.frombuffer(read_exact(stream, 4*n_hits*n_feat), dtype='<f4')
+    return np.reshape(data, [n_hits, n_feat]), row_splits
+
+def encode_request_binary(hit_data, row_splits):
+    hit_data = np.ascontiguousarray(hit_data, dtype='<f4')
+    row_splits = np.ascontiguousarray(row_splits, dtype='<i8')
+    return struct.pack('<qqq', hit_data.shape[0], hit_data.shape[1], row_splits.shape[0]) \
+        + row_splits.tobytes() + hit_data.tobytes()
+
+def encode_prediction_binary(data_arr):
+    data_arr = np.ascontiguousarray(data_arr, dtype='<f4')
+    return struct.pack('<qq', data_arr.shape[0], data_arr.shape[1]) + data_arr.tobytes()
+
+def padded_row_splits(row_splits, n_hits):
+    '''
+    row splits in the format the model expects: V x 1, the last entry is the number of row splits
+    '''
+    rs = np.zeros((max(n_hits, row_splits.shape[0]+1),1),dtype="int64")
+    rs[:row_splits.shape[0],0] = row_splits
+    rs[-1] = row_splits.shape[0]
+    return rs
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-v',
@@ -162,6 +207,12 @@ if __name__ == '__main__':
                         required=False,
                         default='localhost:8001',
                         help='Inference server URL. Default is localhost:8001.')
+    parser.add_argument('-b',
+                        '--binary',
+                        action="store_true",
+                        required=False,
+                        default=False,
+                        help='Use the binary protocol for the fifos instead of text')
     
     
     FLAGS = parser.parse_args()
@@ -180,13 +231,18 @@ if __name__ == '__main__':
     os.mkfifo(FIFO_out)
     while True:
         try:
-            with open(FIFO) as fifo:
-                data = np.loadtxt(fifo)
-                
-            data = np.array(data,dtype='float32')
-            rs = np.zeros((data.shape[0],1),dtype="int64")
-            rs[1] = max(data.shape[0],3)
-            rs[-1]=2
+            if FLAGS.binary:
+                with open(FIFO,'rb') as fifo:
+                    data, rs = decode_request_binary(fifo)
+                rs = padded_row_splits(rs, data.shape[0])
+            else:
+                with open(FIFO) as fifo:
+                    data = np.loadtxt(fifo)
+                    
+                data = np.array(data,dtype='float32')
+                rs = np.zeros((data.shape[0],1),dtype="int64")
+                rs[1] = max(data.shape[0],3)
+                rs[-1]=2
             
         except Exception as e:
             print(e)
@@ -196,10 +252,14 @@ if __name__ == '__main__':
         print('request eval')
         predicted = request_eval(data,rs, triton_client, model_name)
         
-        enc = encode_prediction(predicted)
-        #print(enc)
-        with open(FIFO_out,'w') as fifo:
-            fifo.write(enc)
+        if FLAGS.binary:
+            with open(FIFO_out,'wb') as fifo:
+                fifo.write(encode_prediction_binary(predicted))
+        else:
+            enc = encode_prediction(predicted)
+            #print(enc)
+            with open(FIFO_out,'w') as fifo:
+                fifo.write(enc)
             
         print('result ready')
                 